@@ -1,71 +1,24 @@
-import numpy as np
+import os, time
+import pandas as pd
 import matplotlib.pyplot as plt
-from scipy.signal import savgol_filter
-from scipy.integrate import simps
 import seaborn as sns
+from result_cache import cached_normalized, cached_equivalent_widths, default_cache
+from line_catalog import load_catalog
+from ew_uncertainty import monte_carlo_equivalent_widths
+from results_store import ResultsStore, spectral_type_columns
 sns.set_theme(style="darkgrid")
 
 unknown_stars = {
-    'unknown_star_1': "/Users/madsmikkelsen/ULL/1. Semester/Atmosferas_Estelares/ProblemStar1.dat",
-    'unknown_star_2': "/Users/madsmikkelsen/ULL/1. Semester/Atmosferas_Estelares/ProblemStar2.dat"
+    'unknown_star_1': "ProblemStar1.dat",
+    'unknown_star_2': "ProblemStar2.dat"
 }
 
-absorption_lines = {
-    3932: 'Ca II', # Gray
-    3967: 'Ca II', # Gray
-    4030: 'blend', # Gray
-    4102: 'Hδ', # Gray
-    4340: 'Hγ', # Gray
-    4383: 'Fe I', # Gray
-    4471: 'He I', # NIST
-    4540: 'He II', # Walborn & Fitzpatrick 1990
-    4684: 'He II', # Walborn & Fitzpatrick 1990
-    4860: 'Hβ', # Gray
-    4921: 'Fe I', # Gray
-    5014: 'TENT.',
-    5411: 'TENT.',
-    5875: 'TENT.',
-    5890: 'Na I D1', # Gray, Morton 2003
-    5896: 'Na I D2', # Gray, Morton 2003
-    6270: 'TENT.',
-    6284: 'DIB', # Snow, York & Welty 1977, Herbig 1995
-    6347: 'TENT.',
-    6380: 'TENT.',
-    6560: 'Hα', # Gray
-    6614: 'DIB', # Herbig 1995
-    6684: 'TENT.'
-}
+# Lines to mark, from the shared catalog in line_catalog.tsv
+absorption_lines = dict(load_catalog().as_pairs())
 
 # Constants for separating spectra on the plot
 flux_offset = 2.0
 
-# Function to normalize spectrum
-def normalize_spectrum_smooth(wavelength, flux, window_length=101, polyorder=3):
-    """
-    Normalize the flux of the spectrum by smoothing over local peaks.
-
-    Parameters:
-    wavelength: array-like
-        Array of wavelength values.
-    flux: array-like
-        Array of flux values.
-    window_length: int
-        The length of the filter window (number of points). Must be odd.
-    polyorder: int
-        The order of the polynomial used to fit the samples.
-
-    Returns:
-    norm_flux: array-like
-        The normalized flux.
-    """
-    # Smooth the flux to estimate the continuum
-    smoothed_flux = savgol_filter(flux, window_length, polyorder)
-
-    # Normalize the flux
-    norm_flux = flux / smoothed_flux
-
-    return norm_flux
-
 # Function to plot spectra with annotated absorption lines
 def plot_spectrum_with_lines(wavelength, flux, norm_flux, title):
     plt.figure(figsize=(15, 10))
@@ -88,56 +41,37 @@ def plot_spectrum_with_lines(wavelength, flux, norm_flux, title):
     plt.show()
 
 # Example usage for problem stars
-unknown_star_1 = "/Users/madsmikkelsen/ULL/1. Semester/Atmosferas_Estelares/ProblemStar1.dat"
-unknown_star_2 = "/Users/madsmikkelsen/ULL/1. Semester/Atmosferas_Estelares/ProblemStar2.dat"
+unknown_star_1 = "ProblemStar1.dat"
+unknown_star_2 = "ProblemStar2.dat"
 
-# Process the unknown spectra
-wavelength_1, flux_1 = np.loadtxt(unknown_star_1, unpack=True)
-norm_flux_1 = normalize_spectrum_smooth(wavelength_1, flux_1)
+# Process the unknown spectra (normalizations and EWs are reused from the result cache)
+wavelength_1, flux_1, norm_flux_1 = cached_normalized(unknown_star_1)
 plot_spectrum_with_lines(wavelength_1, flux_1, norm_flux_1, 'Unknown Star 1 - Normalized and Unnormalized Spectrum')
 
-wavelength_2, flux_2 = np.loadtxt(unknown_star_2, unpack=True)
-norm_flux_2 = normalize_spectrum_smooth(wavelength_2, flux_2)
+wavelength_2, flux_2, norm_flux_2 = cached_normalized(unknown_star_2)
 plot_spectrum_with_lines(wavelength_2, flux_2, norm_flux_2, 'Unknown Star 2 - Normalized and Unnormalized Spectrum')
 
-def calculate_equivalent_width(wavelength, flux, line_center, width=5):
-    """
-    Calculate the equivalent width of an absorption line.
-
-    Parameters:
-    wavelength: array-like
-        Array of wavelength values.
-    flux: array-like
-        Array of flux values.
-    line_center: float
-        Central wavelength of the absorption line.
-    width: float
-        Range around the line center to consider for integration, in Angstroms.
-
-    Returns:
-    equivalent_width: float
-        The equivalent width of the absorption line.
-    """
-    # Define the integration range around the line center
-    min_range = line_center - width
-    max_range = line_center + width
-
-    # Select the wavelength and flux in the range of interest
-    mask = (wavelength >= min_range) & (wavelength <= max_range)
-    selected_wavelength = wavelength[mask]
-    selected_flux = flux[mask]
-
-    continuum_flux = np.mean(selected_flux[:5])
-
-    # Calculate the equivalent width using Simpson's rule for integration
-    ew = simps(1 - (selected_flux / continuum_flux), selected_wavelength)
-    
-    return ew
-
 # Calculate equivalent width for selected absorption lines
-for line_wavelength, line_label in absorption_lines.items():
-    if line_wavelength in [4102, 4340, 4471, 4540, 4684, 4860, 6560]:  
-        ew = calculate_equivalent_width(wavelength_1, norm_flux_1, line_wavelength)
-        print(f"Equivalent Width of {line_label} at {line_wavelength} Å: {ew:.2f} Å")
-
+line_index, _ = load_catalog().nearest([4102, 4340, 4471, 4540, 4684, 4860, 6560])
+selected_lines = load_catalog().center[line_index]
+ews = cached_equivalent_widths(unknown_star_1, selected_lines)
+# 68% intervals from 1000 noise realizations at the S/N estimated from the spectrum
+uncertainty = monte_carlo_equivalent_widths(wavelength_1, flux_1, selected_lines, seed=0)
+lower, upper = uncertainty.interval()
+print(f"Estimated S/N of {unknown_star_1}: {uncertainty.snr[0]:.0f}")
+for line_wavelength, ew, low, high in zip(selected_lines, ews, lower[0], upper[0]):
+    print(f"Equivalent Width of {absorption_lines[line_wavelength]} at {line_wavelength:.2f} Å: "
+          f"{ew:.2f} -{ew - low:.3f}/+{high - ew:.3f} Å")
+
+# With $SPECTRUM_RESULTS_STORE set, keep the measurements in that results store, as one run
+# per execution of this script; the star is unclassified, so its classification columns stay empty
+if os.environ.get("SPECTRUM_RESULTS_STORE"):
+    type_letter, subclass = spectral_type_columns([''] * len(selected_lines))
+    ResultsStore().append('measurements', pd.DataFrame({
+        'star': unknown_star_1, 'line': [absorption_lines[c] for c in selected_lines], 'rest_center': selected_lines,
+        'ew': ews, 'spectral_type': '', 'type_letter': type_letter, 'subclass': subclass, 'luminosity_class': '',
+        'ew_lower': lower[0], 'ew_upper': upper[0], 'snr': uncertainty.snr[0]}),
+        run=time.strftime("overlay_%Y%m%d_%H%M%S"))
+
+print(default_cache().report())
 plt.show()
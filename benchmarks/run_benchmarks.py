@@ -0,0 +1,201 @@
+import os, sys, glob, json, time, shutil, platform, argparse, tempfile, subprocess
+import numpy as np
+
+### Benchmark suite ###
+# Times loading, normalization, line measurement, classification and plotting on the
+# real spectra (ExampleStars/, TestStars/, ProblemStar*.dat) and on synthetic libraries
+# scaled to 10x and 100x that set. Results go to a JSON file per run, which can be
+# compared with an earlier run on the same machine:
+#   python benchmarks/run_benchmarks.py                       -> benchmarks/results/<commit>.json
+#   python benchmarks/run_benchmarks.py --compare old.json new.json
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from spectrum_io import load_spectrum, clear_cache
+from spectral_library import SpectralLibrary
+from normalization import normalize_spectrum_smooth, normalize_spectrum, NORMALIZATION_METHODS
+from equivalent_width import calculate_equivalent_width, batch_equivalent_widths
+from classify import TemplateClassifier
+from line_catalog import load_catalog
+from render import render_stacked
+
+RESULTS_DIR = os.path.join(REPO_DIR, "benchmarks", "results")
+
+def real_files():
+    """
+    All real spectra of the repository, in a fixed order.
+    """
+    return (sorted(glob.glob(os.path.join(REPO_DIR, "ExampleStars", "*.dat")))
+            + sorted(glob.glob(os.path.join(REPO_DIR, "TestStars", "*.dat")))
+            + sorted(glob.glob(os.path.join(REPO_DIR, "ProblemStar*.dat"))))
+
+def scaled_flux(flux, scale, seed=0):
+    """
+    Synthetic library of scale x the real spectra: copies with 1% multiplicative noise.
+    """
+    rng = np.random.default_rng(seed)
+    stacked = np.tile(flux, (scale, 1))
+    return stacked * (1 + 0.01 * rng.standard_normal(stacked.shape))
+
+def time_call(function, repeat=5, number=1):
+    """
+    Run function() `repeat` times (each `number` calls) and return per-call timings in seconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - start) / number)
+    return timings
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def load_cases(files, scale, work_dir):
+    # Text files for the scaled sets are byte copies of the real ones, so each is a separate cache entry
+    copies = []
+    for i in range(scale):
+        for file_path in files:
+            copy = os.path.join(work_dir, f"s{scale}_{i}_{os.path.basename(file_path)}")
+            shutil.copyfile(file_path, copy)
+            copies.append(copy)
+
+    def load_text():
+        for file_path in copies:
+            np.loadtxt(file_path)
+
+    def load_cache_build():
+        clear_cache(copies)
+        for file_path in copies:
+            load_spectrum(file_path)
+
+    def load_cached():
+        for file_path in copies:
+            load_spectrum(file_path)[1].sum()
+
+    return [('load/np.loadtxt', load_text), ('load/cache_build', load_cache_build), ('load/cached_memmap', load_cached)]
+
+def compute_cases(wavelength, flux, classifier, lines):
+    cases = [
+        ('normalize/normalize_spectrum_smooth_loop', lambda: [normalize_spectrum_smooth(wavelength, f) for f in flux]),
+    ]
+    for method in NORMALIZATION_METHODS:
+        cases.append((f'normalize/batch_{method}', lambda method=method: normalize_spectrum(wavelength, flux, method)))
+
+    norm_flux = normalize_spectrum_smooth(wavelength, flux)
+    cases += [
+        ('measure/calculate_equivalent_width_loop',
+         lambda: [[calculate_equivalent_width(wavelength, f, c) for c in lines] for f in norm_flux]),
+        ('measure/batch_equivalent_widths', lambda: batch_equivalent_widths(wavelength, norm_flux, lines)),
+        ('classify/template_chi2', lambda: classifier.scores(flux, 'chi2')),
+        ('classify/template_correlation', lambda: classifier.scores(flux, 'correlation')),
+    ]
+    return cases
+
+def _run_cases(work_dir, scales, max_load_scale, repeat, skip):
+    files = real_files()
+    library = SpectralLibrary.from_files(files)
+    classifier = TemplateClassifier()
+    lines = load_catalog().center
+    labels = library.labels()
+
+    results = []
+    def record(name, scale, n_spectra, function, case_repeat):
+        if any(name.startswith(prefix) for prefix in skip):
+            return
+        timings = time_call(function, case_repeat)
+        results.append({
+            'name': name, 'scale': scale, 'n_spectra': n_spectra,
+            'n_pixels': n_spectra * library.wavelength.size,
+            'min': min(timings), 'median': float(np.median(timings)), 'mean': float(np.mean(timings)),
+            'repeat': case_repeat
+        })
+        print(f"{name:<45} x{scale:<4} {n_spectra:>6} spectra  median {results[-1]['median'] * 1e3:10.2f} ms", flush=True)
+
+    for scale in scales:
+        flux = library.flux if scale == 1 else scaled_flux(library.flux, scale)
+        n_spectra = flux.shape[0]
+        # Fewer repeats for the slow large-scale cases
+        case_repeat = repeat if scale < 100 else 1
+
+        if scale <= max_load_scale:
+            for name, function in load_cases(files, scale, work_dir):
+                record(name, scale, n_spectra, function, case_repeat)
+        for name, function in compute_cases(library.wavelength, flux, classifier, lines):
+            record(name, scale, n_spectra, function, case_repeat)
+
+        # One stacked figure per real-library-sized group of spectra
+        output_path = os.path.join(work_dir, f"stacked_{scale}.png")
+        def plot(flux=flux):
+            for start in range(0, n_spectra, len(files)):
+                render_stacked(library.wavelength, flux[start:start + len(files)], labels, output_path)
+        record('plot/render_stacked', scale, n_spectra, plot, 1)
+    return results
+
+def run_benchmarks(scales=(1, 10, 100), max_load_scale=10, repeat=3, skip=()):
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Every spectrum cache of the run, those of the real files included, goes to the work
+        # directory, so the run neither reads nor leaves caches next to the data
+        previous_cache_dir = os.environ.get('SPECTRUM_CACHE_DIR')
+        os.environ['SPECTRUM_CACHE_DIR'] = os.path.join(work_dir, 'cache')
+        try:
+            results = _run_cases(work_dir, scales, max_load_scale, repeat, skip)
+        finally:
+            if previous_cache_dir is None:
+                del os.environ['SPECTRUM_CACHE_DIR']
+            else:
+                os.environ['SPECTRUM_CACHE_DIR'] = previous_cache_dir
+
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(), 'python': platform.python_version(),
+                    'numpy': np.__version__, 'cpu_count': os.cpu_count()},
+        'results': results
+    }
+
+def compare(old_path, new_path):
+    """
+    Print the median time ratio new/old of every benchmark present in both files.
+    """
+    with open(old_path) as f:
+        old = {(r['name'], r['scale']): r for r in json.load(f)['results']}
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    print(f"{'benchmark':<45} {'scale':>5} {'old [ms]':>10} {'new [ms]':>10} {'new/old':>8}")
+    for r in new:
+        key = (r['name'], r['scale'])
+        if key in old:
+            ratio = r['median'] / old[key]['median']
+            flag = '  slower' if ratio > 1.1 else ('  faster' if ratio < 0.9 else '')
+            print(f"{r['name']:<45} {r['scale']:>5} {old[key]['median'] * 1e3:10.2f} {r['median'] * 1e3:10.2f} {ratio:8.2f}{flag}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark loading, normalization, measurement, classification and plotting.")
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100], help="Library sizes relative to the real set")
+    parser.add_argument('--max-load-scale', type=int, default=10, help="Largest scale for the text-loading cases")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip', nargs='*', default=[], help="Benchmark name prefixes to skip, e.g. plot/")
+    parser.add_argument('-o', '--output', default=None, help="Result file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="Compare two result files and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run_benchmarks(args.scales, args.max_load_scale, args.repeat, args.skip)
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
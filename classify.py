@@ -0,0 +1,165 @@
+import os, sys, glob
+import numpy as np
+from spectral_library import SpectralLibrary
+from normalization import normalize_spectrum
+from ew_uncertainty import estimate_noise
+from profiling import profiled
+
+### Template-matching spectral classification ###
+# Unknown spectra are put on the template grid, normalized the same way as the
+# templates and compared with every template at once through one matrix product.
+# The chi^2 score divides the mean squared difference by the pixel noise of the
+# normalized unknown, estimated from its own flux (DER_SNR); the templates are treated
+# as noiseless, so the noise only scales the scores of each unknown, not its ranking.
+
+# Noise estimates are raised to this floor (S/N 10^4), so that noiseless synthetic
+# spectra get finite scores
+MIN_NOISE = 1e-4
+
+def _standardize(flux):
+    # Zero mean, unit norm rows, so that a dot product is the Pearson correlation
+    centered = flux - flux.mean(axis=1, keepdims=True)
+    return centered / np.linalg.norm(centered, axis=1, keepdims=True)
+
+class ClassificationResult:
+    """
+    Scores of a batch of unknown spectra against all templates.
+
+    Attributes:
+    names: list of str
+        Names of the unknown spectra.
+    scores: ndarray, shape (n_unknown, n_templates)
+        Reduced chi^2 (lower is better) or correlation (higher is better).
+    ranking: ndarray of int, shape (n_unknown, n_templates)
+        Template indices sorted from best to worst match.
+    """
+
+    def __init__(self, names, scores, method, templates):
+        self.names = list(names)
+        self.scores = scores
+        self.method = method
+        self.templates = templates
+        order = scores if method == 'chi2' else -scores
+        self.ranking = np.argsort(order, axis=1, kind='stable')
+
+    def top(self, i, k=3):
+        """
+        Best k matches of unknown number i, as a list of dicts.
+        """
+        matches = []
+        for j in self.ranking[i, :k]:
+            matches.append({
+                'template': str(self.templates.hd[j]),
+                'spectral_type': str(self.templates.spectral_type[j]),
+                'luminosity_class': str(self.templates.luminosity_class[j]),
+                'score': float(self.scores[i, j])
+            })
+        return matches
+
+    def best(self):
+        """
+        Best matching (spectral type, luminosity class, score) for every unknown.
+        """
+        j = self.ranking[:, 0]
+        rows = np.arange(len(self.names))
+        return list(zip(self.templates.spectral_type[j].tolist(),
+                        self.templates.luminosity_class[j].tolist(),
+                        self.scores[rows, j].tolist()))
+
+class TemplateClassifier:
+    """
+    Classify spectra by comparison with a library of spectra of known type.
+
+    Parameters:
+    templates: SpectralLibrary or None
+        Template library; defaults to the ExampleStars/ directory.
+    wavelength_range: tuple or None
+        (wmin, wmax) range used for the comparison; defaults to the whole grid.
+    normalization: str
+        Continuum normalization method (see normalization.fit_continuum), applied
+        to templates and unknowns alike. Extra keyword arguments are passed on to it.
+    """
+
+    def __init__(self, templates=None, wavelength_range=None, normalization='savgol', **normalization_kwargs):
+        if templates is None:
+            templates = SpectralLibrary.from_directory()
+        self.templates = templates
+        self.normalization = normalization
+        self.normalization_kwargs = normalization_kwargs
+
+        wmin, wmax = wavelength_range if wavelength_range is not None else (-np.inf, np.inf)
+        self.pixels = (templates.wavelength >= wmin) & (templates.wavelength <= wmax)
+
+        # Everything that only depends on the templates is computed once here
+        self.template_flux = self.normalize(templates.flux)
+        self.template_norm2 = np.einsum('ij,ij->i', self.template_flux, self.template_flux)
+        self.template_standardized = _standardize(self.template_flux)
+
+    def normalize(self, flux):
+        norm_flux = normalize_spectrum(self.templates.wavelength, np.atleast_2d(flux), self.normalization, **self.normalization_kwargs)
+        return np.ascontiguousarray(norm_flux[:, self.pixels])
+
+    @profiled('classify', pixels=lambda result, self, flux, *args, **kwargs: np.size(flux))
+    def scores(self, flux, method='chi2'):
+        """
+        Compare a stack of spectra on the template grid with all templates.
+
+        Parameters:
+        flux: array-like, shape (n_unknown, n_pixels)
+            Unnormalized spectra sampled on self.templates.wavelength.
+        method: str
+            'chi2' for the reduced chi^2 of the normalized spectra, with the noise of the
+            unknown estimated by DER_SNR (lower is better), 'correlation' for the Pearson
+            correlation (higher is better).
+
+        Returns:
+        scores: ndarray, shape (n_unknown, n_templates)
+        """
+        norm_flux = self.normalize(flux)
+        if method == 'chi2':
+            # |u - t|^2 = |u|^2 + |t|^2 - 2 u.t for all pairs in one matrix product
+            norm2 = np.einsum('ij,ij->i', norm_flux, norm_flux)
+            chi2 = norm2[:, None] + self.template_norm2[None, :] - 2 * norm_flux @ self.template_flux.T
+            noise = np.maximum(estimate_noise(norm_flux)[0], MIN_NOISE)
+            return np.maximum(chi2, 0) / (norm_flux.shape[1] * noise[:, None]**2)
+        if method == 'correlation':
+            return _standardize(norm_flux) @ self.template_standardized.T
+        raise ValueError(f"Unknown method '{method}', use 'chi2' or 'correlation'")
+
+    def classify(self, unknowns, method='chi2'):
+        """
+        Classify a batch of spectra.
+
+        Parameters:
+        unknowns: SpectralLibrary or list of str
+            Spectra to classify, or the paths of the spectrum files.
+        method: str
+            'chi2' or 'correlation', see scores.
+
+        Returns:
+        result: ClassificationResult
+        """
+        if not isinstance(unknowns, SpectralLibrary):
+            unknowns = SpectralLibrary.from_files(unknowns, wavelength=self.templates.wavelength)
+        elif not np.array_equal(unknowns.wavelength, self.templates.wavelength):
+            raise ValueError("Unknown spectra must be on the template wavelength grid")
+        names = [os.path.basename(p) for p in unknowns.paths]
+        return ClassificationResult(names, self.scores(unknowns.flux, method), method, self.templates)
+
+    def classify_directory(self, directory, pattern="*.dat", method='chi2'):
+        """
+        Classify every spectrum in a directory in one batch.
+        """
+        return self.classify(sorted(glob.glob(os.path.join(directory, pattern))), method)
+
+# Classify the problem and test stars against the example library
+if __name__ == "__main__":
+    method = sys.argv[1] if len(sys.argv) > 1 else 'chi2'
+    here = os.path.dirname(os.path.abspath(__file__))
+    unknown_files = sorted(glob.glob(os.path.join(here, "ProblemStar*.dat")) + glob.glob(os.path.join(here, "TestStars", "*.dat")))
+
+    classifier = TemplateClassifier()
+    result = classifier.classify(unknown_files, method)
+    for i, name in enumerate(result.names):
+        matches = ", ".join(f"{m['spectral_type']}{m['luminosity_class']} ({m['score']:.4g})" for m in result.top(i))
+        print(f"{name}: {matches}")
@@ -0,0 +1,139 @@
+import numpy as np
+try:
+    from scipy.integrate import simpson
+except ImportError:  # scipy < 1.6
+    from scipy.integrate import simps as simpson
+from profiling import profiled
+
+### Equivalent widths ###
+
+@profiled('measure_single')
+def calculate_equivalent_width(wavelength, flux, line_center, width=5):
+    """
+    Calculate the equivalent width of an absorption line.
+
+    Parameters:
+    wavelength: array-like
+        Array of wavelength values.
+    flux: array-like
+        Array of flux values.
+    line_center: float
+        Central wavelength of the absorption line.
+    width: float
+        Range around the line center to consider for integration, in Angstroms.
+
+    Returns:
+    equivalent_width: float
+        The equivalent width of the absorption line.
+    """
+    # Define the integration range around the line center
+    min_range = line_center - width
+    max_range = line_center + width
+
+    # Select the wavelength and flux in the range of interest
+    mask = (wavelength >= min_range) & (wavelength <= max_range)
+    selected_wavelength = wavelength[mask]
+    selected_flux = flux[mask]
+
+    continuum_flux = np.mean(selected_flux[:5])
+
+    # Calculate the equivalent width using Simpson's rule for integration
+    ew = simpson(1 - (selected_flux / continuum_flux), x=selected_wavelength)
+
+    return ew
+
+def line_windows(wavelength, line_centers, width=5):
+    """
+    Pixel index ranges [start, stop) of the integration windows around each line.
+
+    The windows are found with a binary search on the (sorted) wavelength grid, and
+    contain the same pixels as the mask used in calculate_equivalent_width.
+
+    Parameters:
+    wavelength: array-like
+        Sorted wavelength grid.
+    line_centers: array-like
+        Central wavelengths of the lines.
+    width: float or array-like
+        Half width of the windows in Angstroms (one value or one per line).
+
+    Returns:
+    start, stop: ndarray of int
+        Window bounds for each line.
+    """
+    line_centers = np.asarray(line_centers, dtype=np.float64)
+    start = np.searchsorted(wavelength, line_centers - width, side='left')
+    stop = np.searchsorted(wavelength, line_centers + width, side='right')
+    return start, stop
+
+@profiled('measure', pixels=lambda result, wavelength, flux, *args, **kwargs: np.size(flux))
+def batch_equivalent_widths(wavelength, flux, line_centers, width=5, n_continuum=5):
+    """
+    Equivalent widths of many lines in many spectra at once.
+
+    Gives the same result as calling calculate_equivalent_width for every
+    (star, line) pair, but the lines are grouped by window length and each group
+    is gathered and integrated as one (n_stars, n_lines, n_window) array.
+
+    Parameters:
+    wavelength: array-like, shape (n_pixels,)
+        Shared, sorted wavelength grid.
+    flux: array-like, shape (n_stars, n_pixels) or (n_pixels,)
+        Stack of (normalized) spectra.
+    line_centers: array-like, shape (n_lines,)
+        Central wavelengths of the lines.
+    width: float or array-like
+        Half width of the integration windows in Angstroms.
+    n_continuum: int
+        Number of pixels at the blue edge of each window averaged for the continuum.
+
+    Returns:
+    ew: ndarray, shape (n_stars, n_lines) (or (n_lines,) for a single spectrum)
+        Equivalent widths in Angstroms. Lines whose window falls outside the grid are nan.
+    """
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    flux = np.asarray(flux, dtype=np.float64)
+    single = flux.ndim == 1
+    flux = np.atleast_2d(flux)
+
+    start, stop = line_windows(wavelength, line_centers, width)
+    n_window = stop - start
+    ew = np.full((flux.shape[0], start.size), np.nan)
+
+    # Lines with equally long windows share one gather + one vectorized integration
+    for length in np.unique(n_window):
+        if length < 2:
+            continue
+        lines = np.flatnonzero(n_window == length)
+        index = start[lines, None] + np.arange(length)          # (n_lines, length)
+        window_wavelength = wavelength[index]                   # (n_lines, length)
+        window_flux = flux[:, index]                            # (n_stars, n_lines, length)
+
+        continuum_flux = window_flux[..., :n_continuum].mean(axis=-1, keepdims=True)
+        depth = 1 - window_flux / continuum_flux
+        ew[:, lines] = simpson(depth, x=np.broadcast_to(window_wavelength, depth.shape), axis=-1)
+
+    return ew[0] if single else ew
+
+# Compare the batch engine with the per-line loop on the example library
+if __name__ == "__main__":
+    import time
+    from spectral_library import SpectralLibrary
+
+    line_centers = np.array([3932, 3967, 4030, 4102, 4340, 4383, 4471, 4540, 4684, 4860, 4921,
+                             5014, 5411, 5875, 5890, 5896, 6270, 6284, 6347, 6380, 6560, 6614, 6684])
+    library = SpectralLibrary.from_directory()
+
+    start = time.perf_counter()
+    loop_ew = np.array([[calculate_equivalent_width(library.wavelength, flux, center) for center in line_centers]
+                        for flux in library.flux])
+    t_loop = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch_ew = batch_equivalent_widths(library.wavelength, library.flux, line_centers)
+    t_batch = time.perf_counter() - start
+
+    print(f"{len(library)} stars x {line_centers.size} lines")
+    print(f"Per-line loop: {t_loop * 1e3:8.2f} ms")
+    print(f"Batch engine:  {t_batch * 1e3:8.2f} ms  ({t_loop / t_batch:.1f}x faster)")
+    print(f"Max |difference|: {np.nanmax(np.abs(loop_ew - batch_ew)):.2e} A")
@@ -0,0 +1,197 @@
+import os, sys
+import numpy as np
+from normalization import normalize_spectrum_smooth, normalize_spectrum
+from equivalent_width import batch_equivalent_widths, line_windows
+from profiling import profiled
+
+### Monte Carlo equivalent width uncertainties ###
+# The noise level of every spectrum is estimated from the data (DER_SNR, Stoehr et al.
+# 2008: the median absolute second difference of pixels two apart, which the smooth
+# continuum and resolved lines hardly contribute to). Noise realizations are then drawn
+# as one (n_realizations, n_stars, n_pixels) array per block, normalized and measured
+# with the same vectorized code as the data, and the spread of the resulting EWs gives
+# their uncertainty. This includes the continuum placement, in particular the 5-pixel
+# continuum at the blue edge of every EW window, which dominates for noisy spectra.
+# DER_SNR also counts unresolved line structure as noise, so the intervals of densely
+# lined cool spectra are on the conservative side.
+#
+# The 'savgol' and 'quantile' continua at a pixel only depend on the pixels within their
+# filter windows, so only the EW windows plus that margin are simulated: the cropped
+# segments give the same EWs at a fraction of the cost. The 'iterative' continuum uses a
+# per-spectrum clipping scale and is run on the full spectra.
+#
+# The observed spectrum already contains one noise realization, so the realizations
+# carry sqrt(2) times the noise around the truth; the EW spread is the usual
+# bootstrap-style estimate and is not corrected for this.
+
+DEFAULT_BLOCK_BYTES = 256 * 1024 * 1024
+
+def estimate_noise(flux):
+    """
+    Per-spectrum noise and signal-to-noise ratio estimated from the flux (DER_SNR).
+
+    Parameters:
+    flux: array-like, shape (n_stars, n_pixels) or (n_pixels,)
+
+    Returns:
+    noise: ndarray, shape (n_stars,) (or float for a single spectrum)
+        Standard deviation of the pixel noise, in flux units.
+    snr: ndarray, shape (n_stars,) (or float)
+        Median flux over noise.
+    """
+    flux = np.asarray(flux, dtype=np.float64)
+    single = flux.ndim == 1
+    flux = np.atleast_2d(flux)
+    second_difference = np.abs(2 * flux[:, 2:-2] - flux[:, :-4] - flux[:, 4:])
+    noise = 1.482602 / np.sqrt(6) * np.nanmedian(second_difference, axis=1)
+    snr = np.nanmedian(flux, axis=1) / noise
+    return (noise[0], snr[0]) if single else (noise, snr)
+
+class EWDistribution:
+    """
+    Monte Carlo distribution of equivalent widths.
+
+    Attributes:
+    nominal: ndarray, shape (n_stars, n_lines)
+        EWs of the spectra as observed.
+    samples: ndarray, shape (n_realizations, n_stars, n_lines)
+        EWs of the noise realizations.
+    noise, snr: ndarray, shape (n_stars,)
+        Noise level used for each star and the corresponding S/N.
+    line_centers: ndarray, shape (n_lines,)
+    """
+
+    def __init__(self, nominal, samples, noise, snr, line_centers):
+        self.nominal = nominal
+        self.samples = samples
+        self.noise = noise
+        self.snr = snr
+        self.line_centers = line_centers
+
+    def __len__(self):
+        return self.samples.shape[0]
+
+    def std(self):
+        """
+        Standard deviation of the EWs over the realizations, shape (n_stars, n_lines).
+        """
+        return np.nanstd(self.samples, axis=0)
+
+    def interval(self, level=0.683):
+        """
+        Central confidence interval of the EWs.
+
+        Parameters:
+        level: float
+            Probability content (0.683 = 1 sigma, 0.954 = 2 sigma).
+
+        Returns:
+        lower, upper: ndarray, shape (n_stars, n_lines)
+        """
+        tail = 100 * (1 - level) / 2
+        lower, upper = np.nanpercentile(self.samples, [tail, 100 - tail], axis=0)
+        return lower, upper
+
+def _support(wavelength, line_centers, width, method, normalization_kwargs):
+    # Pixels needed to normalize and measure the EW windows exactly, or None for all of them
+    if method == 'savgol':
+        margin = normalization_kwargs.get('window_length', 101)
+    elif method == 'quantile':
+        margin = normalization_kwargs.get('window_length', 201) + normalization_kwargs.get('smooth_length', 101)
+    else:
+        return None
+    start, stop = line_windows(wavelength, line_centers, width)
+    edges = np.zeros(wavelength.size + 1, dtype=np.int64)
+    np.add.at(edges, np.clip(start - margin, 0, wavelength.size), 1)
+    np.add.at(edges, np.clip(stop + margin, 0, wavelength.size), -1)
+    return np.flatnonzero(np.cumsum(edges[:-1]) > 0)
+
+def _normalize(wavelength, flux, method, normalization_kwargs):
+    if method == 'savgol':
+        return normalize_spectrum_smooth(wavelength, flux, **normalization_kwargs)
+    return normalize_spectrum(wavelength, flux, method, **normalization_kwargs)
+
+@profiled('ew_uncertainty', pixels=lambda result, wavelength, flux, *args, **kw: len(result) * np.size(flux))
+def monte_carlo_equivalent_widths(wavelength, flux, line_centers, width=5, n_realizations=1000, noise=None,
+                                  method='savgol', normalization_kwargs=None, max_block_bytes=DEFAULT_BLOCK_BYTES,
+                                  seed=None):
+    """
+    Equivalent widths and their Monte Carlo distribution for a stack of spectra.
+
+    Parameters:
+    wavelength: array-like, shape (n_pixels,)
+        Shared, sorted wavelength grid.
+    flux: array-like, shape (n_stars, n_pixels) or (n_pixels,)
+        Unnormalized spectra.
+    line_centers: array-like, shape (n_lines,)
+    width: float or array-like
+        Half width of the EW windows in Angstroms, see batch_equivalent_widths.
+    n_realizations: int
+        Number of noise realizations.
+    noise: float, array-like or None
+        Pixel noise per star in flux units (default: estimate_noise).
+    method: str
+        'savgol' (normalize_spectrum_smooth) or a normalize_spectrum method;
+        normalization_kwargs are passed on (e.g. window_length, polyorder).
+    max_block_bytes: int
+        Approximate memory limit of one block of realizations.
+    seed: int or None
+        Seed of the random generator, for reproducible intervals.
+
+    Returns:
+    result: EWDistribution
+    """
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    flux = np.atleast_2d(np.asarray(flux, dtype=np.float64))
+    line_centers = np.atleast_1d(np.asarray(line_centers, dtype=np.float64))
+    normalization_kwargs = normalization_kwargs or {}
+    n_stars, n_pixels = flux.shape
+
+    estimated_noise, _ = estimate_noise(flux)
+    noise = estimated_noise if noise is None else np.broadcast_to(np.asarray(noise, dtype=np.float64), (n_stars,))
+    snr = np.nanmedian(flux, axis=1) / noise
+    nominal = batch_equivalent_widths(wavelength, _normalize(wavelength, flux, method, normalization_kwargs),
+                                      line_centers, width)
+    support = _support(wavelength, line_centers, width, method, normalization_kwargs)
+    if support is not None:
+        wavelength, flux = wavelength[support], flux[:, support]
+        n_pixels = support.size
+
+    # A block holds the realizations plus a few same-sized temporaries of the normalization
+    block_size = int(np.clip(max_block_bytes // (4 * 8 * n_stars * n_pixels), 1, n_realizations))
+    rng = np.random.default_rng(seed)
+    samples = np.empty((n_realizations, n_stars, line_centers.size))
+    for start in range(0, n_realizations, block_size):
+        n_block = min(block_size, n_realizations - start)
+        realizations = rng.standard_normal((n_block, n_stars, n_pixels))
+        realizations *= noise[None, :, None]
+        realizations += flux[None]
+        # Realizations and stars are flattened into one stack for the 2D normalization and EW code
+        stack = realizations.reshape(n_block * n_stars, n_pixels)
+        ew = batch_equivalent_widths(wavelength, _normalize(wavelength, stack, method, normalization_kwargs),
+                                     line_centers, width)
+        samples[start:start + n_block] = ew.reshape(n_block, n_stars, line_centers.size)
+
+    return EWDistribution(nominal, samples, noise, snr, line_centers)
+
+# EW uncertainties of the example library
+if __name__ == "__main__":
+    import time
+    from spectral_library import SpectralLibrary
+    from line_catalog import load_catalog
+
+    library = SpectralLibrary.from_directory()
+    line_index, _ = load_catalog().nearest([4102, 4340, 4471, 4861, 5890, 6563])
+    lines = load_catalog()[line_index]
+    n_realizations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    start = time.perf_counter()
+    result = monte_carlo_equivalent_widths(library.wavelength, library.flux, lines.center, n_realizations=n_realizations, seed=1)
+    elapsed = time.perf_counter() - start
+    print(f"{len(result)} realizations x {len(library)} stars x {len(lines)} lines in {elapsed:.2f} s")
+
+    lower, upper = result.interval()
+    print(f"{'star':<28}{'S/N':>7}  " + "".join(f"{label:>20}" for label in lines.label))
+    for i, path in enumerate(library.paths):
+        cells = "".join(f"{result.nominal[i, j]:>8.2f} [{lower[i, j]:5.2f},{upper[i, j]:5.2f}]" for j in range(len(lines)))
+        print(f"{os.path.basename(path)[:27]:<28}{result.snr[i]:>7.0f}  {cells}")
@@ -0,0 +1,397 @@
+import os, io, sys, glob, gzip, time, fnmatch, warnings, argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+try:
+    from astropy.io import fits
+except ImportError:  # FITS input is optional
+    fits = None
+
+### Spectrum ingestion ###
+# Discovers spectrum files, sniffs the format of each from its first few kilobytes
+# (tab, comma, semicolon or whitespace separated text, with or without header or comment
+# lines, optionally gzipped; 1D FITS images or tables if astropy is installed), reads
+# the files concurrently on a thread pool, which overlaps the file I/O (and the latency
+# of network file systems) with parsing, validates them and returns one
+# SpectrumCollection. Files that cannot be read are
+# reported in collection.rejected instead of stopping the whole ingestion.
+
+SPECTRUM_EXTENSIONS = ('.dat', '.txt', '.csv', '.tsv', '.norm', '.asc', '.fits', '.fit', '.fts', '.gz')
+COMMENT_CHARS = ('#', '%', ';', '!', '\\', '|')
+SNIFF_BYTES = 8192
+
+def discover(inputs, extensions=SPECTRUM_EXTENSIONS, recursive=False, pattern=None):
+    """
+    Expand directories, glob patterns and file names into a sorted list of files.
+
+    Directories contribute the files with one of the given extensions, or the files
+    matching pattern (e.g. "*.dat") if one is given, searched in subdirectories too if
+    recursive; glob patterns and file names are taken as given.
+    """
+    def wanted(name):
+        return fnmatch.fnmatch(name, pattern) if pattern else name.lower().endswith(extensions)
+
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            walk = os.walk(item) if recursive else [(item, [], os.listdir(item))]
+            for directory, _, names in walk:
+                files.extend(os.path.join(directory, name) for name in names
+                             if wanted(name) and os.path.isfile(os.path.join(directory, name)))
+        else:
+            matches = glob.glob(item, recursive=recursive)
+            if not matches:
+                print(f"Warning: no files match {item}", file=sys.stderr)
+            files.extend(matches)
+    return sorted(set(os.path.abspath(f) for f in files))
+
+def _is_number(text):
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+def _split(line, delimiter):
+    return [field.strip() for field in line.split(delimiter)] if delimiter else line.split()
+
+def sniff_format(file_path):
+    """
+    Detect the format of a spectrum file from its first bytes.
+
+    Returns:
+    format: dict
+        'kind' ('text' or 'fits') and, for text, 'delimiter' (None for whitespace),
+        'header_rows' (lines before the data), 'columns' (indices of the wavelength and
+        flux columns), 'comments' (comment characters seen in the first bytes) and
+        'compression' ('gzip' or None).
+    """
+    with open(file_path, 'rb') as f:
+        head = f.read(SNIFF_BYTES)
+    compression = None
+    if head.startswith(b'\x1f\x8b'):
+        compression = 'gzip'
+        with gzip.open(file_path, 'rb') as f:
+            head = f.read(SNIFF_BYTES)
+    if head.startswith(b'SIMPLE  ='):
+        if compression:
+            raise ValueError("gzipped FITS is not supported")
+        return {'kind': 'fits'}
+    if b'\x00' in head or head.startswith(b'%PDF'):
+        raise ValueError("binary file of unknown format")
+
+    # The last line may be cut off by the sniff window
+    lines = head.decode('latin-1').splitlines()[:-1] or head.decode('latin-1').splitlines()
+    header_rows = 0
+    for line in lines:
+        stripped = line.strip()
+        if stripped and not stripped.startswith(COMMENT_CHARS):
+            fields = _split(stripped, next((d for d in '\t,;' if d in stripped), None))
+            if len(fields) >= 2 and _is_number(fields[0]) and _is_number(fields[1]):
+                break
+        header_rows += 1
+    else:
+        raise ValueError("no numeric two-column data found")
+
+    data_line = lines[header_rows].strip()
+    delimiter = next((d for d in '\t,;' if d in data_line), None)
+    n_fields = len(_split(data_line, delimiter))
+
+    # Column names in the last header line select the wavelength and flux columns
+    columns = (0, 1)
+    if header_rows:
+        names = [name.lower() for name in _split(lines[header_rows - 1].strip().lstrip(''.join(COMMENT_CHARS)), delimiter)]
+        if len(names) == n_fields:
+            wave = [i for i, name in enumerate(names) if name.startswith(('wave', 'lambda', 'lam', 'wl'))]
+            flux = [i for i, name in enumerate(names) if name.startswith(('flux', 'f_lambda', 'norm'))]
+            if wave and flux:
+                columns = (wave[0], flux[0])
+    text = '\n'.join(lines)
+    comments = [c for c in COMMENT_CHARS if c != delimiter and c in text]
+    return {'kind': 'text', 'delimiter': delimiter, 'header_rows': header_rows, 'columns': columns,
+            'comments': comments, 'compression': compression}
+
+def read_text(file_path, format):
+    """
+    Parse a text spectrum in the sniffed format.
+    """
+    opener = gzip.open if format['compression'] == 'gzip' else open
+    with opener(file_path, 'rt', encoding='latin-1') as f:
+        text = f.read()
+    # Only the comment characters present in the file are passed: np.loadtxt stays on its
+    # fast path for a single one
+    comments = [c for c in COMMENT_CHARS if c != format['delimiter'] and c in text] or None
+    wavelength, flux = np.loadtxt(io.StringIO(text), delimiter=format['delimiter'], skiprows=format['header_rows'],
+                                  usecols=format['columns'], comments=comments, unpack=True,
+                                  dtype=np.float64, ndmin=2)
+    return wavelength, flux
+
+def iter_text(file_path, format, chunk_rows=1_000_000):
+    """
+    Parse a text spectrum in the sniffed format in blocks of rows, so memory use does not
+    grow with the file length. The file is not read ahead, so only the comment characters
+    seen by sniff_format (or '#') are recognized.
+
+    Yields:
+    wavelength, flux: ndarray
+        The next k <= chunk_rows rows.
+    """
+    opener = gzip.open if format['compression'] == 'gzip' else open
+    options = {'delimiter': format['delimiter'], 'usecols': format['columns'], 'comments': format['comments'] or '#',
+               'unpack': True, 'dtype': np.float64, 'ndmin': 2, 'max_rows': chunk_rows}
+    with opener(file_path, 'rt', encoding='latin-1') as f:
+        for _ in range(format['header_rows']):
+            f.readline()
+        while True:
+            # np.loadtxt continues where the previous block stopped; it warns about the empty last block
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', UserWarning)
+                data = np.loadtxt(f, **options)
+            if data.size:
+                yield data[0], data[1]
+            if data.size < 2 * chunk_rows:
+                return
+
+def read_fits(file_path):
+    """
+    Read a 1D FITS spectrum: an image with a linear or log-linear wavelength axis in the
+    header (CRVAL1, CDELT1 or CD1_1, CRPIX1), or a table with wavelength and flux columns.
+    """
+    if fits is None:
+        raise ImportError("reading FITS spectra needs astropy")
+    with fits.open(file_path, memmap=False) as hdus:
+        for hdu in hdus:
+            if isinstance(hdu, fits.BinTableHDU) and hdu.data is not None:
+                names = [name.lower() for name in hdu.columns.names]
+                wave = [n for n in names if n.startswith(('wave', 'lambda', 'lam'))]
+                flux = [n for n in names if n.startswith('flux')]
+                if wave and flux:
+                    return (np.asarray(hdu.data[wave[0]], dtype=np.float64).ravel(),
+                            np.asarray(hdu.data[flux[0]], dtype=np.float64).ravel())
+            elif hdu.data is not None and np.squeeze(hdu.data).ndim == 1:
+                header = hdu.header
+                flux = np.asarray(np.squeeze(hdu.data), dtype=np.float64)
+                step = header.get('CDELT1', header.get('CD1_1'))
+                if 'CRVAL1' not in header or step is None:
+                    raise ValueError("FITS image without a wavelength axis (CRVAL1/CDELT1)")
+                wavelength = header['CRVAL1'] + step * (np.arange(flux.size) + 1 - header.get('CRPIX1', 1))
+                if 'LOG' in str(header.get('CTYPE1', '')).upper() or header.get('DC-FLAG') == 1:
+                    wavelength = 10**wavelength
+                wavelength = wavelength * {'nm': 10.0, 'um': 1e4, 'micron': 1e4}.get(str(header.get('CUNIT1', '')).lower(), 1.0)
+                return wavelength, flux
+    raise ValueError("no 1D spectrum found in the FITS file")
+
+def validate(wavelength, flux, min_pixels=10):
+    """
+    Check a spectrum and repair what can be repaired.
+
+    Rows with a non-finite wavelength are dropped, descending or unsorted wavelength axes
+    are sorted and duplicated wavelengths are reduced to their first row; nan fluxes are
+    kept (see spectrum_io.fill_nan) but counted.
+
+    Returns:
+    wavelength, flux: ndarray
+        The (repaired) spectrum, wavelength strictly increasing.
+    issues: list of str
+        What was found and repaired.
+
+    Raises ValueError for spectra that are unusable (too short, no finite flux).
+    """
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    flux = np.asarray(flux, dtype=np.float64)
+    issues = []
+    finite = np.isfinite(wavelength)
+    if not finite.all():
+        issues.append(f"dropped {np.sum(~finite)} rows with non-finite wavelength")
+        wavelength, flux = wavelength[finite], flux[finite]
+
+    step = np.diff(wavelength)
+    if np.any(step <= 0):
+        if np.all(step < 0):
+            issues.append("wavelength descending, reversed")
+            wavelength, flux = wavelength[::-1], flux[::-1]
+        else:
+            order = np.argsort(wavelength, kind='stable')
+            wavelength, flux = wavelength[order], flux[order]
+            unique = np.concatenate([[True], np.diff(wavelength) > 0])
+            issues.append("wavelength not monotonic, sorted" +
+                          (f" and {np.sum(~unique)} duplicates dropped" if not unique.all() else ""))
+            wavelength, flux = wavelength[unique], flux[unique]
+
+    if wavelength.size < min_pixels:
+        raise ValueError(f"only {wavelength.size} valid pixels")
+    bad_flux = ~np.isfinite(flux)
+    if bad_flux.all():
+        raise ValueError("no finite flux values")
+    if bad_flux.any():
+        issues.append(f"{np.sum(bad_flux)} non-finite flux values")
+    return wavelength, flux, issues
+
+def read_spectrum(file_path, min_pixels=10):
+    """
+    Sniff, read and validate one spectrum file.
+
+    Returns:
+    wavelength, flux: ndarray
+    format: dict
+        See sniff_format.
+    issues: list of str
+        See validate.
+    """
+    format = sniff_format(file_path)
+    if format['kind'] == 'fits':
+        wavelength, flux = read_fits(file_path)
+    else:
+        wavelength, flux = read_text(file_path, format)
+    wavelength, flux, issues = validate(wavelength, flux, min_pixels)
+    return wavelength, flux, format, issues
+
+class SpectrumCollection:
+    """
+    Spectra read by ingest(), each on its own wavelength axis.
+
+    Attributes:
+    paths: list of str
+    wavelengths, fluxes: list of ndarray
+    formats: list of dict
+        Sniffed format of every file.
+    issues: list of list of str
+        Validation findings per file (empty if clean).
+    rejected: list of (str, str)
+        Files that could not be read, with the reason.
+    n_bytes: int
+        Size of all input files.
+    seconds: float
+        Wall time of the ingestion.
+    """
+
+    def __init__(self, paths, wavelengths, fluxes, formats, issues, rejected, n_bytes, seconds):
+        self.paths = paths
+        self.wavelengths = wavelengths
+        self.fluxes = fluxes
+        self.formats = formats
+        self.issues = issues
+        self.rejected = rejected
+        self.n_bytes = n_bytes
+        self.seconds = seconds
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(zip(self.paths, self.wavelengths, self.fluxes))
+
+    def to_library(self, wavelength=None, step=0.15, mode='linear'):
+        """
+        SpectralLibrary of the collection on a shared grid, see SpectralLibrary.from_spectra.
+        """
+        from spectral_library import SpectralLibrary
+        return SpectralLibrary.from_spectra(list(zip(self.wavelengths, self.fluxes)), self.paths, wavelength, step, mode)
+
+    def summary(self):
+        """
+        One row per file: format, pixel count, wavelength range, nan pixels and validation issues.
+        """
+        rows = []
+        for path, wavelength, flux, format, issues in zip(self.paths, self.wavelengths, self.fluxes, self.formats, self.issues):
+            kind = format['kind'] if format['kind'] == 'fits' else \
+                {'\t': 'tab', ',': 'comma', ';': 'semicolon', None: 'whitespace'}[format['delimiter']]
+            rows.append({'file': os.path.basename(path), 'format': kind + (' (gzip)' if format.get('compression') else ''),
+                         'header_rows': format.get('header_rows', 0), 'n_pixels': wavelength.size,
+                         'wavelength_min': wavelength[0], 'wavelength_max': wavelength[-1],
+                         'n_nan': int(np.sum(~np.isfinite(flux))), 'issues': "; ".join(issues)})
+        return pd.DataFrame(rows)
+
+    def report(self):
+        n_files = len(self) + len(self.rejected)
+        n_pixels = sum(w.size for w in self.wavelengths)
+        rate = n_files / self.seconds if self.seconds else float('inf')
+        return (f"Ingested {len(self)} of {n_files} files ({len(self.rejected)} rejected, "
+                f"{sum(1 for i in self.issues if i)} with issues) in {self.seconds:.2f} s: {rate:.0f} files/s, "
+                f"{self.n_bytes / 2**20 / self.seconds:.1f} MB/s, {n_pixels / self.seconds / 1e6:.2f} Mpixel/s")
+
+def ingest(inputs, workers=None, min_pixels=10, extensions=SPECTRUM_EXTENSIONS, recursive=False):
+    """
+    Discover, read and validate spectrum files concurrently.
+
+    Parameters:
+    inputs: str or list of str
+        Directories, glob patterns or file names, see discover.
+    workers: int or None
+        Number of reader threads (default: ThreadPoolExecutor's default); 1 reads in this thread.
+    min_pixels: int
+        Spectra with fewer valid pixels are rejected.
+
+    Returns:
+    collection: SpectrumCollection
+        The readable spectra, in file name order.
+    """
+    files = discover([inputs] if isinstance(inputs, str) else inputs, extensions, recursive)
+    start = time.perf_counter()
+
+    def read(file_path):
+        try:
+            return read_spectrum(file_path, min_pixels), None
+        except (OSError, ValueError, ImportError) as error:
+            return None, f"{type(error).__name__}: {error}"
+
+    if workers == 1:
+        outputs = [read(f) for f in files]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            outputs = list(pool.map(read, files))
+
+    paths, wavelengths, fluxes, formats, issues, rejected = [], [], [], [], [], []
+    for file_path, (result, error) in zip(files, outputs):
+        if result is None:
+            rejected.append((file_path, error))
+            continue
+        paths.append(file_path)
+        for values, value in zip((wavelengths, fluxes, formats, issues), result):
+            values.append(value)
+    n_bytes = sum(os.path.getsize(f) for f in files)
+    return SpectrumCollection(paths, wavelengths, fluxes, formats, issues, rejected, n_bytes, time.perf_counter() - start)
+
+def _write_benchmark_files(directory, n_files):
+    # Copies of the example spectra in a mix of the supported text formats
+    sources = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "ExampleStars", "*.dat")))
+    spectra = [read_spectrum(f)[:2] for f in sources]
+    writers = [
+        ('.dat', lambda f, w, s: np.savetxt(f, np.column_stack([w, s]), fmt='%.6f', delimiter='\t')),
+        ('.s.norm', lambda f, w, s: np.savetxt(f, np.column_stack([w, s]), fmt='%10.4f %12.4e')),
+        ('.csv', lambda f, w, s: np.savetxt(f, np.column_stack([w, s]), fmt='%.6f', delimiter=',',
+                                            header='wavelength,flux', comments='')),
+        ('.txt', lambda f, w, s: np.savetxt(f, np.column_stack([w, s]), fmt='%.6f', header='synthetic copy\nwave flux')),
+    ]
+    for i in range(n_files):
+        wavelength, flux = spectra[i % len(spectra)]
+        extension, write = writers[i % len(writers)]
+        write(os.path.join(directory, f"spectrum_{i:05d}{extension}"), wavelength, flux)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read a directory of mixed-format spectra and report throughput.")
+    parser.add_argument('inputs', nargs='*', help="Directories, glob patterns or files (default: the repository's spectra)")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="Reader threads")
+    parser.add_argument('-r', '--recursive', action='store_true')
+    parser.add_argument('--benchmark', type=int, default=0, metavar='N',
+                        help="Write N mixed-format copies of the example spectra to a temporary directory and ingest them")
+    parser.add_argument('--summary', action='store_true', help="Print the per-file table")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            _write_benchmark_files(directory, args.benchmark)
+            for workers in sorted({1, args.workers or os.cpu_count() + 4}):
+                collection = ingest(directory, workers)
+                print(f"{workers:>3} threads: {collection.report()}")
+    else:
+        here = os.path.dirname(os.path.abspath(__file__))
+        inputs = args.inputs or [os.path.join(here, "ExampleStars"), os.path.join(here, "TestStars"),
+                                 os.path.join(here, "ProblemStar*")]
+        collection = ingest(inputs, args.workers, recursive=args.recursive)
+        if args.summary:
+            print(collection.summary().to_string(index=False))
+        for file_path, reason in collection.rejected:
+            print(f"Rejected {file_path}: {reason}")
+        print(collection.report())
@@ -0,0 +1,138 @@
+import os
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+### Absorption line catalog ###
+# One catalog for all scripts, stored as parallel arrays sorted by wavelength so that
+# range and nearest-line queries are binary searches (O(log n)) and many wavelengths
+# can be looked up at once.
+
+CATALOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "line_catalog.tsv")
+
+class LineCatalog:
+    """
+    Absorption lines sorted by central wavelength.
+
+    Attributes:
+    center: ndarray of float
+        Central (air) wavelengths in Angstroms, ascending.
+    species, ion, label, source: ndarray of str
+        Element (e.g. 'He'), ionization stage ('II'), display label and reference.
+    tentative: ndarray of bool
+        True for unidentified features.
+    """
+
+    FIELDS = ('center', 'species', 'ion', 'label', 'source', 'tentative')
+
+    def __init__(self, center, species, ion, label, source=None, tentative=None):
+        center = np.asarray(center, dtype=np.float64)
+        n_lines = center.size
+        order = np.argsort(center, kind='stable')
+        self.center = center[order]
+        self.species = np.asarray(species, dtype=str)[order]
+        self.ion = np.asarray(ion, dtype=str)[order]
+        self.label = np.asarray(label, dtype=str)[order]
+        self.source = (np.asarray(source, dtype=str) if source is not None else np.full(n_lines, ''))[order]
+        self.tentative = (np.asarray(tentative, dtype=bool) if tentative is not None else np.zeros(n_lines, dtype=bool))[order]
+
+    @classmethod
+    def from_file(cls, file_path=CATALOG_FILE):
+        """
+        Read a tab-separated catalog with the columns center, species, ion, label, source, tentative.
+        Only 'center' is required; missing text columns are left empty.
+        """
+        table = pd.read_csv(file_path, sep='\t', comment='#', dtype=str, keep_default_na=False)
+        if 'center' not in table:
+            raise ValueError(f"{file_path} has no 'center' column")
+        columns = {field: table[field].to_numpy() if field in table else None for field in cls.FIELDS}
+        columns['center'] = table['center'].astype(np.float64).to_numpy()
+        if columns['tentative'] is not None:
+            columns['tentative'] = np.isin(columns['tentative'], ('1', 'True', 'true', 'yes'))
+        for field in ('species', 'ion', 'label'):
+            if columns[field] is None:
+                columns[field] = np.full(columns['center'].size, '')
+        return cls(**columns)
+
+    def __len__(self):
+        return self.center.size
+
+    def __getitem__(self, index):
+        """
+        Sub-catalog by slice, index array or boolean mask.
+        """
+        subset = LineCatalog.__new__(LineCatalog)
+        for field in self.FIELDS:
+            setattr(subset, field, np.atleast_1d(getattr(self, field)[index]))
+        return subset
+
+    def __iter__(self):
+        return iter(zip(self.center.tolist(), self.label.tolist()))
+
+    def range_indices(self, wmin, wmax):
+        """
+        Index bounds [start, stop) of the lines with wmin <= center <= wmax.
+        wmin and wmax may be arrays, to query many windows at once.
+        """
+        return (np.searchsorted(self.center, wmin, side='left'),
+                np.searchsorted(self.center, wmax, side='right'))
+
+    def in_range(self, wmin, wmax):
+        """
+        Sub-catalog of the lines inside [wmin, wmax].
+        """
+        start, stop = self.range_indices(wmin, wmax)
+        return self[start:stop]
+
+    def nearest(self, wavelengths, max_distance=np.inf):
+        """
+        Closest catalog line to each of the given wavelengths.
+
+        Parameters:
+        wavelengths: float or array-like
+            Wavelengths to look up.
+        max_distance: float
+            Lookups further than this from any line return index -1.
+
+        Returns:
+        index: ndarray of int
+            Catalog index of the nearest line (-1 if none within max_distance).
+        distance: ndarray of float
+            Absolute distance to that line in Angstroms.
+        """
+        wavelengths = np.atleast_1d(np.asarray(wavelengths, dtype=np.float64))
+        right = np.clip(np.searchsorted(self.center, wavelengths), 1, len(self) - 1)
+        left = right - 1
+        take_left = np.abs(wavelengths - self.center[left]) <= np.abs(self.center[right] - wavelengths)
+        index = np.where(take_left, left, right)
+        if len(self) == 1:
+            index = np.zeros_like(index)
+        distance = np.abs(wavelengths - self.center[index])
+        index[distance > max_distance] = -1
+        return index, distance
+
+    def select(self, species=None, ion=None, include_tentative=True):
+        """
+        Sub-catalog by species and/or ionization stage (single values or lists).
+        """
+        keep = np.ones(len(self), dtype=bool)
+        if species is not None:
+            keep &= np.isin(self.species, np.atleast_1d(species))
+        if ion is not None:
+            keep &= np.isin(self.ion, np.atleast_1d(ion))
+        if not include_tentative:
+            keep &= ~self.tentative
+        return self[keep]
+
+    def as_pairs(self):
+        """
+        List of (center, label) pairs, for plotting.
+        """
+        return list(self)
+
+@lru_cache(maxsize=None)
+def load_catalog(file_path=CATALOG_FILE):
+    """
+    The line catalog from file, read once per process and shared afterwards.
+    """
+    return LineCatalog.from_file(file_path)
@@ -0,0 +1,219 @@
+import numpy as np
+from scipy.signal import savgol_filter
+from scipy.ndimage import percentile_filter
+from profiling import profiled
+from line_catalog import load_catalog
+
+### Continuum normalization ###
+# All functions accept a single spectrum (n_pixels,) or a stack (n_stars, n_pixels)
+# sharing one wavelength axis, and work on the whole stack at once.
+
+# Lines whose wings are broad enough to pull a plain smoothing continuum down ("species ion")
+BROAD_IONS = ('H I', 'Ca II')
+
+NORMALIZATION_METHODS = ('savgol', 'iterative', 'quantile')
+
+@profiled('normalize', pixels=lambda result, *args, **kwargs: np.size(result))
+def normalize_spectrum_smooth(wavelength, flux, window_length=101, polyorder=3):
+    """
+    Normalize the flux of the spectrum by smoothing over local peaks.
+
+    Parameters:
+    wavelength: array-like
+        Array of wavelength values.
+    flux: array-like
+        Array of flux values, or a (n_stars, n_pixels) stack of spectra.
+    window_length: int
+        The length of the filter window (number of points). Must be odd.
+    polyorder: int
+        The order of the polynomial used to fit the samples.
+
+    Returns:
+    norm_flux: array-like
+        The normalized flux.
+    """
+    # Smooth the flux to estimate the continuum
+    smoothed_flux = savgol_filter(flux, window_length, polyorder, axis=-1)
+
+    # Normalize the flux
+    norm_flux = flux / smoothed_flux
+
+    return norm_flux
+
+def catalog_line_regions(catalog=None, line_width=3.0, broad_width=25.0, broad_ions=BROAD_IONS):
+    """
+    Line regions around the lines of the absorption catalog.
+
+    Parameters:
+    catalog: LineCatalog or None
+        Lines to use (default: the full catalog, tentative features included).
+    line_width, broad_width: float
+        Half width in Angstroms around ordinary lines and around lines of broad_ions.
+
+    Returns:
+    lines: list of (center, half_width)
+    """
+    catalog = catalog if catalog is not None else load_catalog()
+    broad = np.isin(np.char.add(np.char.add(catalog.species, ' '), catalog.ion), broad_ions)
+    return list(zip(catalog.center.tolist(), np.where(broad, broad_width, line_width).tolist()))
+
+def line_mask(wavelength, lines=None):
+    """
+    Boolean mask of the pixels inside any of the given line regions.
+
+    Parameters:
+    wavelength: array-like
+        Sorted wavelength grid.
+    lines: list of (center, half_width) or None
+        Line regions in Angstroms (default: catalog_line_regions()).
+
+    Returns:
+    mask: ndarray of bool
+        True for pixels within a line region.
+    """
+    wavelength = np.asarray(wavelength)
+    lines = catalog_line_regions() if lines is None else lines
+    mask = np.zeros(wavelength.size, dtype=bool)
+    if len(lines) == 0:
+        return mask
+    centers, half_widths = np.asarray(lines, dtype=np.float64).T
+    start = np.searchsorted(wavelength, centers - half_widths, side='left')
+    stop = np.searchsorted(wavelength, centers + half_widths, side='right')
+    # Mark region edges and integrate, instead of looping over the regions
+    edges = np.zeros(wavelength.size + 1, dtype=np.int64)
+    np.add.at(edges, start, 1)
+    np.add.at(edges, stop, -1)
+    return np.cumsum(edges[:-1]) > 0
+
+def _fill_rejected(wavelength, flux, keep):
+    # Replace rejected pixels by linear interpolation between the kept neighbours
+    filled = flux.copy()
+    for i in range(flux.shape[0]):
+        if not keep[i].all():
+            filled[i, ~keep[i]] = np.interp(wavelength[~keep[i]], wavelength[keep[i]], flux[i, keep[i]])
+    return filled
+
+def continuum_savgol(wavelength, flux, window_length=101, polyorder=3):
+    """
+    Single-pass Savitzky-Golay continuum (the original normalize_spectrum_smooth).
+    """
+    return savgol_filter(np.atleast_2d(flux), window_length, polyorder, axis=-1)
+
+def continuum_iterative(wavelength, flux, window_length=101, polyorder=3, n_iter=10,
+                        lower_sigma=1.0, upper_sigma=3.0, lines=None):
+    """
+    Iterative, asymmetrically sigma-clipped Savitzky-Golay continuum.
+
+    Pixels in the given line regions are excluded from the start. On every
+    iteration the excluded pixels are bridged by linear interpolation, the result is
+    smoothed, and pixels more than lower_sigma below (absorption) or upper_sigma
+    above (cosmics) the smoothed curve are rejected for the next pass. The scatter
+    is a robust (MAD) estimate per spectrum. Iteration stops once no spectrum
+    changes its rejected pixels.
+
+    Parameters:
+    wavelength: array-like, shape (n_pixels,)
+        Shared wavelength grid.
+    flux: array-like, shape (n_stars, n_pixels) or (n_pixels,)
+        Spectra to fit.
+    window_length, polyorder: int
+        Savitzky-Golay settings of the smoothing step.
+    n_iter: int
+        Maximum number of clipping iterations.
+    lower_sigma, upper_sigma: float
+        Clipping thresholds below and above the continuum.
+    lines: list of (center, half_width) or None
+        Line regions that are never used for the continuum (default: the catalog
+        lines, see catalog_line_regions).
+
+    Returns:
+    continuum: ndarray, shape (n_stars, n_pixels)
+    """
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    flux = np.atleast_2d(np.asarray(flux, dtype=np.float64))
+
+    base_keep = np.isfinite(flux) & ~line_mask(wavelength, lines)[None, :]
+    # Spectra left with too few pixels are fitted without the line mask
+    too_few = base_keep.sum(axis=1) < window_length
+    base_keep[too_few] = np.isfinite(flux[too_few])
+    keep = base_keep
+
+    for _ in range(n_iter):
+        continuum = savgol_filter(_fill_rejected(wavelength, flux, keep), window_length, polyorder, axis=-1)
+        residual = np.where(keep, flux - continuum, np.nan)
+        sigma = 1.4826 * np.nanmedian(np.abs(residual - np.nanmedian(residual, axis=1, keepdims=True)),
+                                      axis=1, keepdims=True)
+        residual = flux - continuum
+        new_keep = base_keep & (residual > -lower_sigma * sigma) & (residual < upper_sigma * sigma)
+        new_keep[new_keep.sum(axis=1) < window_length] = base_keep[new_keep.sum(axis=1) < window_length]
+        if np.array_equal(new_keep, keep):
+            break
+        keep = new_keep
+
+    return savgol_filter(_fill_rejected(wavelength, flux, keep), window_length, polyorder, axis=-1)
+
+def continuum_quantile(wavelength, flux, window_length=201, quantile=0.9, smooth_length=101, polyorder=3):
+    """
+    Upper-envelope continuum from a rolling quantile, smoothed by Savitzky-Golay.
+
+    Parameters:
+    window_length: int
+        Width of the rolling window in pixels.
+    quantile: float
+        Quantile of the flux in each window (0.5 = rolling median).
+    smooth_length, polyorder: int
+        Savitzky-Golay settings used to smooth the stepwise quantile curve.
+    """
+    flux = np.atleast_2d(np.asarray(flux, dtype=np.float64))
+    envelope = percentile_filter(flux, 100 * quantile, size=(1, window_length), mode='nearest')
+    return savgol_filter(envelope, smooth_length, polyorder, axis=-1)
+
+def fit_continuum(wavelength, flux, method='iterative', **kwargs):
+    """
+    Continuum of a spectrum or stack of spectra with the selected method.
+
+    Parameters:
+    method: str
+        'savgol' (single smoothing pass), 'iterative' (sigma-clipped with line mask)
+        or 'quantile' (rolling upper envelope). Extra keyword arguments are passed
+        to continuum_savgol, continuum_iterative or continuum_quantile.
+
+    Returns:
+    continuum: ndarray, same shape as flux
+    """
+    functions = {'savgol': continuum_savgol, 'iterative': continuum_iterative, 'quantile': continuum_quantile}
+    if method not in functions:
+        raise ValueError(f"Unknown normalization method '{method}', use one of {NORMALIZATION_METHODS}")
+    continuum = functions[method](wavelength, flux, **kwargs)
+    return continuum.reshape(np.shape(flux))
+
+@profiled('normalize', pixels=lambda result, *args, **kwargs: np.size(result))
+def normalize_spectrum(wavelength, flux, method='iterative', **kwargs):
+    """
+    Continuum-normalize a spectrum or stack of spectra, see fit_continuum.
+
+    Returns:
+    norm_flux: ndarray, same shape as flux
+    """
+    return flux / fit_continuum(wavelength, flux, method, **kwargs)
+
+# Throughput of the normalization modes on the example library
+if __name__ == "__main__":
+    import time
+    from spectral_library import SpectralLibrary
+
+    library = SpectralLibrary.from_directory()
+    n_pixels = library.flux.size
+
+    start = time.perf_counter()
+    for flux in library.flux:
+        normalize_spectrum_smooth(library.wavelength, flux)
+    t_loop = time.perf_counter() - start
+    print(f"{len(library)} spectra, {n_pixels} pixels")
+    print(f"normalize_spectrum_smooth (loop): {t_loop * 1e3:8.1f} ms  {n_pixels / t_loop / 1e6:6.1f} Mpix/s")
+
+    for method in NORMALIZATION_METHODS:
+        start = time.perf_counter()
+        normalize_spectrum(library.wavelength, library.flux, method)
+        elapsed = time.perf_counter() - start
+        print(f"{method:>32} (batch): {elapsed * 1e3:8.1f} ms  {n_pixels / elapsed / 1e6:6.1f} Mpix/s")
@@ -0,0 +1,216 @@
+import os, glob, argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy.signal import savgol_coeffs
+from scipy.fft import rfft, irfft, next_fast_len
+from spectrum_io import load_spectrum, fill_nan
+from normalization import fit_continuum, normalize_spectrum, line_mask, catalog_line_regions, BROAD_IONS
+
+### Automatic choice of the normalization parameters ###
+# Every spectrum is normalized with each candidate of a grid of methods, window lengths
+# and polynomial orders. A candidate is scored by the flatness of the normalized flux in
+# the line-free regions (catalog lines masked, the Balmer and Ca II lines broadly),
+# i.e. the median of |norm_flux - 1| there: a continuum pulled down by broad wings or
+# bent by too stiff a filter leaves the line-free pixels away from 1. A continuum that
+# follows a broad line inside its mask (a short Savitzky-Golay window across the Balmer
+# lines of a hot star) hardly moves the line-free pixels, so the mean depth by which it
+# dips below its line-free values, bridged linearly across the masked lines, is added.
+#
+# Flexible continua also follow the noise and score a little better the smaller the
+# window, while they start to eat into the lines. So the stiffest candidate (largest
+# window per polynomial degree of freedom) that scores within `tolerance` of the best
+# one is chosen, rather than the best one.
+#
+# All Savitzky-Golay candidates of a spectrum are evaluated at once: their kernels are
+# stacked and convolved with the spectrum in one FFT convolution. The scores use the
+# pixels at least half the largest window from the edges, where the convolution equals
+# savgol_filter. The iterative candidates are run one by one. Stars are spread over a
+# process pool.
+
+DEFAULT_METHODS = ('savgol', 'iterative')
+DEFAULT_WINDOWS = (101, 201, 401, 801)
+DEFAULT_ORDERS = (1, 2, 3)
+
+def candidate_grid(methods=DEFAULT_METHODS, windows=DEFAULT_WINDOWS, orders=DEFAULT_ORDERS):
+    """
+    List of candidate settings, as dicts with the keys method, window_length and polyorder.
+    """
+    return [{'method': method, 'window_length': window, 'polyorder': order}
+            for method in methods for window in windows for order in orders if order < window]
+
+def line_free_mask(wavelength, catalog=None, line_width=3.0, broad_width=25.0, broad_ions=BROAD_IONS):
+    """
+    Boolean mask of the pixels away from all catalog lines.
+
+    Parameters:
+    catalog: LineCatalog or None
+        Lines to mask (default: the full catalog, tentative features included).
+    line_width, broad_width: float
+        Half width in Angstroms masked around ordinary lines and around lines of broad_ions.
+
+    Returns:
+    mask: ndarray of bool
+        True for line-free pixels.
+    """
+    return ~line_mask(wavelength, catalog_line_regions(catalog, line_width, broad_width, broad_ions))
+
+def flatness(norm_flux, mask):
+    """
+    Median |norm_flux - 1| over the masked pixels, for each row of norm_flux.
+    """
+    return np.nanmedian(np.abs(np.atleast_2d(norm_flux)[:, mask] - 1), axis=1)
+
+def line_depression(continua, mask, valid):
+    """
+    Mean relative depth by which each continuum dips into the masked lines, for each row
+    of continua: the continuum on the line pixels is compared with its line-free values
+    bridged linearly across the lines.
+
+    Parameters:
+    continua: ndarray, shape (n_candidates, n_pixels)
+    mask: ndarray of bool
+        Line-free pixels used for the bridge.
+    valid: ndarray of bool
+        Pixels that are scored; the line pixels are valid & ~mask.
+    """
+    continua = np.atleast_2d(continua)
+    pixels = np.arange(mask.size)
+    free, lines = pixels[mask], pixels[valid & ~mask]
+    if not lines.size or not free.size:
+        return np.zeros(len(continua))
+    bridge = np.array([np.interp(lines, free, continuum[free]) for continuum in continua])
+    return np.mean(np.clip(1 - continua[:, lines] / bridge, 0, None), axis=1)
+
+def savgol_candidates(flux, candidates):
+    """
+    Savitzky-Golay continua of one spectrum for many (window_length, polyorder) candidates.
+
+    Returns:
+    continua: ndarray, shape (n_candidates, n_pixels)
+        Equal to savgol_filter at least half the largest window away from the edges.
+    """
+    size = max(c['window_length'] for c in candidates)
+    kernels = np.zeros((len(candidates), size))
+    for i, c in enumerate(candidates):
+        offset = (size - c['window_length']) // 2
+        kernels[i, offset:offset + c['window_length']] = savgol_coeffs(c['window_length'], c['polyorder'])
+    flux = np.asarray(flux, dtype=np.float64)
+    # Full linear convolution of the spectrum with every kernel, cropped to the spectrum ('same')
+    n_fft = next_fast_len(flux.size + size - 1, real=True)
+    convolved = irfft(rfft(flux, n_fft)[None, :] * rfft(kernels, n_fft, axis=-1), n_fft, axis=-1)
+    return convolved[:, size // 2:size // 2 + flux.size]
+
+def select_parameters(candidates, scores, tolerance=0.1):
+    """
+    Stiffest candidate scoring within a factor (1 + tolerance) of the best score.
+    """
+    scores = np.asarray(scores)
+    stiffness = np.array([c['window_length'] / (c['polyorder'] + 1) for c in candidates])
+    eligible = np.flatnonzero(scores <= np.nanmin(scores) * (1 + tolerance))
+    # Stiffest first, lower score breaks ties
+    best = eligible[np.lexsort((scores[eligible], -stiffness[eligible]))[0]]
+    return best
+
+def tune_spectrum(wavelength, flux, candidates=None, tolerance=0.1, mask=None):
+    """
+    Score all candidates on one spectrum and choose the normalization settings.
+
+    Parameters:
+    wavelength, flux: array-like
+        The spectrum (non-finite flux is interpolated over).
+    candidates: list of dict or None
+        Settings to try (default: candidate_grid()).
+    tolerance: float
+        Relative score margin within which the stiffest candidate wins.
+    mask: ndarray of bool or None
+        Line-free pixels (default: line_free_mask(wavelength)).
+
+    Returns:
+    params: dict
+        method, window_length and polyorder of the chosen candidate.
+    scores: ndarray, shape (n_candidates,)
+        Score of every candidate, NaN for windows longer than the spectrum.
+    """
+    candidates = candidates or candidate_grid()
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    flux = fill_nan(wavelength, np.asarray(flux, dtype=np.float64))
+    mask = line_free_mask(wavelength) if mask is None else mask.copy()
+    # Only candidates whose window fits into the spectrum are scored, the others score NaN
+    usable = [i for i, c in enumerate(candidates) if c['window_length'] <= wavelength.size]
+    if not usable:
+        raise ValueError(f"Spectrum of {wavelength.size} pixels is shorter than every candidate window")
+
+    scores = np.full(len(candidates), np.nan)
+    valid = np.ones(mask.size, dtype=bool)
+    savgol = [i for i in usable if candidates[i]['method'] == 'savgol']
+    if savgol:
+        # All candidates are scored on the pixels where the stacked convolution is exact
+        edge = max(candidates[i]['window_length'] for i in savgol) // 2
+        valid[:edge] = valid[valid.size - edge:] = False
+        mask &= valid
+        continua = savgol_candidates(flux, [candidates[i] for i in savgol])
+        scores[savgol] = flatness(flux / continua, mask) + line_depression(continua, mask, valid)
+    for i in usable:
+        if candidates[i]['method'] != 'savgol':
+            settings = {k: v for k, v in candidates[i].items() if k != 'method'}
+            continuum = fit_continuum(wavelength, flux, candidates[i]['method'], **settings)
+            scores[i] = flatness(flux / continuum, mask)[0] + line_depression(continuum, mask, valid)[0]
+
+    return dict(candidates[select_parameters(candidates, scores, tolerance)]), scores
+
+def normalize_tuned(wavelength, flux, params):
+    """
+    Normalize a spectrum with settings from tune_spectrum.
+    """
+    settings = {k: v for k, v in params.items() if k in ('window_length', 'polyorder')}
+    return normalize_spectrum(wavelength, flux, params['method'], **settings)
+
+def _tune_job(job):
+    file_path, candidates, tolerance = job
+    wavelength, flux = load_spectrum(file_path)
+    params, scores = tune_spectrum(wavelength, flux, candidates, tolerance)
+    default = [i for i, c in enumerate(candidates) if c == {'method': 'savgol', 'window_length': 101, 'polyorder': 3}]
+    return {'file': os.path.basename(file_path), **params,
+            'score': scores[candidates.index(params)],
+            'score_default': scores[default[0]] if default else np.nan}
+
+def tune_files(files, candidates=None, tolerance=0.1, workers=None):
+    """
+    Choose the normalization settings of many spectrum files in parallel worker processes.
+
+    Parameters:
+    workers: int or None
+        Number of worker processes (default: all cores); 1 tunes in this process.
+
+    Returns:
+    params: pandas.DataFrame
+        One row per file: file, method, window_length, polyorder, score of the choice
+        and of the default savgol(101, 3) normalization.
+    """
+    candidates = candidates or candidate_grid()
+    jobs = [(file_path, candidates, tolerance) for file_path in files]
+    if workers == 1 or len(jobs) == 1:
+        rows = [_tune_job(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = list(pool.map(_tune_job, jobs, chunksize=max(1, len(jobs) // (4 * (workers or os.cpu_count())))))
+    return pd.DataFrame(rows)
+
+if __name__ == "__main__":
+    import time
+    parser = argparse.ArgumentParser(description="Choose continuum normalization settings per spectrum.")
+    parser.add_argument('inputs', nargs='*', help="Spectrum files (default: ExampleStars and TestStars)")
+    parser.add_argument('-o', '--output', default=None, help="CSV file for the chosen settings")
+    parser.add_argument('-j', '--workers', type=int, default=None)
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    files = args.inputs or sorted(glob.glob("ExampleStars/*.dat") + glob.glob("TestStars/*.dat"))
+    start = time.perf_counter()
+    params = tune_files(files, tolerance=args.tolerance, workers=args.workers)
+    elapsed = time.perf_counter() - start
+    print(params.to_string(index=False, float_format=lambda v: f"{v:.5f}"))
+    print(f"Tuned {len(params)} spectra x {len(candidate_grid())} candidates in {elapsed:.2f} s")
+    if args.output:
+        params.to_csv(args.output, index=False)
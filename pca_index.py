@@ -0,0 +1,261 @@
+import os, glob, argparse
+import numpy as np
+from scipy.spatial import cKDTree
+from spectral_library import SpectralLibrary
+from normalization import normalize_spectrum
+from spectrum_io import _write_atomic
+from ew_uncertainty import estimate_noise
+from classify import MIN_NOISE
+
+### PCA-compressed template library ###
+# The normalized template spectra are reduced to their coordinates on the leading
+# principal components, and the coordinates are indexed in a KD-tree. An unknown is
+# normalized, projected onto the basis (one small matrix product) and matched with a
+# tree query, instead of being compared with every template pixel by pixel.
+#
+# The distance between two spectra splits into the part inside the basis (the distance
+# between their coefficient vectors) and the residuals outside it, so the tree distance
+# is a lower bound of the full one. With fewer components than templates the tree alone
+# misranks spectra whose differences lie outside the basis. query() therefore rescores
+# the nearest tree candidates against the stored normalized templates (k x n_pixels per
+# unknown) and widens the candidate set until the tree distance of the next candidate
+# exceeds the k-th full distance. The result is the TemplateClassifier chi^2 and ranking
+#     chi2 = |u - t|^2 / (n_pixels * sigma^2)
+# with sigma the DER_SNR noise of the unknown.
+#
+# New templates are added with an incremental SVD update of the basis (Ross et al. 2008),
+# which only needs the flux of the new templates.
+
+INDEX_VERSION = 2
+
+class PCAIndex:
+    """
+    Nearest-neighbour index of normalized template spectra in a PCA basis.
+
+    Attributes:
+    wavelength: ndarray, shape (n_pixels,)
+        Grid on which templates and unknowns are compared.
+    mean: ndarray, shape (n_pixels,)
+        Mean normalized template.
+    components: ndarray, shape (n_basis, n_pixels)
+        Orthonormal basis (principal components).
+    singular_values: ndarray, shape (n_basis,)
+    coefficients: ndarray, shape (n_templates, n_basis)
+        Template coordinates in the basis.
+    residual2: ndarray, shape (n_templates,)
+        Squared norm of the template part outside the basis.
+    template_flux: ndarray, shape (n_templates, n_pixels)
+        Normalized templates, for the exact scores of the tree candidates.
+    paths, hd, spectral_type, luminosity_class: ndarray of str, shape (n_templates,)
+        Template metadata.
+    """
+
+    META_FIELDS = ('paths', 'hd', 'spectral_type', 'luminosity_class')
+
+    def __init__(self, wavelength, n_components=20, normalization='savgol'):
+        self.wavelength = np.asarray(wavelength, dtype=np.float64)
+        self.n_components = n_components
+        self.normalization = normalization
+        self.n_samples = 0
+        self.mean = np.zeros(self.wavelength.size)
+        self.components = np.empty((0, self.wavelength.size))
+        self.singular_values = np.empty(0)
+        self.coefficients = np.empty((0, 0))
+        self.residual2 = np.empty(0)
+        self.template_flux = np.empty((0, self.wavelength.size))
+        for field in self.META_FIELDS:
+            setattr(self, field, np.empty(0, dtype=str))
+        self.tree = None
+
+    @classmethod
+    def build(cls, library, n_components=20, normalization='savgol'):
+        """
+        Index of all spectra of a SpectralLibrary (on the library's grid).
+        """
+        index = cls(library.wavelength, n_components, normalization)
+        index.add(library)
+        return index
+
+    def __len__(self):
+        return self.coefficients.shape[0]
+
+    def normalize(self, flux):
+        return normalize_spectrum(self.wavelength, np.atleast_2d(flux), self.normalization)
+
+    def project(self, norm_flux):
+        """
+        Coefficients and squared residual norm of normalized spectra.
+        """
+        centered = np.atleast_2d(norm_flux) - self.mean
+        coefficients = centered @ self.components.T
+        residual2 = np.einsum('ij,ij->i', centered, centered) - np.einsum('ij,ij->i', coefficients, coefficients)
+        return coefficients, np.maximum(residual2, 0)
+
+    def add(self, library):
+        """
+        Add templates, updating the basis incrementally and rebuilding the tree.
+
+        Parameters:
+        library: SpectralLibrary or list of str
+            New templates, or their file names (resampled onto the index grid).
+        """
+        if not isinstance(library, SpectralLibrary):
+            library = SpectralLibrary.from_files(library, wavelength=self.wavelength)
+        elif not np.array_equal(library.wavelength, self.wavelength):
+            raise ValueError("New templates must be on the index wavelength grid")
+        norm_flux = self.normalize(library.flux)
+
+        # Incremental SVD: the old data enter only through singular values x components,
+        # plus one row correcting for the shift of the mean
+        n_old, n_new = self.n_samples, norm_flux.shape[0]
+        batch_mean = norm_flux.mean(axis=0)
+        mean = (n_old * self.mean + n_new * batch_mean) / (n_old + n_new)
+        rows = [self.singular_values[:, None] * self.components, norm_flux - batch_mean]
+        if n_old:
+            rows.append(np.sqrt(n_old * n_new / (n_old + n_new)) * (self.mean - batch_mean)[None, :])
+        _, singular_values, components = np.linalg.svd(np.vstack(rows), full_matrices=False)
+        n_basis = min(self.n_components, int(np.sum(singular_values > singular_values[0] * 1e-10)))
+
+        # Old templates in the new basis: x = mean_old + c V_old  ->  (x - mean) V^T
+        new_components = components[:n_basis]
+        if n_old:
+            old_coefficients = self.coefficients @ (self.components @ new_components.T) + (self.mean - mean) @ new_components.T
+            old_residual2 = self.residual2 + np.einsum('ij,ij->i', self.coefficients, self.coefficients) + \
+                2 * self.coefficients @ (self.components @ (self.mean - mean)) + np.sum((self.mean - mean)**2) - \
+                np.einsum('ij,ij->i', old_coefficients, old_coefficients)
+        else:
+            old_coefficients, old_residual2 = np.empty((0, n_basis)), np.empty(0)
+
+        self.mean, self.components, self.singular_values = mean, new_components, singular_values[:n_basis]
+        self.n_samples = n_old + n_new
+        coefficients, residual2 = self.project(norm_flux)
+        self.coefficients = np.vstack([old_coefficients, coefficients])
+        self.residual2 = np.concatenate([np.maximum(old_residual2, 0), residual2])
+        self.template_flux = np.vstack([self.template_flux, norm_flux])
+        for field in self.META_FIELDS:
+            setattr(self, field, np.concatenate([getattr(self, field), getattr(library, field)]))
+        self.tree = cKDTree(self.coefficients)
+
+    def explained_variance_ratio(self):
+        """
+        Fraction of the template variance captured by each basis vector (lower bound after incremental updates).
+        """
+        total = np.sum(self.singular_values**2) + np.sum(self.residual2)
+        return self.singular_values**2 / total
+
+    def query(self, flux, k=3):
+        """
+        Nearest templates of a stack of spectra on the index grid.
+
+        Parameters:
+        flux: array-like, shape (n_unknown, n_pixels)
+            Unnormalized spectra sampled on self.wavelength.
+        k: int
+            Number of matches.
+
+        Returns:
+        chi2: ndarray, shape (n_unknown, k)
+            Reduced chi^2 of the normalized spectra, as TemplateClassifier.scores.
+        index: ndarray of int, shape (n_unknown, k)
+            Template indices, best match first.
+        """
+        norm_flux = self.normalize(flux)
+        coefficients, _ = self.project(norm_flux)
+        k = min(k, len(self))
+        distance2 = np.empty((len(norm_flux), k))
+        index = np.empty((len(norm_flux), k), dtype=np.int64)
+        for i in range(len(norm_flux)):
+            n_candidates = min(2 * k, len(self))
+            while True:
+                tree_distance, candidates = self.tree.query(coefficients[i], k=n_candidates)
+                tree_distance, candidates = np.atleast_1d(tree_distance), np.atleast_1d(candidates)
+                difference = self.template_flux[candidates] - norm_flux[i]
+                full = np.einsum('ij,ij->i', difference, difference)
+                best = np.argsort(full, kind='stable')[:k]
+                # Templates beyond the candidates are at least the last tree distance away
+                if n_candidates == len(self) or tree_distance[-1]**2 >= full[best[-1]]:
+                    break
+                n_candidates = min(2 * n_candidates, len(self))
+            distance2[i], index[i] = full[best], candidates[best]
+        noise = np.maximum(estimate_noise(norm_flux)[0], MIN_NOISE)
+        return distance2 / (self.wavelength.size * noise[:, None]**2), index
+
+    def classify(self, unknowns, k=3):
+        """
+        Best k matches of each unknown, in the format of ClassificationResult.top.
+
+        Parameters:
+        unknowns: SpectralLibrary or list of str
+            Spectra to classify, or the paths of the spectrum files.
+
+        Returns:
+        names: list of str
+        matches: list of list of dict
+        """
+        if not isinstance(unknowns, SpectralLibrary):
+            unknowns = SpectralLibrary.from_files(unknowns, wavelength=self.wavelength)
+        chi2, index = self.query(unknowns.flux, k)
+        matches = [[{'template': str(self.hd[j]), 'spectral_type': str(self.spectral_type[j]),
+                     'luminosity_class': str(self.luminosity_class[j]), 'score': float(s)}
+                    for j, s in zip(row_index, row_chi2)] for row_index, row_chi2 in zip(index, chi2)]
+        return [os.path.basename(p) for p in unknowns.paths], matches
+
+    def save(self, file_path):
+        """
+        Write the index to an .npz file (the KD-tree is rebuilt on loading).
+        """
+        arrays = {field: getattr(self, field) for field in
+                  ('wavelength', 'mean', 'components', 'singular_values', 'coefficients', 'residual2',
+                   'template_flux') + self.META_FIELDS}
+        settings = np.array([INDEX_VERSION, self.n_components, self.n_samples])
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, settings=settings, normalization=np.array(self.normalization), **arrays)
+        _write_atomic(file_path, write)
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            version, n_components, n_samples = data['settings'].tolist()
+            if version != INDEX_VERSION:
+                raise ValueError(f"{file_path} has index version {version}, expected {INDEX_VERSION}; rebuild it")
+            index = cls(data['wavelength'], n_components, str(data['normalization']))
+            index.n_samples = n_samples
+            for field in ('mean', 'components', 'singular_values', 'coefficients', 'residual2',
+                          'template_flux') + cls.META_FIELDS:
+                setattr(index, field, data[field])
+        index.tree = cKDTree(index.coefficients)
+        return index
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build, extend and query a PCA template index.")
+    parser.add_argument('command', choices=['build', 'add', 'query'])
+    parser.add_argument('index', help="Index file (.npz)")
+    parser.add_argument('inputs', nargs='*', help="Spectrum files or directories (build: default ExampleStars)")
+    parser.add_argument('-n', '--n-components', type=int, default=20)
+    parser.add_argument('-k', type=int, default=3, help="Number of matches to report")
+    args = parser.parse_args(argv)
+
+    files = []
+    for item in args.inputs:
+        files.extend(sorted(glob.glob(os.path.join(item, "*.dat"))) if os.path.isdir(item) else [item])
+
+    if args.command == 'build':
+        library = SpectralLibrary.from_files(files) if files else SpectralLibrary.from_directory()
+        index = PCAIndex.build(library, args.n_components)
+        index.save(args.index)
+        print(f"Indexed {len(index)} templates with {index.components.shape[0]} components "
+              f"({index.explained_variance_ratio().sum():.1%} of the variance) -> {args.index}")
+    elif args.command == 'add':
+        index = PCAIndex.load(args.index)
+        index.add(files)
+        index.save(args.index)
+        print(f"Index now holds {len(index)} templates")
+    else:
+        index = PCAIndex.load(args.index)
+        names, matches = index.classify(files, args.k)
+        for name, row in zip(names, matches):
+            print(f"{name}: " + ", ".join(f"{m['spectral_type']}{m['luminosity_class']} ({m['score']:.4g})" for m in row))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import os, json, time, argparse, cProfile, multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from spectrum_io import load_spectrum, fill_nan
+from ingest import discover
+from normalization import normalize_spectrum, NORMALIZATION_METHODS
+from normalization_tuning import tune_spectrum, normalize_tuned
+from equivalent_width import batch_equivalent_widths
+from classify import TemplateClassifier
+from radial_velocity import RadialVelocityMeasurer, rest_wavelength
+from line_catalog import load_catalog
+import profiling
+from results_store import ResultsStore, record_pipeline_results, STORE_DIR
+
+### Batch processing pipeline ###
+# load -> normalize -> classification -> (radial velocity) -> equivalent widths for
+# every input file, spread over a process pool. Usage:
+#   python pipeline.py ExampleStars TestStars "ProblemStar*.dat" -o runs -j 4
+
+# Lines measured by default: (center, label) of the catalog lines closest to these wavelengths
+_catalog = load_catalog()
+MEASURED_LINES = _catalog[_catalog.nearest([4102, 4340, 4471, 4540, 4684, 4860, 6560])[0]].as_pairs()
+
+# One classifier, radial velocity measurer and optionally cProfile profiler per worker process, set up by _init_worker
+_classifier = None
+_rv_measurer = None
+_profiler = None
+_cprofile_dir = None
+
+def _init_worker(classify, profile=False, cprofile_dir=None, rest_frame=False):
+    global _classifier, _rv_measurer, _profiler, _cprofile_dir
+    profiling.enable(profile)
+    _classifier = TemplateClassifier() if classify else None
+    if rest_frame:
+        _rv_measurer = RadialVelocityMeasurer(_classifier.templates if _classifier is not None else None)
+    if cprofile_dir is not None:
+        _profiler = cProfile.Profile()
+        _cprofile_dir = cprofile_dir
+        # Written once when the worker exits (pool workers skip atexit handlers, not finalizers)
+        multiprocessing.util.Finalize(None, _dump_profile, exitpriority=10)
+
+def _dump_profile():
+    _profiler.dump_stats(os.path.join(_cprofile_dir, f"worker_{os.getpid()}.prof"))
+
+def process_file(file_path, options):
+    """
+    Run the full analysis of one spectrum and write its normalized flux.
+
+    Parameters:
+    file_path: str
+        Spectrum file.
+    options: dict
+        'normalization' (method name, or 'auto' to tune it per spectrum), 'output_dir', 'lines' (list of (center, label)),
+        'width' (EW half width) and 'top' (number of matches to report). The radial
+        velocity is measured (and the EWs taken in the rest frame) when the worker was
+        started with rest_frame=True.
+
+    Returns:
+    row: dict
+        One row of the results table.
+    """
+    start = time.perf_counter()
+    wavelength, flux = load_spectrum(file_path)
+    flux = fill_nan(wavelength, flux)
+    if options['normalization'] == 'auto':
+        # Settings chosen per spectrum by continuum flatness in the line-free regions
+        params, _ = tune_spectrum(wavelength, flux)
+        norm_flux = normalize_tuned(wavelength, flux, params)
+    else:
+        params = {'method': options['normalization']}
+        norm_flux = normalize_spectrum(wavelength, flux, options['normalization'])
+
+    name = os.path.basename(file_path)
+    with profiling.stage('write', norm_flux.size):
+        np.savetxt(os.path.join(options['output_dir'], 'normalized', name + '.norm'),
+                   np.column_stack([wavelength, norm_flux]), fmt='%.6f', delimiter='\t')
+
+    row = {'file': name, 'n_pixels': wavelength.size, 'normalization': params['method']}
+    # The tuned window length and order are recorded with the results
+    row.update({key: value for key, value in params.items() if key != 'method'})
+    best = None
+    if _classifier is not None:
+        grid = _classifier.templates.wavelength
+        result = _classifier.scores(np.interp(grid, wavelength, flux)[None, :])[0]
+        best = np.argsort(result)[:options['top']]
+        templates = _classifier.templates
+        row['spectral_type'] = templates.spectral_type[best[0]]
+        row['luminosity_class'] = templates.luminosity_class[best[0]]
+        row['chi2'] = result[best[0]]
+        row['matches'] = "; ".join(f"{templates.spectral_type[j]}{templates.luminosity_class[j]}:{result[j]:.3g}" for j in best)
+
+    if _rv_measurer is not None:
+        # Against the best matching template, or the best correlating one without classification
+        if best is not None:
+            rv = _rv_measurer.measure(wavelength, flux, best[0])
+        else:
+            rv = _rv_measurer.measure_best(wavelength, flux)
+        row['rv'], row['rv_error'] = rv.velocity[0], rv.error[0]
+        # EW windows are placed at the rest wavelengths of the lines
+        wavelength = rest_wavelength(wavelength, rv.velocity[0])
+
+    centers = [center for center, _ in options['lines']]
+    ews = batch_equivalent_widths(wavelength, norm_flux, centers, options['width'])
+    for (center, label), ew in zip(options['lines'], ews):
+        row[f"EW {label} {center:.2f}"] = ew
+
+    row['seconds'] = time.perf_counter() - start
+    return row
+
+def _process_job(file_path, options):
+    # Worker entry point: process one file and ship its stage records back with the row
+    if _profiler is not None:
+        _profiler.enable()
+    with profiling.current_file(file_path):
+        row = process_file(file_path, options)
+    if _profiler is not None:
+        _profiler.disable()
+    return row, profiling.drain()
+
+def run(files, output_dir, workers=None, normalization='iterative', lines=MEASURED_LINES, width=5, classify=True, top=3,
+        profile=False, cprofile=False, rest_frame=False):
+    """
+    Process a list of files in parallel and write the results table.
+
+    With profile=True the per-stage timings of all workers are written to
+    <output_dir>/profile_records.csv and profile_summary.json; with cprofile=True every
+    worker also dumps a cProfile file to <output_dir>/cprofile/. With rest_frame=True the
+    radial velocity of every star is measured and its EWs are measured in the rest frame.
+
+    Returns:
+    results: pandas.DataFrame
+        One row per input file, also written to <output_dir>/results.csv.
+    """
+    os.makedirs(os.path.join(output_dir, 'normalized'), exist_ok=True)
+    options = {'normalization': normalization, 'output_dir': output_dir, 'lines': lines, 'width': width, 'top': top}
+
+    # Build the binary caches up front, so the workers only ever read them
+    for file_path in files:
+        load_spectrum(file_path)
+
+    cprofile_dir = os.path.join(output_dir, 'cprofile') if cprofile else None
+    if cprofile_dir:
+        os.makedirs(cprofile_dir, exist_ok=True)
+
+    workers = workers or os.cpu_count()
+    chunksize = max(1, len(files) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(classify, profile, cprofile_dir, rest_frame)) as pool:
+        outputs = list(pool.map(_process_job, files, [options] * len(files), chunksize=chunksize))
+
+    results = pd.DataFrame([row for row, _ in outputs])
+    results.to_csv(os.path.join(output_dir, 'results.csv'), index=False)
+    if profile:
+        summary = profiling.write_report(output_dir, [r for _, stage_records in outputs for r in stage_records])
+        profiling.print_summary(summary)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Normalize, measure and classify a batch of spectra.")
+    parser.add_argument('inputs', nargs='+', help="Directories, glob patterns or spectrum files")
+    parser.add_argument('-o', '--output', default='runs', help="Directory in which the run folder is created")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="Number of worker processes (default: all cores)")
+    parser.add_argument('--pattern', default=None,
+                        help="File pattern used inside input directories (default: every spectrum format ingest.py reads)")
+    parser.add_argument('--normalization', choices=NORMALIZATION_METHODS + ('auto',), default='iterative',
+                        help="Continuum method; 'auto' picks method, window and order per spectrum")
+    parser.add_argument('--width', type=float, default=5, help="Half width of the EW windows in Angstroms")
+    parser.add_argument('--no-classify', action='store_true', help="Skip template classification")
+    parser.add_argument('--rest-frame', action='store_true',
+                        help="Measure radial velocities and take the EWs in the rest frame")
+    parser.add_argument('--run-name', default=None, help="Name of the run folder (default: timestamp)")
+    parser.add_argument('--profile', action='store_true', default=profiling.ENABLED,
+                        help="Write per-stage timings (also enabled by SPECTRA_PROFILE=1)")
+    parser.add_argument('--cprofile', action='store_true', help="Dump a cProfile file per worker process")
+    parser.add_argument('--store', nargs='?', const=STORE_DIR, default=None,
+                        help=f"Also append the results to a results store, partitioned by run (default: {STORE_DIR})")
+    args = parser.parse_args(argv)
+
+    files = discover(args.inputs, pattern=args.pattern)
+    if not files:
+        parser.error("no input files found")
+
+    run_name = args.run_name or time.strftime("run_%Y%m%d_%H%M%S")
+    output_dir = os.path.join(args.output, run_name)
+    start = time.perf_counter()
+    results = run(files, output_dir, args.workers, args.normalization, width=args.width, classify=not args.no_classify,
+                  profile=args.profile, cprofile=args.cprofile, rest_frame=args.rest_frame)
+    elapsed = time.perf_counter() - start
+
+    if args.store:
+        record_pipeline_results(ResultsStore(args.store), run_name, results, MEASURED_LINES)
+    with open(os.path.join(output_dir, 'run.json'), 'w') as f:
+        json.dump({'arguments': vars(args), 'n_files': len(files), 'seconds': elapsed}, f, indent=2)
+    print(f"Processed {len(results)} spectra in {elapsed:.2f} s with {args.workers or os.cpu_count()} workers -> {output_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,452 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy.special import wofz
+from line_catalog import load_catalog
+from profiling import profiled
+
+### Line profile fitting ###
+# Every line of the catalog is fitted with a Gaussian, Lorentzian or Voigt profile on a
+# local linear continuum; lines whose fit windows overlap (Ca II H + Hε, He I 4026 + the
+# 4030 blend, Na I D2 + D1, the Balmer lines with their neighbours) are fitted together
+# as one multi-component model. The same line group in all stars forms one batch: the
+# Levenberg-Marquardt iterations run on (n_stars, n_pixels, n_params) arrays with
+# analytic Jacobians, so a group costs a few dozen array operations for the whole library.
+#
+# Model of a window:  (c0 + c1 t) * (1 - sum_k A_k phi_k(wavelength))
+# with t the position in the window scaled to [-1, 1] and phi_k a unit-area profile, so
+# that A_k is the equivalent width of component k in Angstroms.
+
+PROFILES = ('gaussian', 'lorentzian', 'voigt')
+# Parameters per component: center, area and log widths (log sigma and/or log gamma)
+N_PROFILE_PARAMS = {'gaussian': 3, 'lorentzian': 3, 'voigt': 4}
+SQRT_2PI = np.sqrt(2 * np.pi)
+SQRT_PI = np.sqrt(np.pi)
+GAUSS_FWHM = 2 * np.sqrt(2 * np.log(2))
+
+# Columns of the LineFitter.fit result table
+RESULT_COLUMNS = ('star', 'line', 'rest_center', 'group', 'n_components', 'profile', 'center', 'center_err',
+                  'fwhm', 'fwhm_err', 'depth', 'depth_err', 'ew', 'ew_err', 'chi2_red', 'n_iter', 'converged',
+                  'at_bound')
+
+def profile_jacobian(profile, x, log_widths):
+    """
+    Unit-area line profile and its derivatives.
+
+    Parameters:
+    profile: str
+        'gaussian' (width sigma), 'lorentzian' (half width gamma) or 'voigt' (sigma, gamma).
+    x: ndarray
+        Wavelength minus line center.
+    log_widths: tuple of ndarray
+        (log sigma,), (log gamma,) or (log sigma, log gamma), broadcastable against x.
+
+    Returns:
+    phi: ndarray
+        Profile values.
+    derivatives: list of ndarray
+        d phi / d center, followed by d phi / d log width for each width.
+    """
+    if profile == 'gaussian':
+        sigma = np.exp(log_widths[0])
+        u = x / sigma
+        phi = np.exp(-0.5 * u**2) / (sigma * SQRT_2PI)
+        return phi, [phi * u / sigma, phi * (u**2 - 1)]
+    if profile == 'lorentzian':
+        gamma = np.exp(log_widths[0])
+        r2 = x**2 + gamma**2
+        phi = gamma / (np.pi * r2)
+        return phi, [2 * x * phi / r2, phi * (x**2 - gamma**2) / r2]
+    if profile == 'voigt':
+        sigma, gamma = np.exp(log_widths[0]), np.exp(log_widths[1])
+        z = (x + 1j * gamma) / (sigma * np.sqrt(2))
+        w = wofz(z)
+        # Derivative of the Faddeeva function: w'(z) = -2 z w(z) + 2i / sqrt(pi)
+        dw = -2 * z * w + 2j / SQRT_PI
+        phi = w.real / (sigma * SQRT_2PI)
+        d_center = -dw.real / (2 * SQRT_PI * sigma**2)
+        d_log_sigma = -(dw * z).real / (sigma * SQRT_2PI) - phi
+        d_log_gamma = -gamma * dw.imag / (2 * SQRT_PI * sigma**2)
+        return phi, [d_center, d_log_sigma, d_log_gamma]
+    raise ValueError(f"Unknown profile '{profile}', use one of {PROFILES}")
+
+def profile_peak(profile, log_widths):
+    """
+    Profile value at the line center (depth of a unit-area line).
+    """
+    if profile == 'gaussian':
+        return 1 / (np.exp(log_widths[0]) * SQRT_2PI)
+    if profile == 'lorentzian':
+        return 1 / (np.pi * np.exp(log_widths[0]))
+    sigma, gamma = np.exp(log_widths[0]), np.exp(log_widths[1])
+    return wofz(1j * gamma / (sigma * np.sqrt(2))).real / (sigma * SQRT_2PI)
+
+def profile_fwhm(profile, log_widths):
+    """
+    Full width at half maximum in Angstroms (Voigt: Olivero & Longbothum 1977, accurate to 0.02%).
+    """
+    if profile == 'gaussian':
+        return GAUSS_FWHM * np.exp(log_widths[0])
+    if profile == 'lorentzian':
+        return 2 * np.exp(log_widths[0])
+    f_gauss, f_lorentz = GAUSS_FWHM * np.exp(log_widths[0]), 2 * np.exp(log_widths[1])
+    return 0.5346 * f_lorentz + np.sqrt(0.2166 * f_lorentz**2 + f_gauss**2)
+
+class LineGroup:
+    """
+    Lines fitted together in one window.
+
+    Attributes:
+    lines: ndarray of int
+        Catalog indices of the components.
+    wmin, wmax: float
+        Fit window in Angstroms.
+    """
+
+    def __init__(self, lines, wmin, wmax):
+        self.lines = lines
+        self.wmin = wmin
+        self.wmax = wmax
+
+def line_groups(centers, half_widths):
+    """
+    Merge lines whose windows [center - half_width, center + half_width] overlap.
+
+    Returns:
+    groups: list of LineGroup
+    """
+    if len(centers) == 0:
+        return []
+    order = np.argsort(centers)
+    lo, hi = centers[order] - half_widths[order], centers[order] + half_widths[order]
+    groups, members = [], [order[0]]
+    wmin, wmax = lo[0], hi[0]
+    for i in range(1, order.size):
+        if lo[i] <= wmax:
+            members.append(order[i])
+            wmax = max(wmax, hi[i])
+        else:
+            groups.append(LineGroup(np.array(members), wmin, wmax))
+            members, wmin, wmax = [order[i]], lo[i], hi[i]
+    groups.append(LineGroup(np.array(members), wmin, wmax))
+    return groups
+
+class LineFitter:
+    """
+    Fit line profiles to all catalog lines of a stack of spectra.
+
+    Parameters:
+    lines: LineCatalog or None
+        Lines to fit; defaults to the non-tentative lines of line_catalog.tsv.
+    profile: str
+        'gaussian', 'lorentzian' or 'voigt'.
+    window: float
+        Half width of the fit window of ordinary lines in Angstroms.
+    broad_window: float
+        Half width of the fit window of the broad-winged lines (broad_ions).
+    broad_ions: tuple of str
+        Species and ionization stage ('H I') of the lines that get the broad window:
+        the Balmer lines and Ca II H & K, whose wings span tens of Angstroms in cool stars.
+    max_shift, broad_max_shift: float
+        Largest allowed distance in Angstroms between a fitted and the expected center,
+        for ordinary and for broad-winged lines.
+    n_iter: int
+        Maximum number of Levenberg-Marquardt iterations.
+    ftol, xtol: float
+        A fit has converged when an iteration lowers the squared residuals by less than
+        ftol (relative) or changes no parameter by more than xtol (relative).
+    """
+
+    def __init__(self, lines=None, profile='voigt', window=3.0, broad_window=40.0, broad_ions=('H I', 'Ca II'),
+                 max_shift=1.5, broad_max_shift=4.0, n_iter=1000, ftol=1e-6, xtol=1e-6):
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown profile '{profile}', use one of {PROFILES}")
+        self.lines = lines if lines is not None else load_catalog().select(include_tentative=False)
+        self.profile = profile
+        self.n_width = N_PROFILE_PARAMS[profile] - 2
+        self.n_iter = n_iter
+        self.ftol = ftol
+        self.xtol = xtol
+        self.broad = np.isin(np.char.add(np.char.add(self.lines.species, ' '), self.lines.ion), broad_ions)
+        self.max_shift = np.where(self.broad, broad_max_shift, max_shift)
+        self.groups = line_groups(self.lines.center, np.where(self.broad, broad_window, window))
+        if profile == 'voigt':
+            self._gaussian_fitter = LineFitter(self.lines, 'gaussian', window, broad_window, broad_ions, max_shift,
+                                               broad_max_shift, n_iter, ftol, xtol)
+
+    def _model(self, params, wavelength, t, n_components):
+        # Model and Jacobian for a batch of windows. params: (n_fits, n_params);
+        # wavelength, t: (n_pixels,). Returns (n_fits, n_pixels) and (n_fits, n_pixels, n_params).
+        n_per = N_PROFILE_PARAMS[self.profile]
+        continuum = params[:, 0, None] + params[:, 1, None] * t
+        absorbed = np.zeros((params.shape[0], wavelength.size))
+        jacobian = np.empty((params.shape[0], wavelength.size, params.shape[1]))
+        for k in range(n_components):
+            p = 2 + k * n_per
+            center, area = params[:, p, None], params[:, p + 1, None]
+            phi, derivatives = profile_jacobian(self.profile, wavelength - center,
+                                                [params[:, p + 2 + j, None] for j in range(self.n_width)])
+            absorbed += area * phi
+            jacobian[:, :, p] = -continuum * area * derivatives[0]
+            jacobian[:, :, p + 1] = -continuum * phi
+            for j in range(self.n_width):
+                jacobian[:, :, p + 2 + j] = -continuum * area * derivatives[1 + j]
+        jacobian[:, :, 0] = 1 - absorbed
+        jacobian[:, :, 1] = t * (1 - absorbed)
+        return continuum * (1 - absorbed), jacobian
+
+    def _initial_params(self, wavelength, flux, t, centers, broad):
+        # Continuum from the window edges, areas from the depth at the expected centers
+        n_fits, n_components = flux.shape[0], centers.shape[1]
+        n_edge = max(2, wavelength.size // 20)
+        blue, red = flux[:, :n_edge].mean(axis=1), flux[:, -n_edge:].mean(axis=1)
+        params = np.empty((n_fits, 2 + n_components * N_PROFILE_PARAMS[self.profile]))
+        params[:, 0], params[:, 1] = 0.5 * (blue + red), 0.5 * (red - blue)
+        for k in range(n_components):
+            p = 2 + k * N_PROFILE_PARAMS[self.profile]
+            pixel = np.clip(np.searchsorted(wavelength, centers[:, k]), 0, wavelength.size - 1)
+            depth = np.clip(1 - flux[np.arange(n_fits), pixel] / params[:, 0], 0.02, 0.9)
+            sigma = 3.0 if broad[k] else 0.5
+            params[:, p] = centers[:, k]
+            if self.profile == 'lorentzian':
+                params[:, p + 1] = depth * np.pi * sigma
+                params[:, p + 2] = np.log(sigma)
+            else:
+                params[:, p + 1] = depth * sigma * SQRT_2PI
+                params[:, p + 2:p + 2 + self.n_width] = np.log(sigma if self.n_width == 1 else [sigma, 0.2 * sigma])
+        return params
+
+    def _project(self, params, centers, max_shift, log_width_range):
+        # Keep centers near their expected positions, areas non-negative (absorption lines)
+        # and widths within sensible bounds
+        n_per = N_PROFILE_PARAMS[self.profile]
+        for k in range(centers.shape[1]):
+            p = 2 + k * n_per
+            params[:, p] = np.clip(params[:, p], centers[:, k] - max_shift[k], centers[:, k] + max_shift[k])
+            params[:, p + 1] = np.maximum(params[:, p + 1], 0)
+            params[:, p + 2:p + n_per] = np.clip(params[:, p + 2:p + n_per], *log_width_range)
+        return params
+
+    def _at_bound(self, params, centers, max_shift, log_width_range):
+        # Components that ended on a limit of _project: (n_fits, n_components)
+        n_per = N_PROFILE_PARAMS[self.profile]
+        components = params[:, 2:].reshape(params.shape[0], -1, n_per)
+        margin = 1e-6
+        shifted = np.abs(components[:, :, 0] - centers) >= max_shift * (1 - margin)
+        # A Voigt component with only one of sigma, gamma at the lower limit is a pure
+        # Lorentzian or Gaussian, which is a valid fit
+        widths = components[:, :, 2:]
+        bounded = np.all(widths <= log_width_range[0] + margin, axis=2) | np.any(widths >= log_width_range[1] - margin, axis=2)
+        return shifted | bounded | (components[:, :, 1] <= 0)
+
+    def _levenberg_marquardt(self, params, wavelength, flux, t, centers, max_shift, log_width_range):
+        # Batched Levenberg-Marquardt: every fit has its own damping and stops on its own
+        n_components = centers.shape[1]
+        model, jacobian = self._model(params, wavelength, t, n_components)
+        cost = np.sum((flux - model)**2, axis=1)
+        damping = np.full(params.shape[0], 1e-3)
+        growth = np.full(params.shape[0], 2.0)
+        active = np.ones(params.shape[0], dtype=bool)
+        n_iterations = np.zeros(params.shape[0], dtype=int)
+        for _ in range(self.n_iter):
+            rows = np.flatnonzero(active)
+            if rows.size == 0:
+                break
+            J, residual = jacobian[rows], flux[rows] - model[rows]
+            A = np.einsum('fpi,fpj->fij', J, J)
+            g = np.einsum('fpi,fp->fi', J, residual)
+            diagonal = np.einsum('fii->fi', A)
+            A_damped = A + (damping[rows, None] * np.maximum(diagonal, 1e-12))[:, :, None] * np.eye(A.shape[1])
+            step = np.linalg.solve(A_damped, g[:, :, None])[:, :, 0]
+            trial = self._project(params[rows] + step, centers[rows], max_shift, log_width_range)
+            step = trial - params[rows]
+            trial_model, trial_jacobian = self._model(trial, wavelength, t, n_components)
+            trial_cost = np.sum((flux[rows] - trial_model)**2, axis=1)
+
+            # Damping update of Nielsen (1999), from the ratio of actual to predicted cost reduction
+            predicted = 2 * np.einsum('fi,fi->f', step, g) - np.einsum('fi,fij,fj->f', step, A, step)
+            ratio = np.clip((cost[rows] - trial_cost) / np.maximum(predicted, 1e-300), -1, 2)
+            better = trial_cost < cost[rows]
+            accepted = rows[better]
+            improvement = cost[accepted] - trial_cost[better]
+            params[accepted], model[accepted], jacobian[accepted] = trial[better], trial_model[better], trial_jacobian[better]
+            cost[accepted] = trial_cost[better]
+            damping[rows] = np.where(better, damping[rows] * np.maximum(1 / 3, 1 - (2 * ratio - 1)**3), damping[rows] * growth[rows])
+            growth[rows] = np.where(better, 2.0, growth[rows] * 2)
+            n_iterations[rows] += 1
+            # Converged: accepted step with negligible improvement or size, or damping so large that no step helps
+            done = np.zeros(rows.size, dtype=bool)
+            small_step = np.max(np.abs(step[better]) / (np.abs(trial[better]) + 1e-3), axis=1) <= self.xtol
+            done[better] = (improvement <= self.ftol * cost[accepted]) | small_step
+            done |= damping[rows] > 1e8
+            active[rows[done]] = False
+        return params, jacobian, cost, ~active, n_iterations
+
+    @profiled('fit_lines', pixels=lambda result, self, wavelength, flux, *args, **kwargs: np.size(flux))
+    def fit(self, wavelength, flux, velocities=None, names=None):
+        """
+        Fit all line groups in a stack of spectra on a shared wavelength grid.
+
+        Parameters:
+        wavelength: array-like, shape (n_pixels,)
+            Shared, sorted wavelength grid.
+        flux: array-like, shape (n_stars, n_pixels) or (n_pixels,)
+            Continuum-normalized spectra.
+        velocities: array-like or None
+            Radial velocities in km/s (e.g. from radial_velocity), used to place the expected centers.
+        names: list of str or None
+            Star names for the result table (default: the row numbers).
+
+        Returns:
+        fits: pandas.DataFrame
+            One row per star and line: expected and fitted center, FWHM, depth and
+            equivalent width with 1-sigma errors, plus the group, reduced chi^2,
+            iteration count and convergence flag of its fit. at_bound marks lines whose
+            center, width or (zero) area ended on the limits of the fit.
+        """
+        from radial_velocity import doppler_shift
+        wavelength = np.asarray(wavelength, dtype=np.float64)
+        flux = np.atleast_2d(np.asarray(flux, dtype=np.float64))
+        n_stars = flux.shape[0]
+        velocities = np.zeros(n_stars) if velocities is None else np.broadcast_to(np.asarray(velocities, dtype=np.float64), (n_stars,))
+        names = list(names) if names is not None else list(range(n_stars))
+        n_per = N_PROFILE_PARAMS[self.profile]
+        pixel_size = np.median(np.diff(wavelength))
+
+        tables = []
+        for g, group in enumerate(self.groups):
+            lo, hi = np.searchsorted(wavelength, [group.wmin, group.wmax])
+            n_params = 2 + n_per * group.lines.size
+            if hi - lo <= n_params:
+                continue  # window (mostly) outside the grid
+            window_wavelength = wavelength[lo:hi]
+            window_flux = flux[:, lo:hi]
+            t = (window_wavelength - 0.5 * (group.wmin + group.wmax)) / (0.5 * (group.wmax - group.wmin))
+            centers = doppler_shift(self.lines.center[group.lines][None, :], velocities[:, None])
+            log_width_range = (np.log(0.25 * pixel_size), np.log(group.wmax - group.wmin))
+            max_shift = self.max_shift[group.lines]
+
+            if self.profile == 'voigt':
+                # Voigt fits start from a Gaussian fit: sigma and gamma are nearly degenerate
+                # far from the optimum, which makes a cold start crawl
+                gaussian = self._gaussian_fitter
+                params = gaussian._initial_params(window_wavelength, window_flux, t, centers, self.broad[group.lines])
+                params = gaussian._project(params, centers, max_shift, log_width_range)
+                params, _, _, _, n_prefit = gaussian._levenberg_marquardt(params, window_wavelength, window_flux, t,
+                                                                          centers, max_shift, log_width_range)
+                components = params[:, 2:].reshape(n_stars, -1, 3)
+                log_gamma = np.maximum(components[:, :, 2:] - 2, log_width_range[0])
+                params = np.concatenate([params[:, :2], np.concatenate([components, log_gamma], axis=2).reshape(n_stars, -1)], axis=1)
+            else:
+                params = self._initial_params(window_wavelength, window_flux, t, centers, self.broad[group.lines])
+                n_prefit = 0
+            params = self._project(params, centers, max_shift, log_width_range)
+            params, jacobian, cost, converged, n_iterations = self._levenberg_marquardt(
+                params, window_wavelength, window_flux, t, centers, max_shift, log_width_range)
+            at_bound = self._at_bound(params, centers, max_shift, log_width_range)
+            n_iterations += n_prefit
+
+            # Covariance from the Jacobian, scaled by the residual variance (no flux errors available)
+            dof = window_wavelength.size - n_params
+            chi2_red = cost / dof
+            A = np.einsum('fpi,fpj->fij', jacobian, jacobian)
+            covariance = np.linalg.pinv(A) * chi2_red[:, None, None]
+            tables.append(self._results_table(params, covariance, group, g, names, chi2_red, n_iterations, converged,
+                                              at_bound))
+        if not tables:
+            # No line group fits into the grid (e.g. a short echelle order between the catalog lines)
+            return pd.DataFrame(columns=RESULT_COLUMNS)
+        return pd.concat(tables, ignore_index=True)
+
+    def _results_table(self, params, covariance, group, g, names, chi2_red, n_iterations, converged, at_bound):
+        n_per = N_PROFILE_PARAMS[self.profile]
+        rows = []
+        for k, line in enumerate(group.lines):
+            p = 2 + k * n_per
+            widths = [params[:, p + 2 + j] for j in range(self.n_width)]
+            block = covariance[:, p:p + n_per, p:p + n_per]
+
+            # Errors of the derived quantities from numerical gradients with respect to (center, area, log widths)
+            def derived(q):
+                log_widths = [q[:, 2 + j] for j in range(self.n_width)]
+                return np.stack([q[:, 1] * profile_peak(self.profile, log_widths), profile_fwhm(self.profile, log_widths)], axis=1)
+            q = params[:, p:p + n_per]
+            gradient = np.zeros((q.shape[0], 2, n_per))
+            for j in range(2, n_per):
+                dq = np.zeros_like(q)
+                dq[:, j] = 1e-6
+                gradient[:, :, j] = (derived(q + dq) - derived(q - dq)) / 2e-6
+            gradient[:, 0, 1] = profile_peak(self.profile, widths)
+            values = derived(q)
+            errors = np.sqrt(np.abs(np.einsum('fai,fij,faj->fa', gradient, block, gradient)))
+
+            rows.append(pd.DataFrame({
+                'star': names, 'line': self.lines.label[line], 'rest_center': self.lines.center[line],
+                'group': g, 'n_components': group.lines.size, 'profile': self.profile,
+                'center': params[:, p], 'center_err': np.sqrt(np.abs(block[:, 0, 0])),
+                'fwhm': values[:, 1], 'fwhm_err': errors[:, 1],
+                'depth': values[:, 0], 'depth_err': errors[:, 0],
+                'ew': params[:, p + 1], 'ew_err': np.sqrt(np.abs(block[:, 1, 1])),
+                'chi2_red': chi2_red, 'n_iter': n_iterations, 'converged': converged, 'at_bound': at_bound[:, k]
+            }))
+        return pd.concat(rows, ignore_index=True)
+
+def _fit_job(job):
+    fitter, wavelength, flux, velocities, names = job
+    return fitter.fit(wavelength, flux, velocities, names)
+
+def fit_library(wavelength, flux, fitter=None, velocities=None, names=None, workers=None, chunk_size=64):
+    """
+    Fit a library of spectra in parallel worker processes, chunk_size stars per job.
+
+    Parameters:
+    wavelength, flux, velocities, names:
+        As for LineFitter.fit.
+    fitter: LineFitter or None
+        Fit settings (default: Voigt profiles on the non-tentative catalog lines).
+    workers: int or None
+        Number of worker processes (default: all cores); 1 fits in this process.
+
+    Returns:
+    fits: pandas.DataFrame
+    """
+    fitter = fitter or LineFitter()
+    flux = np.atleast_2d(flux)
+    n_stars = flux.shape[0]
+    velocities = np.zeros(n_stars) if velocities is None else np.broadcast_to(velocities, (n_stars,))
+    names = list(names) if names is not None else list(range(n_stars))
+    jobs = [(fitter, wavelength, flux[start:start + chunk_size], velocities[start:start + chunk_size],
+             names[start:start + chunk_size]) for start in range(0, n_stars, chunk_size)]
+    if workers == 1 or len(jobs) == 1:
+        tables = [_fit_job(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            tables = list(pool.map(_fit_job, jobs))
+    fits = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=RESULT_COLUMNS)
+    # Chunks are in star order, so a stable sort keeps the stars in order within each line
+    return fits.sort_values('rest_center', kind='stable', ignore_index=True)
+
+# Fit every line of the example library and write the table
+if __name__ == "__main__":
+    import time, argparse
+    from spectral_library import SpectralLibrary
+    from normalization import normalize_spectrum
+
+    parser = argparse.ArgumentParser(description="Fit line profiles to all catalog lines of a set of spectra.")
+    parser.add_argument('directory', nargs='?', default=None, help="Spectrum directory (default: ExampleStars)")
+    parser.add_argument('-o', '--output', default='line_fits.csv')
+    parser.add_argument('-j', '--workers', type=int, default=None)
+    parser.add_argument('--profile', choices=PROFILES, default='voigt')
+    args = parser.parse_args()
+
+    library = SpectralLibrary.from_directory(args.directory) if args.directory else SpectralLibrary.from_directory()
+    norm_flux = normalize_spectrum(library.wavelength, library.flux, 'iterative')
+    names = [os.path.basename(p) for p in library.paths]
+
+    start = time.perf_counter()
+    fits = fit_library(library.wavelength, norm_flux, LineFitter(profile=args.profile), names=names, workers=args.workers)
+    elapsed = time.perf_counter() - start
+    fits.to_csv(args.output, index=False)
+    print(f"Fitted {len(fits)} lines ({fits['converged'].mean():.0%} converged) in {len(library)} spectra "
+          f"in {elapsed:.2f} s -> {args.output}")
@@ -0,0 +1,165 @@
+import os, sys, csv, json, time, functools, contextlib
+import numpy as np
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+### Per-stage instrumentation ###
+# Timing of the load / normalize / measure / classify / render stages, per file.
+# Switched on with the environment variable SPECTRA_PROFILE=1 (or enable(), or the
+# --profile flag of pipeline.py). When switched off, stage() returns a shared no-op
+# context and profiled functions only pay for one flag check.
+#
+# Stages nest (the classifier normalizes its input inside the classify stage), so every
+# record holds the self time of its stage: the time spent in stages opened inside it is
+# subtracted, and the stage totals add up to the instrumented wall time.
+
+ENABLED = os.environ.get("SPECTRA_PROFILE", "") not in ("", "0")
+
+_records = []
+_open_stages = []
+_current_file = ''
+_NULL = contextlib.nullcontext()
+
+def enable(on=True):
+    global ENABLED
+    ENABLED = on
+
+def _peak_rss_mb():
+    if resource is None:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kilobytes on Linux
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+class _Stage:
+    def __init__(self, name, pixels):
+        self.name = name
+        self.pixels = pixels
+
+    def __enter__(self):
+        self.nested = 0.0
+        _open_stages.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        _open_stages.pop()
+        if _open_stages:
+            _open_stages[-1].nested += elapsed
+        _records.append({
+            'stage': self.name, 'file': _current_file, 'seconds': elapsed - self.nested,
+            'pixels': int(self.pixels), 'peak_rss_mb': _peak_rss_mb(), 'pid': os.getpid()
+        })
+        return False
+
+def stage(name, pixels=0):
+    """
+    Context manager timing one stage, e.g. `with stage('normalize', flux.size): ...`.
+    The pixel count can also be set afterwards through the returned object (`s.pixels = n`).
+    """
+    return _Stage(name, pixels) if ENABLED else _NULL
+
+@contextlib.contextmanager
+def current_file(name):
+    """
+    Attribute the stages recorded inside this block to a file.
+    """
+    global _current_file
+    previous, _current_file = _current_file, os.path.basename(name)
+    try:
+        yield
+    finally:
+        _current_file = previous
+
+def profiled(name, pixels=None):
+    """
+    Decorator recording every call of a function as a stage.
+
+    Parameters:
+    name: str
+        Stage name.
+    pixels: callable or None
+        pixels(result, *args, **kwargs) -> number of pixels processed by the call.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            with _Stage(name, 0) as timed:
+                result = function(*args, **kwargs)
+                if pixels is not None:
+                    timed.pixels = pixels(result, *args, **kwargs)
+            return result
+        return wrapper
+    return decorator
+
+def records():
+    """
+    Stage records of this process so far.
+    """
+    return list(_records)
+
+def drain():
+    """
+    Return and clear the stage records of this process (used to ship them out of worker processes).
+    """
+    drained = list(_records)
+    _records.clear()
+    return drained
+
+def summarize(stage_records):
+    """
+    Per-stage totals: calls, seconds (total, mean, max), pixels and pixel throughput.
+    """
+    summary = {}
+    for name in sorted({r['stage'] for r in stage_records}):
+        seconds = np.array([r['seconds'] for r in stage_records if r['stage'] == name])
+        pixels = sum(r['pixels'] for r in stage_records if r['stage'] == name)
+        total = float(seconds.sum())
+        summary[name] = {
+            'calls': int(seconds.size), 'total_seconds': total, 'mean_seconds': float(seconds.mean()),
+            'max_seconds': float(seconds.max()), 'pixels': int(pixels),
+            'mpixels_per_second': pixels / total / 1e6 if total > 0 and pixels else None
+        }
+    return summary
+
+def write_report(output_dir, stage_records=None, prefix='profile'):
+    """
+    Write <prefix>_records.csv (one row per stage call) and <prefix>_summary.json
+    (per-stage and per-file totals, peak memory) to output_dir.
+
+    Returns:
+    summary: dict
+    """
+    stage_records = records() if stage_records is None else stage_records
+    os.makedirs(output_dir, exist_ok=True)
+    fields = ['stage', 'file', 'seconds', 'pixels', 'peak_rss_mb', 'pid']
+    with open(os.path.join(output_dir, f"{prefix}_records.csv"), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(stage_records)
+
+    per_file = {}
+    for r in stage_records:
+        if r['file']:
+            per_file.setdefault(r['file'], {}).setdefault(r['stage'], 0.0)
+            per_file[r['file']][r['stage']] += r['seconds']
+    summary = {
+        'stages': summarize(stage_records),
+        'files': per_file,
+        'peak_rss_mb': max((r['peak_rss_mb'] for r in stage_records), default=_peak_rss_mb())
+    }
+    with open(os.path.join(output_dir, f"{prefix}_summary.json"), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+def print_summary(summary):
+    print(f"{'stage':<24} {'calls':>6} {'total [s]':>10} {'mean [ms]':>10} {'Mpix/s':>8}")
+    for name, s in summary['stages'].items():
+        throughput = f"{s['mpixels_per_second']:8.1f}" if s['mpixels_per_second'] else f"{'-':>8}"
+        print(f"{name:<24} {s['calls']:>6} {s['total_seconds']:10.3f} {s['mean_seconds'] * 1e3:10.2f} {throughput}")
+    print(f"Peak memory: {summary['peak_rss_mb']:.0f} MB")
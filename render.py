@@ -0,0 +1,206 @@
+import os, argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from line_catalog import load_catalog
+from profiling import profiled
+
+### Headless figure rendering ###
+# Figures are built with the object-oriented API on an Agg canvas (no pyplot, no
+# window), spectra are min/max decimated to the output pixel width, and all line
+# markers of a figure are one LineCollection. render_many renders figures in
+# parallel worker processes.
+
+# Lines marked on the plots: (center, label)
+MARKED_LINES = load_catalog().select(include_tentative=False).as_pairs()
+
+def minmax_decimate(x, y, n_bins):
+    """
+    Reduce a curve to the minimum and maximum of each of n_bins equally long pixel bins.
+
+    Drawn at one bin per output pixel this looks the same as the full curve, since
+    every pixel column still spans the full range of the data falling into it.
+
+    Parameters:
+    x, y: array-like
+        Curve to decimate (x sorted).
+    n_bins: int
+        Number of bins, normally the width of the axes in pixels.
+
+    Returns:
+    x, y: ndarray
+        At most 2 * n_bins points, in the original order.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    bin_size = y.size // n_bins
+    if bin_size < 2:
+        return x, y
+
+    n_used = bin_size * n_bins
+    bins = y[:n_used].reshape(n_bins, bin_size)
+    offsets = np.arange(n_bins)[:, None] * bin_size
+    # nan-aware positions of the extremes, kept in order so the curve does not zigzag backwards
+    i_min = np.argmin(np.where(np.isnan(bins), np.inf, bins), axis=1)
+    i_max = np.argmax(np.where(np.isnan(bins), -np.inf, bins), axis=1)
+    index = np.sort(np.column_stack([i_min, i_max]), axis=1) + offsets
+    index = np.concatenate([index.ravel(), np.arange(n_used, y.size)])
+    return x[index], y[index]
+
+def add_line_markers(ax, lines, label_y=0.02, color='k'):
+    """
+    Mark spectral lines with dashed vertical lines, drawn as a single LineCollection.
+
+    Parameters:
+    ax: matplotlib Axes
+    lines: list of (center, label)
+        Lines to mark.
+    label_y: float
+        Height of the labels in axes coordinates.
+    """
+    if not lines:
+        return
+    centers = np.array([center for center, _ in lines], dtype=np.float64)
+    # x in data coordinates, y in axes coordinates
+    segments = np.zeros((centers.size, 2, 2))
+    segments[:, :, 0] = centers[:, None]
+    segments[:, 0, 1], segments[:, 1, 1] = 0.05, 0.95
+    ax.add_collection(LineCollection(segments, colors=color, linestyles='--', alpha=0.5,
+                                     transform=ax.get_xaxis_transform()))
+    for center, label in lines:
+        ax.text(center + 8, label_y, label, color=color, fontsize=8, rotation=90,
+                verticalalignment='bottom', transform=ax.get_xaxis_transform())
+
+def _new_figure(figsize, dpi):
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    return fig
+
+def _axes_width_pixels(fig, ax):
+    return max(1, int(ax.get_position().width * fig.get_figwidth() * fig.dpi))
+
+def _save(fig, output_path):
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    fig.savefig(output_path)
+    return output_path
+
+@profiled('render', pixels=lambda result, wavelength, flux, *args, **kwargs: sum(np.size(f) for f in flux))
+def render_stacked(wavelength, flux, labels, output_path, flux_offset=2.0, lines=MARKED_LINES,
+                   title=None, figsize=(12, 10), dpi=100):
+    """
+    Stacked plot of several spectra with an offset between them (as stacked_spectral_plot.py).
+
+    Parameters:
+    wavelength: array-like, shape (n_pixels,), or list of array-like
+        Shared wavelength grid, or one grid per spectrum.
+    flux: array-like, shape (n_stars, n_pixels), or list of array-like
+        Spectra, plotted bottom to top.
+    labels: list of str
+        Label of each spectrum.
+    output_path: str
+        File to write; the format follows the extension (.png, .pdf, ...).
+
+    Returns:
+    output_path: str
+    """
+    fig = _new_figure(figsize, dpi)
+    ax = fig.add_subplot()
+    n_bins = _axes_width_pixels(fig, ax)
+    grids = [wavelength] * len(flux) if np.ndim(wavelength[0]) == 0 else wavelength
+    for i, (grid, star_flux, label) in enumerate(zip(grids, flux, labels)):
+        x, y = minmax_decimate(grid, star_flux, n_bins)
+        line, = ax.plot(x, y + i * flux_offset, lw=0.8, label=label)
+        ax.text(grid[-1] + 50, star_flux[-1] + i * flux_offset, label, color=line.get_color(),
+                fontsize=10, verticalalignment='center')
+    add_line_markers(ax, lines)
+    ax.set_xlabel('Wavelength (Å)')
+    ax.set_ylabel('Normalized Flux + Constant')
+    if title:
+        ax.set_title(title)
+    fig.tight_layout()
+    return _save(fig, output_path)
+
+@profiled('render', pixels=lambda result, wavelength, flux, *args, **kwargs: np.size(flux))
+def render_spectrum(wavelength, flux, norm_flux, output_path, title='', lines=MARKED_LINES,
+                    figsize=(15, 10), dpi=100):
+    """
+    Unnormalized and normalized flux of one spectrum with marked lines
+    (as plot_spectrum_with_lines in Overlay_spectral_line.py).
+    """
+    fig = _new_figure(figsize, dpi)
+    ax = fig.add_subplot()
+    n_bins = _axes_width_pixels(fig, ax)
+    ax.plot(*minmax_decimate(wavelength, flux, n_bins), label='Unnormalized Flux', alpha=0.5)
+    ax.plot(*minmax_decimate(wavelength, norm_flux, n_bins), label='Normalized Flux')
+    add_line_markers(ax, lines)
+    ax.set_xlabel('Wavelength')
+    ax.set_ylabel('Flux')
+    ax.set_title(title)
+    ax.legend(loc="upper right")
+    fig.tight_layout()
+    return _save(fig, output_path)
+
+RENDERERS = {'stacked': render_stacked, 'spectrum': render_spectrum}
+
+def _render_job(job):
+    kind, kwargs = job
+    return RENDERERS[kind](**kwargs)
+
+def render_many(jobs, workers=None):
+    """
+    Render figures concurrently in worker processes.
+
+    Parameters:
+    jobs: list of (kind, kwargs)
+        kind is 'stacked' or 'spectrum', kwargs the arguments of render_stacked / render_spectrum.
+    workers: int or None
+        Number of worker processes (default: all cores); 1 renders in this process.
+
+    Returns:
+    paths: list of str
+        Written files, in job order.
+    """
+    if workers == 1:
+        return [_render_job(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_render_job, jobs))
+
+def class_report_jobs(library, output_dir, formats=('png',)):
+    """
+    One stacked-plot job per spectral type letter and luminosity class of a library.
+    """
+    from spectral_library import SPECTRAL_SEQUENCE
+    library = library.sort_by_type()
+    jobs = []
+    for letter in SPECTRAL_SEQUENCE:
+        for lum in np.unique(library.luminosity_class):
+            subset = library.select(type_letter=letter, luminosity_class=lum)
+            if len(subset) == 0:
+                continue
+            for fmt in formats:
+                jobs.append(('stacked', {
+                    'wavelength': subset.wavelength, 'flux': subset.flux, 'labels': subset.labels(),
+                    'output_path': os.path.join(output_dir, f"stacked_{letter}_{lum}.{fmt}"),
+                    'title': f"{letter}-type stars, luminosity class {lum}", 'figsize': (12, 2 + 2 * len(subset))
+                }))
+    return jobs
+
+# Render a stacked plot per spectral type and class of the example library
+if __name__ == "__main__":
+    import time
+    from spectral_library import SpectralLibrary
+
+    parser = argparse.ArgumentParser(description="Render stacked spectral plots per star class without a display.")
+    parser.add_argument('directory', nargs='?', default=None, help="Spectrum directory (default: ExampleStars)")
+    parser.add_argument('-o', '--output', default='figures')
+    parser.add_argument('-j', '--workers', type=int, default=None)
+    parser.add_argument('--format', action='append', dest='formats', help="png, pdf, ... (repeatable)")
+    args = parser.parse_args()
+
+    library = SpectralLibrary.from_directory(args.directory) if args.directory else SpectralLibrary.from_directory()
+    jobs = class_report_jobs(library, args.output, args.formats or ['png'])
+    start = time.perf_counter()
+    paths = render_many(jobs, args.workers)
+    print(f"Rendered {len(paths)} figures in {time.perf_counter() - start:.2f} s -> {args.output}")
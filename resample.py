@@ -0,0 +1,169 @@
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from scipy.interpolate import make_interp_spline
+
+### Resampling onto a common wavelength grid ###
+# The spectra come on slightly different grids (start wavelengths between 3900.00 and
+# 3901.12 A, 18962 to 19334 pixels, ProblemStar2.s.norm at 3900.39 A). A Resampler
+# maps any number of them onto one output grid. For each distinct input grid the
+# interpolation indices and weights ("plan") are computed once and cached, and all
+# spectra sharing an input grid are resampled together as one array operation.
+# shared_resampler keeps the Resamplers of the last few output grids, so that repeated
+# calls (every SpectralLibrary built on the same grid) reuse their plans.
+
+RESAMPLE_MODES = ('linear', 'spline', 'flux')
+
+def uniform_grid(start, stop, step):
+    """
+    Uniform wavelength grid from start up to (at most) stop.
+    """
+    return start + step * np.arange(int(np.floor((stop - start) / step + 1e-9)) + 1)
+
+def log_grid(start, stop, velocity_step):
+    """
+    Grid uniform in log(wavelength), with velocity_step km/s between pixels.
+    """
+    c = 299792.458
+    n_pixels = int(np.floor(np.log(stop / start) / np.log1p(velocity_step / c) + 1e-9)) + 1
+    return start * np.exp(np.log1p(velocity_step / c) * np.arange(n_pixels))
+
+def bin_edges(wavelength):
+    """
+    Pixel edges halfway between pixel centers, extrapolated by half a pixel at both ends.
+    """
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    middle = 0.5 * (wavelength[1:] + wavelength[:-1])
+    return np.concatenate([[2 * wavelength[0] - middle[0]], middle, [2 * wavelength[-1] - middle[-1]]])
+
+def _grid_key(wavelength):
+    return (wavelength.size, hashlib.sha1(np.ascontiguousarray(wavelength).tobytes()).hexdigest())
+
+class Resampler:
+    """
+    Resample spectra onto a fixed output grid.
+
+    Parameters:
+    grid: array-like
+        Output wavelength grid (sorted).
+    mode: str
+        'linear' (linear interpolation), 'spline' (cubic interpolating spline) or
+        'flux' (flux conserving: each output pixel is the average of the input flux,
+        taken as constant over each input pixel, across the output pixel).
+    fill_value: float
+        Value of output pixels outside the input wavelength range.
+    max_plans: int
+        Number of input grids whose plans are kept in the cache.
+    """
+
+    def __init__(self, grid, mode='linear', fill_value=np.nan, max_plans=1024):
+        if mode not in RESAMPLE_MODES:
+            raise ValueError(f"Unknown resampling mode '{mode}', use one of {RESAMPLE_MODES}")
+        self.grid = np.asarray(grid, dtype=np.float64)
+        self.mode = mode
+        self.fill_value = fill_value
+        self.max_plans = max_plans
+        self._plans = OrderedDict()
+        if mode == 'flux':
+            self._edges = bin_edges(self.grid)
+            self._widths = np.diff(self._edges)
+
+    def plan(self, wavelength):
+        """
+        Interpolation plan for an input grid (cached).
+        """
+        wavelength = np.asarray(wavelength, dtype=np.float64)
+        key = _grid_key(wavelength)
+        if key in self._plans:
+            self._plans.move_to_end(key)
+            return self._plans[key]
+
+        if self.mode == 'linear':
+            right = np.clip(np.searchsorted(wavelength, self.grid, side='right'), 1, wavelength.size - 1)
+            left = right - 1
+            t = (self.grid - wavelength[left]) / (wavelength[right] - wavelength[left])
+            plan = {'left': left, 'weight': t,
+                    'outside': (self.grid < wavelength[0]) | (self.grid > wavelength[-1])}
+        elif self.mode == 'flux':
+            in_edges = bin_edges(wavelength)
+            index = np.clip(np.searchsorted(in_edges, self._edges, side='right') - 1, 0, wavelength.size - 1)
+            plan = {'in_widths': np.diff(in_edges), 'index': index, 'offset': self._edges - in_edges[index],
+                    'outside': (self._edges[:-1] < in_edges[0]) | (self._edges[1:] > in_edges[-1])}
+        else:
+            plan = {'outside': (self.grid < wavelength[0]) | (self.grid > wavelength[-1])}
+
+        self._plans[key] = plan
+        if len(self._plans) > self.max_plans:
+            self._plans.popitem(last=False)
+        return plan
+
+    def _apply(self, wavelength, flux):
+        # flux: (n_spectra, n_in), all sampled on `wavelength`
+        plan = self.plan(wavelength)
+        if self.mode == 'linear':
+            left, t = plan['left'], plan['weight']
+            result = flux[:, left] * (1 - t) + flux[:, left + 1] * t
+        elif self.mode == 'flux':
+            # Integral of the piecewise-constant input up to each output edge, differenced per output pixel
+            cumulative = np.zeros((flux.shape[0], flux.shape[1] + 1))
+            np.cumsum(flux * plan['in_widths'], axis=1, out=cumulative[:, 1:])
+            index = plan['index']
+            integral = cumulative[:, index] + flux[:, index] * plan['offset']
+            result = np.diff(integral, axis=1) / self._widths
+        else:
+            result = make_interp_spline(wavelength, flux, k=3, axis=1)(self.grid)
+        result[:, plan['outside']] = self.fill_value
+        return result
+
+    def __call__(self, wavelengths, fluxes):
+        """
+        Resample a batch of spectra.
+
+        Parameters:
+        wavelengths: array-like or list of array-like
+            One wavelength grid shared by all spectra, or one grid per spectrum.
+        fluxes: array-like, shape (n_spectra, n_in), or list of array-like
+            Fluxes on the corresponding grids.
+
+        Returns:
+        flux: ndarray, shape (n_spectra, n_grid)
+        """
+        shared = not isinstance(wavelengths, (list, tuple)) and np.ndim(wavelengths) == 1
+        if shared:
+            return self._apply(np.asarray(wavelengths, dtype=np.float64), np.atleast_2d(np.asarray(fluxes, dtype=np.float64)))
+
+        if len(wavelengths) != len(fluxes):
+            raise ValueError("Need one wavelength grid per spectrum")
+        # Spectra on identical input grids are resampled together
+        groups = {}
+        for i, wavelength in enumerate(wavelengths):
+            wavelength = np.asarray(wavelength, dtype=np.float64)
+            groups.setdefault(_grid_key(wavelength), (wavelength, []))[1].append(i)
+
+        result = np.empty((len(fluxes), self.grid.size))
+        for wavelength, rows in groups.values():
+            result[rows] = self._apply(wavelength, np.array([fluxes[i] for i in rows], dtype=np.float64))
+        return result
+
+def resample(wavelengths, fluxes, grid, mode='linear', fill_value=np.nan):
+    """
+    One-off resampling of a batch of spectra, see Resampler.
+    """
+    return Resampler(grid, mode, fill_value)(wavelengths, fluxes)
+
+_shared_resamplers = OrderedDict()
+
+def shared_resampler(grid, mode='linear', max_resamplers=8):
+    """
+    Resampler for an output grid and mode, shared across calls (the max_resamplers most
+    recently used grids are kept).
+    """
+    grid = np.asarray(grid, dtype=np.float64)
+    key = (_grid_key(grid), mode)
+    if key in _shared_resamplers:
+        _shared_resamplers.move_to_end(key)
+    else:
+        _shared_resamplers[key] = Resampler(grid, mode)
+        if len(_shared_resamplers) > max_resamplers:
+            _shared_resamplers.popitem(last=False)
+    return _shared_resamplers[key]
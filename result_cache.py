@@ -0,0 +1,283 @@
+import os, sys, glob, json, time, inspect, hashlib
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from spectrum_io import load_spectrum, file_digest, _write_atomic, CACHE_DIR_NAME
+
+### Content-addressed result cache ###
+# Analysis results (normalized spectra, EW tables) are stored on disk under a key made
+# of the SHA-1 of the input file, the function name, the SHA-1 of the source file that
+# defines the function, the SHA-1 of further data files it reads (the line catalog behind
+# the default line mask of the 'iterative' continuum) and the parameters. Re-running a
+# plotting script with only presentation changes finds every result by its key and skips
+# the computation; editing the input, the parameters, the data files or the analysis code
+# gives new keys. The directory is kept
+# below max_bytes by deleting the least recently used entries (each hit refreshes the
+# entry's modification time).
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+def _sha1(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+@lru_cache(maxsize=None)
+def _source_digest(source_file):
+    return _sha1(source_file)
+
+@lru_cache(maxsize=None)
+def _stat_digest(file_path, mtime_ns, size):
+    return _sha1(file_path)
+
+def _data_digest(file_path):
+    # Data files can change while the process runs, so their digest is cached per modification time
+    stat = os.stat(file_path)
+    return _stat_digest(os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+
+def _code_digest(function):
+    # Decorated functions (e.g. @profiled) are hashed by the file that defines the wrapped function
+    try:
+        return _source_digest(inspect.getsourcefile(inspect.unwrap(function)))
+    except (TypeError, OSError):
+        return ''
+
+def _as_array(value):
+    # Object arrays (e.g. text columns) would need pickle; store them as fixed-width strings
+    array = np.asarray(value)
+    return array.astype(str) if array.dtype == object else array
+
+def _pack(value):
+    # Results are stored as .npz arrays: one array, a tuple of arrays, a dict of arrays or a DataFrame
+    if isinstance(value, pd.DataFrame):
+        arrays = {f"c{i}": _as_array(value[column].to_numpy()) for i, column in enumerate(value.columns)}
+        return 'frame', [str(c) for c in value.columns], arrays
+    if isinstance(value, dict):
+        keys = list(value)
+        return 'dict', keys, {f"c{i}": _as_array(value[k]) for i, k in enumerate(keys)}
+    if isinstance(value, (tuple, list)):
+        return 'tuple', len(value), {f"c{i}": _as_array(v) for i, v in enumerate(value)}
+    return 'array', None, {'c0': _as_array(value)}
+
+def _unpack(kind, layout, data):
+    if kind == 'frame':
+        return pd.DataFrame({column: data[f"c{i}"] for i, column in enumerate(layout)})
+    if kind == 'dict':
+        return {k: data[f"c{i}"] for i, k in enumerate(layout)}
+    if kind == 'tuple':
+        return tuple(data[f"c{i}"] for i in range(layout))
+    return data['c0']
+
+class ResultCache:
+    """
+    On-disk memoization of analysis results with size-bounded LRU eviction.
+
+    Parameters:
+    directory: str or None
+        Cache directory. Defaults to $SPECTRUM_RESULT_CACHE_DIR if set, otherwise
+        ".spectrum_cache/results" in the working directory.
+    max_bytes: int
+        Size limit of the directory; older entries are evicted beyond it.
+
+    Attributes:
+    hits, misses, evictions: int
+        Counts for this process.
+    seconds_saved: float
+        Compute time of the results served from the cache (as measured when they were stored).
+    """
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or os.environ.get("SPECTRUM_RESULT_CACHE_DIR") or os.path.join(CACHE_DIR_NAME, "results")
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self.seconds_saved = 0.0
+        self._size = None
+
+    def key(self, file_path, function, params, depends=None, data_files=None):
+        """
+        Cache key of function(file_path, **params); depends holds further settings the
+        result depends on (e.g. how its inputs were computed), data_files further files
+        it reads, which are hashed by content.
+        """
+        description = {
+            'file': file_digest(file_path),
+            'function': f"{function.__module__}.{function.__qualname__}",
+            'code': _code_digest(function),
+            'params': params,
+            'depends': depends,
+            'data': {os.path.basename(path): _data_digest(path) for path in data_files or ()}
+        }
+        text = json.dumps(description, sort_keys=True, default=lambda v: np.asarray(v).tolist())
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".npz")
+
+    def get(self, key):
+        """
+        Stored result for a key, or None.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                meta = json.loads(str(data['__meta__']))
+                value = _unpack(meta['kind'], meta['layout'], {k: data[k] for k in data.files if k != '__meta__'})
+            os.utime(path)  # mark as recently used
+        except (OSError, ValueError, KeyError):
+            # Includes an entry evicted by another process between the read and the touch
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.seconds_saved += meta.get('seconds', 0.0)
+        return value
+
+    def put(self, key, value, seconds=0.0, description=None):
+        """
+        Store a result (see _pack for the supported types) and evict old entries if needed.
+        """
+        kind, layout, arrays = _pack(value)
+        meta = json.dumps({'kind': kind, 'layout': layout, 'seconds': seconds, 'created': time.time(),
+                           'description': description})
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, __meta__=np.array(meta), **arrays)
+        _write_atomic(path, write)
+
+        if self._size is None:
+            self._size = sum(size for _, _, size in self._entries())
+        else:
+            self._size += os.path.getsize(path)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def memoize(self, file_path, function, args=(), params=None, depends=None, data_files=None):
+        """
+        function(*args, **params) for the spectrum in file_path, computed once.
+
+        The arguments in args are not part of the key: they must be fully determined by
+        the file and `depends` (e.g. its wavelength and flux arrays). params are part of the key.
+        Files the function reads besides the spectrum (catalogs, masks) go into data_files.
+        """
+        params = params or {}
+        key = self.key(file_path, function, params, depends, data_files)
+        value = self.get(key)
+        if value is None:
+            start = time.perf_counter()
+            value = function(*args, **params)
+            self.put(key, value, time.perf_counter() - start,
+                     {'file': os.path.basename(file_path), 'function': function.__qualname__})
+        return value
+
+    def _entries(self):
+        # (path, mtime, size) of every entry
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, "??", "*.npz")):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_mtime, stat.st_size))
+        return entries
+
+    def evict(self, max_bytes=None):
+        """
+        Delete least recently used entries until the cache is below max_bytes.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        size = sum(entry[2] for entry in entries)
+        for path, _, entry_size in entries:
+            if size <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+            self.evictions += 1
+        self._size = size
+
+    def clear(self):
+        self.evict(0)
+
+    def stats(self):
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'seconds_saved': self.seconds_saved, 'entries': len(entries),
+                'bytes': sum(size for _, _, size in entries), 'max_bytes': self.max_bytes}
+
+    def report(self):
+        s = self.stats()
+        lookups = s['hits'] + s['misses']
+        rate = f"{s['hits'] / lookups:.0%}" if lookups else "-"
+        return (f"Result cache: {s['hits']} hits, {s['misses']} misses ({rate} hit rate), {s['evictions']} evictions, "
+                f"{s['seconds_saved']:.2f} s saved; {s['entries']} entries, {s['bytes'] / 2**20:.1f} of "
+                f"{s['max_bytes'] / 2**20:.1f} MB")
+
+_default_cache = None
+
+def default_cache():
+    """
+    Process-wide ResultCache with the default directory and size limit.
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ResultCache()
+    return _default_cache
+
+def _normalization_data_files(method, kwargs):
+    # The 'iterative' continuum masks the catalog lines unless it is given its own regions
+    from line_catalog import CATALOG_FILE
+    return [CATALOG_FILE] if method == 'iterative' and kwargs.get('lines') is None else None
+
+def cached_normalized(file_path, method='savgol', cache=None, **kwargs):
+    """
+    Load a spectrum and its continuum-normalized flux, the latter from the result cache.
+
+    Parameters:
+    method: str
+        'savgol' (normalize_spectrum_smooth) or a normalize_spectrum method; extra keyword
+        arguments (window_length, polyorder, ...) are passed on and are part of the key.
+
+    Returns:
+    wavelength, flux, norm_flux: ndarray
+    """
+    from normalization import normalize_spectrum_smooth, normalize_spectrum
+    cache = cache or default_cache()
+    wavelength, flux = load_spectrum(file_path)
+    if method == 'savgol':
+        norm_flux = cache.memoize(file_path, normalize_spectrum_smooth, (wavelength, flux), kwargs)
+    else:
+        norm_flux = cache.memoize(file_path, normalize_spectrum, (wavelength, flux), {'method': method, **kwargs},
+                                  data_files=_normalization_data_files(method, kwargs))
+    return wavelength, flux, norm_flux
+
+def cached_equivalent_widths(file_path, line_centers, width=5, method='savgol', cache=None, **kwargs):
+    """
+    Equivalent widths of lines in a spectrum normalized with `method`, from the result cache.
+
+    Returns:
+    ew: ndarray, shape (n_lines,)
+    """
+    from equivalent_width import batch_equivalent_widths
+    cache = cache or default_cache()
+    wavelength, _, norm_flux = cached_normalized(file_path, method, cache, **kwargs)
+    # The normalization settings are part of the key, as the EWs depend on them
+    return cache.memoize(file_path, batch_equivalent_widths, (wavelength, norm_flux),
+                         {'line_centers': np.asarray(line_centers, dtype=np.float64), 'width': width},
+                         depends={'normalization': method, **kwargs},
+                         data_files=_normalization_data_files(method, kwargs))
+
+# Time a cold and a warm pass over the example library
+if __name__ == "__main__":
+    import tempfile
+    files = sorted(glob.glob(sys.argv[1] if len(sys.argv) > 1 else "ExampleStars/*.dat"))
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ResultCache(directory)
+        for label in ('cold', 'warm'):
+            start = time.perf_counter()
+            for file_path in files:
+                cached_normalized(file_path, 'iterative', cache)
+            print(f"{label}: {time.perf_counter() - start:.3f} s for {len(files)} spectra")
+        print(cache.report())
@@ -0,0 +1,337 @@
+import os, sys, glob, json, time, argparse
+import numpy as np
+import pandas as pd
+from spectrum_io import _write_atomic
+
+### Columnar results store ###
+# Measurements, normalization settings and classifications of every run are appended to
+# tables partitioned by run:
+#     <root>/<table>/run=<run>/part-<time>-<pid>.<ext>   (+ .json statistics sidecar)
+# Each append writes a new part, so runs (and concurrent writers) never rewrite earlier
+# data. Parts are Parquet files if pyarrow is installed, HDF5 tables if PyTables is,
+# otherwise .npz files with one array per column. A query first skips the runs and parts
+# whose sidecar statistics (min/max per column, the distinct values of text columns)
+# cannot match the filters, then reads only the filter columns of the remaining parts,
+# and the requested columns only for the matching rows' parts.
+
+STORE_DIR = "results_store"
+TABLES = ('measurements', 'normalization', 'classification')
+# Text columns with at most this many distinct values per part keep the value list in the statistics
+MAX_STAT_VALUES = 256
+OPERATORS = {
+    '==': lambda a, v: a == v, '!=': lambda a, v: a != v, '<': lambda a, v: a < v, '<=': lambda a, v: a <= v,
+    '>': lambda a, v: a > v, '>=': lambda a, v: a >= v, 'in': lambda a, v: np.isin(a, list(v)),
+}
+
+def _available_format():
+    try:
+        import pyarrow
+        return 'parquet'
+    except ImportError:
+        pass
+    try:
+        import tables
+        return 'hdf5'
+    except ImportError:
+        return 'npz'
+
+EXTENSIONS = {'parquet': '.parquet', 'hdf5': '.h5', 'npz': '.npz'}
+
+def _column_array(series):
+    # Non-numeric columns are stored as fixed-width text (npz cannot hold objects without pickle)
+    if series.dtype.kind in 'iufb':
+        return series.to_numpy()
+    return np.asarray(series.fillna('').astype(str).to_numpy(), dtype=str)
+
+def _column_stats(values):
+    if values.dtype.kind in 'iufb':
+        finite = values[np.isfinite(values)] if values.dtype.kind == 'f' else values
+        if finite.size == 0:
+            return {'min': None, 'max': None}
+        return {'min': finite.min().item(), 'max': finite.max().item()}
+    unique = np.unique(values.astype(str))
+    stats = {'min': str(unique[0]), 'max': str(unique[-1])} if unique.size else {'min': None, 'max': None}
+    if unique.size <= MAX_STAT_VALUES:
+        stats['values'] = unique.tolist()
+    return stats
+
+def _as_text(value):
+    # Filter value for a text column (CLI values such as '5' arrive as numbers)
+    if isinstance(value, (list, tuple, set, np.ndarray)):
+        return [_as_text(v) for v in value]
+    return value if isinstance(value, str) else f"{value:g}" if isinstance(value, float) else str(value)
+
+def _may_match(stats, column, op, value):
+    # False only if the part statistics rule out any row matching (column op value)
+    if column not in stats:
+        return op == '!='
+    s = stats[column]
+    if s['min'] is None:
+        return op == '!='
+    if 'values' in s:
+        values = np.asarray(s['values'])
+        return bool(np.any(OPERATORS[op](values, _as_text(value))))
+    if op == '==':
+        return s['min'] <= value <= s['max']
+    if op == 'in':
+        return any(s['min'] <= v <= s['max'] for v in value)
+    if op in ('<', '<='):
+        return OPERATORS[op](s['min'], value)
+    if op in ('>', '>='):
+        return OPERATORS[op](s['max'], value)
+    return True
+
+class ResultsStore:
+    """
+    Append-only, run-partitioned column store of analysis results.
+
+    Parameters:
+    root: str
+        Store directory (default: $SPECTRUM_RESULTS_STORE or "results_store").
+    format: str
+        'parquet', 'hdf5' or 'npz' for new parts; 'auto' picks the first one whose
+        library is installed. Parts of all formats are read.
+    """
+
+    def __init__(self, root=None, format='auto'):
+        self.root = root or os.environ.get("SPECTRUM_RESULTS_STORE") or STORE_DIR
+        self.format = _available_format() if format == 'auto' else format
+        if self.format not in EXTENSIONS:
+            raise ValueError(f"Unknown store format '{format}', use one of {tuple(EXTENSIONS)} or 'auto'")
+
+    def append(self, table, frame, run):
+        """
+        Append a DataFrame to a table as a new part of the given run.
+
+        Returns:
+        path: str
+            The written part file.
+        """
+        if frame.empty:
+            return None
+        directory = os.path.join(self.root, table, f"run={run}")
+        os.makedirs(directory, exist_ok=True)
+        stem = os.path.join(directory, f"part-{time.time_ns()}-{os.getpid()}")
+        path = stem + EXTENSIONS[self.format]
+        columns = {str(column): _column_array(frame[column]) for column in frame.columns}
+
+        def write(tmp_path):
+            if self.format == 'parquet':
+                pd.DataFrame(columns).to_parquet(tmp_path, index=False)
+            elif self.format == 'hdf5':
+                pd.DataFrame(columns).to_hdf(tmp_path, key='table', format='table', data_columns=True)
+            else:
+                with open(tmp_path, 'wb') as f:
+                    np.savez(f, **columns)
+        _write_atomic(path, write)
+        # The sidecar is written last: a part without one is incomplete and ignored
+        stats = {'n_rows': len(frame), 'columns': {c: _column_stats(v) for c, v in columns.items()}}
+        def write_stats(tmp_path):
+            with open(tmp_path, 'w') as f:
+                json.dump(stats, f)
+        _write_atomic(stem + '.json', write_stats)
+        return path
+
+    def runs(self, table='measurements'):
+        """
+        Names of the runs that have parts in a table, sorted.
+        """
+        return sorted(os.path.basename(d)[4:] for d in glob.glob(os.path.join(self.root, table, "run=*")))
+
+    def _parts(self, table, runs=None):
+        # (run, part path, statistics) of every complete part
+        parts = []
+        for run in (self.runs(table) if runs is None else runs):
+            for stats_path in sorted(glob.glob(os.path.join(self.root, table, f"run={run}", "part-*.json"))):
+                stem = stats_path[:-5]
+                data_path = next((stem + ext for ext in EXTENSIONS.values() if os.path.exists(stem + ext)), None)
+                if data_path is None:
+                    continue
+                with open(stats_path) as f:
+                    parts.append((run, data_path, json.load(f)))
+        return parts
+
+    @staticmethod
+    def _read(path, columns):
+        # {column: ndarray} of some columns of a part
+        if path.endswith('.parquet'):
+            frame = pd.read_parquet(path, columns=columns)
+        elif path.endswith('.h5'):
+            frame = pd.read_hdf(path, 'table', columns=columns)
+        else:
+            with np.load(path, allow_pickle=False) as data:
+                return {c: data[c] for c in columns}
+        return {c: frame[c].to_numpy() for c in columns}
+
+    def query(self, table, columns=None, filters=(), runs=None):
+        """
+        Rows of a table matching all filters.
+
+        Parameters:
+        table: str
+        columns: list of str or None
+            Columns to return (default: all). A 'run' column is always added.
+        filters: list of (column, op, value)
+            Conditions that must all hold; op is one of ==, !=, <, <=, >, >=, in.
+            'run' can be filtered on like any other column.
+        runs: list of str or None
+            Runs to read (default: all).
+
+        Returns:
+        rows: pandas.DataFrame
+        """
+        for _, op, _ in filters:
+            if op not in OPERATORS:
+                raise ValueError(f"Unknown filter operator '{op}', use one of {tuple(OPERATORS)}")
+        run_filters = [f for f in filters if f[0] == 'run']
+        column_filters = [f for f in filters if f[0] != 'run']
+
+        frames = []
+        for run, path, stats in self._parts(table, runs):
+            if not all(OPERATORS[op](np.array([run]), _as_text(value))[0] for _, op, value in run_filters):
+                continue
+            if not all(_may_match(stats['columns'], *f) for f in column_filters):
+                continue
+            available = list(stats['columns'])
+            if any(column not in available for column, _, _ in column_filters):
+                continue
+            # Filter columns first; the other columns only if some rows match
+            filter_columns = sorted({column for column, _, _ in column_filters})
+            keep = np.ones(stats['n_rows'], dtype=bool)
+            if filter_columns:
+                part = self._read(path, filter_columns)
+                for column, op, value in column_filters:
+                    values = part[column]
+                    keep &= np.asarray(OPERATORS[op](values, value if values.dtype.kind in 'iufb' else _as_text(value)))
+                if not keep.any():
+                    continue
+            wanted = [c for c in (columns or available) if c in available]
+            # Rows are selected on the arrays, so only matching rows become DataFrame cells
+            arrays = self._read(path, wanted)
+            frame = pd.DataFrame({c: arrays[c] if keep.all() else arrays[c][keep] for c in wanted})
+            frame.insert(0, 'run', run)
+            frames.append(frame)
+        if not frames:
+            return pd.DataFrame(columns=['run'] + list(columns or []))
+        return pd.concat(frames, ignore_index=True)
+
+    def summary(self):
+        """
+        Number of parts and rows per table and run.
+        """
+        rows = [{'table': table, 'run': run, 'parts': 1, 'rows': stats['n_rows']}
+                for table in TABLES for run, _, stats in self._parts(table)]
+        if not rows:
+            return pd.DataFrame(columns=['table', 'run', 'parts', 'rows'])
+        return pd.DataFrame(rows).groupby(['table', 'run'], as_index=False).sum()
+
+def spectral_type_columns(spectral_type):
+    """
+    type_letter and numeric subclass of spectral types such as 'B3' or 'O7.5' (for
+    filtering and for ordering trend plots).
+    """
+    spectral_type = pd.Series(spectral_type, dtype=str).fillna('')
+    letter = spectral_type.str[:1]
+    subclass = pd.to_numeric(spectral_type.str[1:], errors='coerce')
+    return letter.to_numpy(), subclass.to_numpy()
+
+def record_pipeline_results(store, run, results, lines):
+    """
+    Append a pipeline results table (one row per file, see pipeline.process_file) to the
+    measurements, normalization and classification tables.
+
+    Parameters:
+    lines: list of (center, label)
+        The measured lines, in the order of the results' EW columns.
+    """
+    stars = results['file'].to_numpy()
+    classified = 'spectral_type' in results
+    spectral_type = results['spectral_type'].to_numpy() if classified else np.full(len(results), '')
+    luminosity_class = results['luminosity_class'].to_numpy() if classified else np.full(len(results), '')
+    type_letter, subclass = spectral_type_columns(spectral_type)
+
+    # One measurement row per star and line, with the star's classification for filtering
+    n_lines = len(lines)
+    measurements = pd.DataFrame({
+        'star': np.repeat(stars, n_lines),
+        'line': np.tile([label for _, label in lines], len(results)),
+        'rest_center': np.tile([center for center, _ in lines], len(results)),
+        'ew': results[[f"EW {label} {center:.2f}" for center, label in lines]].to_numpy().ravel(),
+        'spectral_type': np.repeat(spectral_type, n_lines),
+        'type_letter': np.repeat(type_letter, n_lines),
+        'subclass': np.repeat(subclass, n_lines),
+        'luminosity_class': np.repeat(luminosity_class, n_lines),
+    })
+    if 'rv' in results:
+        measurements['rv'] = np.repeat(results['rv'].to_numpy(), n_lines)
+    store.append('measurements', measurements, run)
+
+    settings = [c for c in ('normalization', 'window_length', 'polyorder') if c in results]
+    store.append('normalization', results[['file'] + settings].rename(columns={'file': 'star', 'normalization': 'method'}), run)
+    if classified:
+        classification = results[['file', 'spectral_type', 'luminosity_class', 'chi2', 'matches']].rename(columns={'file': 'star'})
+        classification.insert(2, 'type_letter', type_letter)
+        classification.insert(3, 'subclass', subclass)
+        store.append('classification', classification, run)
+
+def _parse_filter(text):
+    # "column==value", "column>=3.5", "column in a,b"
+    if ' in ' in text:
+        column, values = text.split(' in ', 1)
+        return column.strip(), 'in', [_parse_value(v) for v in values.split(',')]
+    for op in ('==', '!=', '<=', '>=', '<', '>'):
+        if op in text:
+            column, value = text.split(op, 1)
+            return column.strip(), op, _parse_value(value)
+    raise argparse.ArgumentTypeError(f"cannot parse filter '{text}'")
+
+def _parse_value(text):
+    text = text.strip()
+    for parse in (int, float):
+        try:
+            return parse(text)
+        except ValueError:
+            pass
+    return text
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect and query the results store.")
+    parser.add_argument('command', choices=['summary', 'query', 'trend'])
+    parser.add_argument('--store', default=None, help="Store directory")
+    parser.add_argument('--table', default='measurements', choices=TABLES)
+    parser.add_argument('--columns', default=None, help="Comma-separated columns to show")
+    parser.add_argument('-f', '--filter', action='append', type=_parse_filter, default=[],
+                        help="Filter such as 'line==Hβ', 'type_letter==B', 'subclass<5' (repeatable)")
+    parser.add_argument('--line', default='Hβ', help="trend: line whose EW is plotted against spectral type")
+    parser.add_argument('-o', '--output', default=None, help="trend: figure file (default: figures/ew_trend_<line>.png)")
+    args = parser.parse_args(argv)
+
+    store = ResultsStore(args.store)
+    if args.command == 'summary':
+        print(store.summary().to_string(index=False))
+    elif args.command == 'query':
+        columns = args.columns.split(',') if args.columns else None
+        print(store.query(args.table, columns, args.filter).to_string(index=False))
+    else:
+        # EW of one line against spectral type (letter + subclass) for every classified star of every run
+        from spectral_library import SPECTRAL_SEQUENCE
+        import matplotlib.pyplot as plt
+        rows = store.query('measurements', ['star', 'ew', 'type_letter', 'subclass', 'luminosity_class'],
+                           [('line', '==', args.line), ('type_letter', 'in', list(SPECTRAL_SEQUENCE))] + args.filter)
+        if rows.empty:
+            sys.exit(f"No classified measurements of {args.line} in {store.root}")
+        x = rows['type_letter'].map(SPECTRAL_SEQUENCE.index) * 10 + rows['subclass'].fillna(0)
+        fig, ax = plt.subplots(figsize=(10, 6))
+        for luminosity_class, group in rows.groupby('luminosity_class'):
+            ax.scatter(x[group.index], group['ew'], s=12, label=luminosity_class or '?')
+        ax.set_xticks(10 * np.arange(len(SPECTRAL_SEQUENCE)), list(SPECTRAL_SEQUENCE))
+        ax.set_xlabel('Spectral type')
+        ax.set_ylabel(f'EW {args.line} [A]')
+        ax.legend(title='Luminosity class')
+        output = args.output or os.path.join('figures', f"ew_trend_{args.line}.png")
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        fig.savefig(output, dpi=150)
+        print(f"{len(rows)} measurements from {rows['run'].nunique()} runs -> {output}")
+
+if __name__ == "__main__":
+    main()
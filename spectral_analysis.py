@@ -1,9 +1,11 @@
 import os, sys, glob
 import numpy as np
 import seaborn as sns
-import pandas as pd
 import matplotlib.pyplot as plt
 import normPlot
+from spectrum_io import load_spectrum
+from line_catalog import load_catalog
+from viewer import SpectrumViewer
 
 """
 TO DO:
@@ -17,44 +19,32 @@ TO DO:
 sns.set_theme(style="darkgrid")
 
 ### Paths to example, test and problem stars ###
-example_data = glob.glob("ExampleStars/*.dat")
-test_data = glob.glob("TestStars/*.dat")
+example_data = sorted(glob.glob("ExampleStars/*.dat"))
+test_data = sorted(glob.glob("TestStars/*.dat"))
 
 ### Choose which stellar spectrum to plot ###
-file_index_example = int(input(f"\nEnter the index of the file you want to plot [EXAMPLE STAR] (0-{len(example_data)-1}): "))
-file_index_test = int(input(f"\nEnter the index of the file you want to plot [TEST STAR] (0-{len(test_data)-1}): "))
-
-plt.figure(num=1001)
-
-selected_example = example_data[file_index_example]
-example_star = pd.read_csv(selected_example, sep='\t', header=None, names=["Wavelength", "Flux"])
-
-sns.lineplot(x="Wavelength", y="Flux", data=example_star)
-plt.title(f"Spectrum from {os.path.basename(selected_example)}")
-plt.xlabel("Wavelength [A]")
-plt.ylabel(r"Normalised Flux [erg/cm$^2$/A/s]")
-
-plt.figure(num=2001)
-
-selected_test = test_data[file_index_test]
-test_star = pd.read_csv(selected_test, sep='\t', header=None, names=["Wavelength", "Flux"])
-
-sns.lineplot(x="Wavelength", y="Flux", data=test_star)
-plt.title(f"Spectrum from {os.path.basename(selected_test)}")
-plt.xlabel("Wavelength [A]")
-plt.ylabel(r"Normalised Flux [erg/cm$^2$/A/s]")
-
-### Plotting vertical lines at spectral lines of interest ###
-    ### Balmer series ###
-wavel_balmer = [6562.79, 4861.35, 4340.472, 4101.734, 3970.075]
-for wl in wavel_balmer:
-    plt.axvline(x = wl, color = "red", linestyle = "dotted", alpha = 0.5, label = "Balmer Series")
-plt.axvline(x = 4471, color = "yellow", linestyle = "dotted", alpha = 0.5, label = "He I")
-plt.axvline(x = 4121, color = "teal", linestyle = "dotted", alpha = 0.5, label = "He I")
-plt.axvline(x = 4089, color = "orange", linestyle = "dotted", alpha = 0.5, label = "Si IV")
-plt.axvline(x = 4552, color = "black", linestyle = "dotted", alpha = 0.5, label = "Si III")
-plt.axvline(x = 4226, color = "purple", linestyle = "dotted", alpha = 0.5, label = "Ca I")
+# Indices can be given on the command line (python spectral_analysis.py 3 1), otherwise they are asked for
+if len(sys.argv) > 2:
+    file_index_example, file_index_test = int(sys.argv[1]), int(sys.argv[2])
+else:
+    file_index_example = int(input(f"\nEnter the index of the file you want to plot [EXAMPLE STAR] (0-{len(example_data)-1}): "))
+    file_index_test = int(input(f"\nEnter the index of the file you want to plot [TEST STAR] (0-{len(test_data)-1}): "))
+
+### Interactive plots ###
+# Both spectra are drawn through the level-of-detail viewer, so zooming and panning only
+# redraws as many points as the window has pixels. The markers show the H, He, Si and Ca
+# lines of the catalog that fall inside the visible range.
+marked_lines = load_catalog().select(species=['H', 'He', 'Si', 'Ca'], include_tentative=False)
+
+for num, selected in ((1001, example_data[file_index_example]), (2001, test_data[file_index_test])):
+    fig, ax = plt.subplots(num=num)
+    viewer = SpectrumViewer(ax, lines=marked_lines)
+    viewer.add(*load_spectrum(selected))
+    viewer.show_all()
+    fig.viewer = viewer  # keep the callbacks alive with the figure
+    ax.set_title(f"Spectrum from {os.path.basename(selected)}")
+    ax.set_xlabel("Wavelength [A]")
+    ax.set_ylabel(r"Normalised Flux [erg/cm$^2$/A/s]")
 
 #plt.close(1001)
-plt.legend()
-plt.show()
\ No newline at end of file
+plt.show()
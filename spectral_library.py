@@ -0,0 +1,222 @@
+import os, re, glob
+import numpy as np
+from spectrum_io import load_spectrum, fill_nan
+from resample import shared_resampler
+
+### Spectral library ###
+# Holds a whole directory of spectra as one contiguous (n_stars, n_pixels) flux array
+# on a single shared wavelength axis, plus per-star metadata parsed from the file names.
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ExampleStars")
+
+# Order of the spectral sequence, used for sorting
+SPECTRAL_SEQUENCE = "OBAFGKM"
+
+# e.g. HD46223_O4V_Melchiors517392.dat, HD192639_O7.5I_Melchiors477365.dat, HD109358_melchiors347600.dat
+FILENAME_PATTERN = re.compile(
+    r"^(?P<hd>HD\d+[A-Z]?)_"
+    r"(?:(?P<letter>[OBAFGKM])(?P<subclass>\d+(?:\.\d+)?)(?P<lum>IV|V|III|II|I)_)?"
+    r"[Mm]elchiors(?P<melchiors>\d+)"
+)
+
+def parse_filename(file_path):
+    """
+    Parse star metadata from a MELCHIORS file name.
+
+    Parameters:
+    file_path: str
+        Path such as "ExampleStars/HD46223_O4V_Melchiors517392.dat".
+
+    Returns:
+    meta: dict
+        Keys 'hd', 'spectral_type' (e.g. 'O4'), 'type_letter' ('O'), 'subclass' (4.0),
+        'luminosity_class' ('V') and 'melchiors_id'. Fields missing from the name
+        (e.g. for the unclassified test stars) are '' or nan.
+    """
+    name = os.path.basename(file_path)
+    meta = {'hd': os.path.splitext(name)[0], 'spectral_type': '', 'type_letter': '',
+            'subclass': np.nan, 'luminosity_class': '', 'melchiors_id': ''}
+    match = FILENAME_PATTERN.match(name)
+    if match is None:
+        return meta
+
+    meta['hd'] = match['hd']
+    meta['melchiors_id'] = match['melchiors']
+    if match['letter']:
+        meta['spectral_type'] = match['letter'] + match['subclass']
+        meta['type_letter'] = match['letter']
+        meta['subclass'] = float(match['subclass'])
+        meta['luminosity_class'] = match['lum']
+    return meta
+
+def common_grid(wavelengths, step=0.15):
+    """
+    Uniform wavelength grid covering the overlap of all given wavelength arrays.
+
+    Parameters:
+    wavelengths: list of array-like
+        Wavelength axes of the individual spectra.
+    step: float
+        Grid spacing in Angstroms.
+
+    Returns:
+    grid: ndarray
+        Uniform wavelength grid.
+    """
+    start = max(w[0] for w in wavelengths)
+    stop = min(w[-1] for w in wavelengths)
+    n_pixels = int(np.floor((stop - start) / step + 1e-9)) + 1
+    return start + step * np.arange(n_pixels)
+
+class SpectralLibrary:
+    """
+    A set of spectra on a shared wavelength grid.
+
+    Attributes:
+    wavelength: ndarray, shape (n_pixels,)
+        Shared wavelength axis.
+    flux: ndarray, shape (n_stars, n_pixels)
+        Fluxes, one star per row.
+    paths, hd, spectral_type, type_letter, luminosity_class: ndarray of str, shape (n_stars,)
+        Per-star metadata.
+    subclass: ndarray of float, shape (n_stars,)
+        Numeric spectral subclass (nan if unknown).
+    """
+
+    META_FIELDS = ('paths', 'hd', 'spectral_type', 'type_letter', 'subclass', 'luminosity_class')
+
+    def __init__(self, wavelength, flux, paths, metas=None):
+        self.wavelength = np.asarray(wavelength, dtype=np.float64)
+        self.flux = np.ascontiguousarray(flux, dtype=np.float64)
+        if self.flux.ndim != 2 or self.flux.shape[1] != self.wavelength.size:
+            raise ValueError(f"flux must have shape (n_stars, {self.wavelength.size}), got {self.flux.shape}")
+
+        if metas is None:
+            metas = [parse_filename(p) for p in paths]
+        self.paths = np.asarray(paths, dtype=str)
+        self.hd = np.array([m['hd'] for m in metas], dtype=str)
+        self.spectral_type = np.array([m['spectral_type'] for m in metas], dtype=str)
+        self.type_letter = np.array([m['type_letter'] for m in metas], dtype=str)
+        self.subclass = np.array([m['subclass'] for m in metas], dtype=np.float64)
+        self.luminosity_class = np.array([m['luminosity_class'] for m in metas], dtype=str)
+
+    @classmethod
+    def from_files(cls, file_paths, wavelength=None, step=0.15, mode='linear'):
+        """
+        Load spectra and resample them onto a shared grid, bridging nan pixels.
+
+        Parameters:
+        file_paths: list of str
+            Spectrum files.
+        wavelength: array-like or None
+            Target grid. Defaults to a uniform grid with spacing `step` over the
+            wavelength range covered by every file.
+        step: float
+            Grid spacing in Angstroms when `wavelength` is not given.
+        mode: str
+            Resampling mode, see resample.Resampler ('linear', 'spline' or 'flux').
+        """
+        file_paths = list(file_paths)
+        if not file_paths:
+            raise ValueError("No spectra to load")
+        return cls.from_spectra([load_spectrum(p) for p in file_paths], file_paths, wavelength, step, mode)
+
+    @classmethod
+    def from_spectra(cls, spectra, paths, wavelength=None, step=0.15, mode='linear'):
+        """
+        Library of spectra already in memory, see from_files.
+
+        Parameters:
+        spectra: list of (wavelength, flux)
+            The spectra, each on its own sorted wavelength axis.
+        paths: list of str
+            Their file names (for the metadata).
+        """
+        if wavelength is None:
+            wavelength = common_grid([w for w, _ in spectra], step)
+        wavelength = np.asarray(wavelength, dtype=np.float64)
+
+        # Some files contain nan fluxes (e.g. saturated Ca II cores); interpolate over them.
+        # Pixels outside a file's range take its edge flux, as np.interp does.
+        fluxes = [fill_nan(w, f) for w, f in spectra]
+        flux = shared_resampler(wavelength, mode)([w for w, _ in spectra], fluxes)
+        outside = np.isnan(flux)
+        if outside.any():
+            edges = np.array([[f[0], f[-1]] for f in fluxes])
+            rows, columns = np.nonzero(outside)
+            flux[rows, columns] = np.where(columns < wavelength.size // 2, edges[rows, 0], edges[rows, 1])
+        return cls(wavelength, flux, paths)
+
+    @classmethod
+    def from_directory(cls, directory=EXAMPLE_DIR, pattern="*.dat", **kwargs):
+        """
+        Load every spectrum in a directory (defaults to ExampleStars/).
+        """
+        file_paths = sorted(glob.glob(os.path.join(directory, pattern)))
+        return cls.from_files(file_paths, **kwargs)
+
+    def __len__(self):
+        return self.flux.shape[0]
+
+    def __getitem__(self, index):
+        """
+        Subset of stars by integer index, slice, index array or boolean mask.
+        """
+        if isinstance(index, (int, np.integer)):
+            index = [index]
+        subset = SpectralLibrary.__new__(SpectralLibrary)
+        subset.wavelength = self.wavelength
+        subset.flux = np.ascontiguousarray(self.flux[index])
+        for field in self.META_FIELDS:
+            setattr(subset, field, getattr(self, field)[index])
+        return subset
+
+    def mask(self, type_letter=None, luminosity_class=None, spectral_type=None):
+        """
+        Boolean star mask for the given type letters / luminosity classes / spectral types.
+        Each argument may be a single value or a list of values; None matches everything.
+        """
+        keep = np.ones(len(self), dtype=bool)
+        for values, field in ((type_letter, self.type_letter),
+                              (luminosity_class, self.luminosity_class),
+                              (spectral_type, self.spectral_type)):
+            if values is not None:
+                keep &= np.isin(field, np.atleast_1d(values))
+        return keep
+
+    def select(self, type_letter=None, luminosity_class=None, spectral_type=None):
+        """
+        Subset of the library, e.g. select(type_letter=['O', 'B'], luminosity_class='V').
+        """
+        return self[self.mask(type_letter, luminosity_class, spectral_type)]
+
+    def window(self, wmin, wmax):
+        """
+        Flux columns of a wavelength window, as a view.
+
+        Returns:
+        wavelength: ndarray, shape (n_window,)
+        flux: ndarray, shape (n_stars, n_window)
+        """
+        i0, i1 = np.searchsorted(self.wavelength, [wmin, wmax], side='left')
+        return self.wavelength[i0:i1], self.flux[:, i0:i1]
+
+    def sequence_key(self):
+        """
+        Numeric position along the spectral sequence (O0 = 0, B0 = 10, ...); nan if unknown.
+        """
+        letter_index = np.array([SPECTRAL_SEQUENCE.find(t) if t else -1 for t in self.type_letter], dtype=np.float64)
+        letter_index[letter_index < 0] = np.nan
+        return 10 * letter_index + self.subclass
+
+    def sort_by_type(self):
+        """
+        Library ordered from early to late spectral type (unclassified stars last).
+        """
+        return self[np.argsort(self.sequence_key(), kind='stable')]
+
+    def labels(self):
+        """
+        Display labels such as 'O4V', falling back to the HD number.
+        """
+        return [str(s + l) if s else str(hd) for s, l, hd in zip(self.spectral_type, self.luminosity_class, self.hd)]
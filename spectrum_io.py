@@ -0,0 +1,272 @@
+import os, sys, glob, json, time, shutil, hashlib
+import numpy as np
+from profiling import profiled
+from ingest import sniff_format, read_text, iter_text, read_fits
+
+### Binary spectrum cache ###
+# Each spectrum file is parsed once, in the format ingest.sniff_format detects (delimited
+# text with or without header and comment lines, gzipped text, FITS), and stored as a
+# (2, n) float64 .npy file (row 0 = wavelength, row 1 = flux). Later loads memory-map
+# that file, so wavelength and flux come back as zero-copy, read-only views.
+
+CACHE_DIR_NAME = ".spectrum_cache"
+CACHE_VERSION = 1
+# Text files above this size are converted in row blocks instead of with one np.loadtxt call
+LARGE_FILE_BYTES = 64 * 1024 * 1024
+
+def _file_hash(file_path, block_size=1 << 20):
+    """
+    Return the SHA-1 hex digest of a file, read in blocks.
+    """
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def cache_paths(file_path, cache_dir=None):
+    """
+    Return the (.npy, .json) cache file paths for a spectrum file.
+
+    Parameters:
+    file_path: str
+        Path to the spectrum file.
+    cache_dir: str or None
+        Cache directory. Defaults to $SPECTRUM_CACHE_DIR if set, otherwise a
+        ".spectrum_cache" directory next to the source file.
+
+    Returns:
+    npy_path, meta_path: str
+        Paths to the binary array and its metadata sidecar.
+    """
+    file_path = os.path.abspath(file_path)
+    if cache_dir is None:
+        cache_dir = os.environ.get("SPECTRUM_CACHE_DIR") or os.path.join(os.path.dirname(file_path), CACHE_DIR_NAME)
+    # Key on the full source path so files with the same name in different folders do not collide
+    key = hashlib.sha1(file_path.encode('utf-8')).hexdigest()[:12]
+    stem = f"{os.path.basename(file_path)}.{key}"
+    return os.path.join(cache_dir, stem + ".npy"), os.path.join(cache_dir, stem + ".json")
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_atomic(path, write):
+    # Write to a temporary file and rename, so concurrent readers never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _write_meta(meta_path, meta):
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+    _write_atomic(meta_path, write)
+
+def read_spectrum_text(file_path):
+    """
+    Parse a spectrum file in the format detected by ingest.sniff_format.
+
+    Returns:
+    data: ndarray, shape (2, n)
+        Row 0 is the wavelength, row 1 the flux.
+    """
+    format = sniff_format(file_path)
+    wavelength, flux = read_fits(file_path) if format['kind'] == 'fits' else read_text(file_path, format)
+    return np.ascontiguousarray(np.stack([wavelength, flux]), dtype=np.float64)
+
+def iter_spectrum_text(file_path, chunk_rows=1_000_000):
+    """
+    Parse a spectrum file in blocks of rows, so memory use does not grow with the file
+    length (FITS files are read in one block).
+
+    Yields:
+    data: ndarray, shape (2, k)
+        Wavelength and flux of the next k <= chunk_rows rows.
+    """
+    format = sniff_format(file_path)
+    if format['kind'] == 'fits':
+        yield read_spectrum_text(file_path)
+        return
+    for wavelength, flux in iter_text(file_path, format, chunk_rows):
+        yield np.ascontiguousarray(np.stack([wavelength, flux]))
+
+def _write_npy_chunked(file_path, npy_path, chunk_rows):
+    # Write wavelength and flux blocks to two raw files, then join them behind a .npy header
+    parts = [npy_path + '.wavelength', npy_path + '.flux']
+    n_pixels = 0
+    try:
+        with open(parts[0], 'wb') as f_wavelength, open(parts[1], 'wb') as f_flux:
+            for data in iter_spectrum_text(file_path, chunk_rows):
+                data[0].tofile(f_wavelength)
+                data[1].tofile(f_flux)
+                n_pixels += data.shape[1]
+        with open(npy_path, 'wb') as f:
+            np.lib.format.write_array_header_1_0(f, {'descr': np.dtype(np.float64).str, 'fortran_order': False,
+                                                     'shape': (2, n_pixels)})
+            for part in parts:
+                with open(part, 'rb') as f_part:
+                    shutil.copyfileobj(f_part, f, 1 << 24)
+    finally:
+        for part in parts:
+            if os.path.exists(part):
+                os.remove(part)
+    return n_pixels
+
+def build_cache(file_path, cache_dir=None, chunk_rows=1_000_000):
+    """
+    Parse a spectrum file and (re)write its binary cache entry.
+
+    Files larger than LARGE_FILE_BYTES are parsed and written in blocks of chunk_rows
+    rows, so that even very long spectra are converted with bounded memory.
+
+    Returns:
+    npy_path: str
+        Path to the written .npy file.
+    """
+    npy_path, meta_path = cache_paths(file_path, cache_dir)
+    os.makedirs(os.path.dirname(npy_path), exist_ok=True)
+
+    stat = os.stat(file_path)
+    n_pixels = []
+    def write_array(tmp_path):
+        if stat.st_size > LARGE_FILE_BYTES:
+            n_pixels.append(_write_npy_chunked(file_path, tmp_path, chunk_rows))
+            return
+        data = read_spectrum_text(file_path)
+        with open(tmp_path, 'wb') as f:
+            np.save(f, data)
+        n_pixels.append(data.shape[1])
+    _write_atomic(npy_path, write_array)
+    _write_meta(meta_path, {
+        'version': CACHE_VERSION,
+        'source': os.path.abspath(file_path),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha1': _file_hash(file_path),
+        'n_pixels': int(n_pixels[0])
+    })
+    return npy_path
+
+def is_cache_valid(file_path, cache_dir=None):
+    """
+    Check whether the cache entry of a spectrum is up to date.
+
+    The cheap check is on source size and mtime. If only the mtime changed (e.g. the
+    file was touched or copied) the content hash decides, and a matching hash
+    refreshes the stored mtime instead of forcing a re-parse.
+    """
+    npy_path, meta_path = cache_paths(file_path, cache_dir)
+    meta = _read_meta(meta_path)
+    if meta is None or meta.get('version') != CACHE_VERSION or not os.path.exists(npy_path):
+        return False
+
+    stat = os.stat(file_path)
+    if stat.st_size != meta['size']:
+        return False
+    if stat.st_mtime_ns == meta['mtime_ns']:
+        return True
+
+    if _file_hash(file_path) != meta['sha1']:
+        return False
+    meta['mtime_ns'] = stat.st_mtime_ns
+    _write_meta(meta_path, meta)
+    return True
+
+@profiled('load', pixels=lambda result, *args, **kwargs: len(result[1]))
+def load_spectrum(file_path, cache_dir=None, use_cache=True):
+    """
+    Load a spectrum, converting it to a memory-mapped binary cache on first use.
+
+    Parameters:
+    file_path: str
+        Path to the spectrum file (.dat, .s.norm, .csv, ..., see ingest.sniff_format).
+    cache_dir: str or None
+        Cache directory, see cache_paths.
+    use_cache: bool
+        If False, parse the file directly (read_spectrum_text).
+
+    Returns:
+    wavelength, flux: array-like
+        Read-only views into the memory-mapped cache (plain arrays if use_cache is False).
+    """
+    if not use_cache:
+        wavelength, flux = read_spectrum_text(file_path)
+        return wavelength, flux
+
+    npy_path, _ = cache_paths(file_path, cache_dir)
+    if not is_cache_valid(file_path, cache_dir):
+        build_cache(file_path, cache_dir)
+
+    data = np.load(npy_path, mmap_mode='r')
+    return data[0], data[1]
+
+def fill_nan(wavelength, flux):
+    """
+    Replace non-finite flux values by linear interpolation between their neighbours.
+
+    Returns:
+    flux: ndarray
+        The input array if it has no nan pixels, otherwise a filled copy.
+    """
+    good = np.isfinite(flux)
+    if good.all():
+        return flux
+    filled = np.array(flux, dtype=np.float64)
+    filled[~good] = np.interp(wavelength[~good], wavelength[good], flux[good])
+    return filled
+
+def file_digest(file_path, cache_dir=None):
+    """
+    SHA-1 of a spectrum file's content, taken from its cache entry (built if needed),
+    so that an unchanged file is hashed only once.
+    """
+    if not is_cache_valid(file_path, cache_dir):
+        build_cache(file_path, cache_dir)
+    return _read_meta(cache_paths(file_path, cache_dir)[1])['sha1']
+
+def clear_cache(file_paths, cache_dir=None):
+    """
+    Remove the cache entries of the given spectra.
+    """
+    for file_path in file_paths:
+        for path in cache_paths(file_path, cache_dir):
+            if os.path.exists(path):
+                os.remove(path)
+
+# Compare text parsing with cached loads on the example library
+if __name__ == "__main__":
+    pattern = sys.argv[1] if len(sys.argv) > 1 else "ExampleStars/*.dat"
+    files = sorted(glob.glob(pattern))
+    if not files:
+        sys.exit(f"No spectra match {pattern}")
+
+    start = time.perf_counter()
+    for file_path in files:
+        np.loadtxt(file_path)
+    t_loadtxt = time.perf_counter() - start
+
+    clear_cache(files)
+    start = time.perf_counter()
+    for file_path in files:
+        load_spectrum(file_path)
+    t_cold = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for file_path in files:
+        wavelength, flux = load_spectrum(file_path)
+        flux.sum()  # touch the data so the pages are actually read
+    t_warm = time.perf_counter() - start
+
+    print(f"{len(files)} spectra from {pattern}")
+    print(f"np.loadtxt:          {t_loadtxt:8.3f} s")
+    print(f"cache build (cold):  {t_cold:8.3f} s")
+    print(f"cached memmap load:  {t_warm:8.3f} s")
+    print(f"Speedup vs loadtxt:  {t_loadtxt / t_warm:8.1f}x")
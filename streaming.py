@@ -0,0 +1,169 @@
+import numpy as np
+from scipy.signal import savgol_filter
+from spectrum_io import load_spectrum
+from equivalent_width import batch_equivalent_widths
+
+### Chunked processing of very long spectra ###
+# The spectrum is read from its memory-mapped cache in overlapping blocks of pixels.
+# Each block carries window_length // 2 extra pixels on both sides, which is exactly
+# the reach of the Savitzky-Golay filter, so the filtered core of every block equals
+# the corresponding part of a whole-array savgol_filter call bit for bit. The first
+# and last blocks contain the true spectrum edges, where savgol_filter fits its edge
+# polynomials from the same pixels as in the whole-array case.
+
+def iter_chunks(wavelength, flux, chunk_size=1_000_000, overlap=0, min_last=0):
+    """
+    Split a spectrum into blocks of chunk_size pixels with `overlap` extra pixels on each side.
+
+    Parameters:
+    wavelength, flux: array-like
+        Spectrum, typically memory-mapped so that only the current block is read.
+    chunk_size: int
+        Number of pixels in the core of each block.
+    overlap: int
+        Extra pixels on each side of the core (fewer at the spectrum edges).
+    min_last: int
+        A remainder shorter than this is merged into the preceding block.
+
+    Yields:
+    wavelength, flux: ndarray
+        Pixels of the block including its overlap.
+    core: slice
+        Position of the core pixels within the block.
+    """
+    n_pixels = len(flux)
+    start = 0
+    while start < n_pixels:
+        stop = min(start + chunk_size, n_pixels)
+        if n_pixels - stop < min_last:
+            stop = n_pixels
+        lo = max(0, start - overlap)
+        hi = min(n_pixels, stop + overlap)
+        yield np.asarray(wavelength[lo:hi]), np.asarray(flux[lo:hi]), slice(start - lo, stop - lo)
+        start = stop
+
+def stream_normalize(wavelength, flux, chunk_size=1_000_000, window_length=101, polyorder=3):
+    """
+    Savitzky-Golay normalization (as normalize_spectrum_smooth) block by block.
+
+    Only the 'savgol' method is available in streaming form: the iterative and
+    quantile methods use statistics of the whole spectrum.
+
+    Yields:
+    wavelength, norm_flux: ndarray
+        Consecutive, non-overlapping pieces of the normalized spectrum.
+    """
+    if chunk_size < window_length:
+        raise ValueError(f"chunk_size ({chunk_size}) must be at least window_length ({window_length})")
+    # The last block must hold the last window_length pixels for the edge fit
+    for chunk_wavelength, chunk_flux, core in iter_chunks(wavelength, flux, chunk_size, window_length // 2, window_length):
+        if chunk_flux.size < window_length:
+            # Only happens if the whole spectrum is shorter than the filter window
+            raise ValueError(f"Spectrum has fewer than window_length ({window_length}) pixels")
+        smoothed_flux = savgol_filter(chunk_flux, window_length, polyorder)
+        yield chunk_wavelength[core], (chunk_flux / smoothed_flux)[core]
+
+class StreamingEquivalentWidths:
+    """
+    Equivalent widths measured from pieces of a spectrum as they arrive.
+
+    Keeps only the pixels still needed by lines whose window has not been completely
+    received, so memory is bounded by the widest window plus one piece. Each line is
+    measured with batch_equivalent_widths as soon as its window is complete, giving
+    the same result as measuring the whole spectrum at once.
+
+    Parameters:
+    line_centers: array-like
+        Central wavelengths of the lines.
+    width: float
+        Half width of the integration windows in Angstroms.
+    n_continuum: int
+        Pixels at the blue window edge used for the continuum.
+    """
+
+    def __init__(self, line_centers, width=5, n_continuum=5):
+        self.line_centers = np.asarray(line_centers, dtype=np.float64)
+        self.width = width
+        self.n_continuum = n_continuum
+        self.ew = np.full(self.line_centers.size, np.nan)
+        self.pending = np.ones(self.line_centers.size, dtype=bool)
+        self.wavelength = np.empty(0)
+        self.flux = np.empty(0)
+
+    def _measure(self, lines):
+        if lines.any() and self.wavelength.size:
+            self.ew[lines] = batch_equivalent_widths(self.wavelength, self.flux, self.line_centers[lines],
+                                                     self.width, self.n_continuum)
+        self.pending &= ~lines
+
+    def update(self, wavelength, flux):
+        """
+        Add the next piece of the (normalized) spectrum.
+        """
+        self.wavelength = np.concatenate([self.wavelength, wavelength])
+        self.flux = np.concatenate([self.flux, flux])
+        if self.wavelength.size == 0:
+            return
+
+        # Lines whose window ends at or before the last received pixel are complete
+        self._measure(self.pending & (self.line_centers + self.width <= self.wavelength[-1]))
+
+        # Drop the pixels that no pending window reaches
+        if self.pending.any():
+            first_needed = np.searchsorted(self.wavelength, self.line_centers[self.pending].min() - self.width)
+        else:
+            first_needed = self.wavelength.size
+        self.wavelength = self.wavelength[first_needed:]
+        self.flux = self.flux[first_needed:]
+
+    def finalize(self):
+        """
+        Measure the lines still pending (windows cut by the end of the spectrum).
+
+        Returns:
+        ew: ndarray, shape (n_lines,)
+            Equivalent widths in Angstroms (nan for lines outside the spectrum).
+        """
+        self._measure(self.pending.copy())
+        return self.ew
+
+def stream_spectrum(file_path, line_centers=None, output_path=None, chunk_size=1_000_000,
+                    window_length=101, polyorder=3, width=5):
+    """
+    Normalize a spectrum file and measure its lines block by block.
+
+    Parameters:
+    file_path: str
+        Spectrum file; it is converted to the binary cache (in blocks) if needed.
+    line_centers: array-like or None
+        Lines to measure; None skips the equivalent widths.
+    output_path: str or None
+        If given, the normalized (2, n_pixels) spectrum is written there as .npy, block by block.
+    chunk_size, window_length, polyorder: int
+        Block size and Savitzky-Golay settings.
+    width: float
+        Half width of the EW windows in Angstroms.
+
+    Returns:
+    ew: ndarray or None
+        Equivalent widths of line_centers.
+    """
+    wavelength, flux = load_spectrum(file_path)
+    measure = StreamingEquivalentWidths(line_centers, width) if line_centers is not None else None
+    output = None
+    if output_path is not None:
+        output = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float64, shape=(2, len(flux)))
+
+    position = 0
+    for chunk_wavelength, norm_flux in stream_normalize(wavelength, flux, chunk_size, window_length, polyorder):
+        if output is not None:
+            output[0, position:position + norm_flux.size] = chunk_wavelength
+            output[1, position:position + norm_flux.size] = norm_flux
+            output.flush()
+        if measure is not None:
+            measure.update(chunk_wavelength, norm_flux)
+        position += norm_flux.size
+
+    if output is not None:
+        del output
+    return measure.finalize() if measure is not None else None
@@ -1,57 +1,41 @@
-import os, sys, glob
-import numpy as np
+import os, sys, glob, argparse
 import seaborn as sns
 import pandas as pd
 import matplotlib.pyplot as plt
-from scipy.signal import find_peaks, savgol_filter
+from scipy.signal import find_peaks
+from result_cache import cached_normalized, default_cache
+from line_catalog import load_catalog
+from normalization_tuning import tune_files
+from render import render_spectrum
 
 sns.set_theme(style="darkgrid")
 
-G_star = "/Users/madsmikkelsen/ULL/1. Semester/Atmosferas_Estelares/TestStars/HD109358_melchiors347600.dat"
-B_star = "/Users/madsmikkelsen/ULL/1. Semester/Atmosferas_Estelares/TestStars/HD120315_Melchiors327246.dat"
-F_star = "/Users/madsmikkelsen/ULL/1. Semester/Atmosferas_Estelares/TestStars/HD194093_Melchiors474733.dat"
+G_star = "TestStars/HD109358_melchiors347600.dat"
+B_star = "TestStars/HD120315_Melchiors327246.dat"
+F_star = "TestStars/HD194093_Melchiors474733.dat"
 
+parser = argparse.ArgumentParser(description="Normalized spectra of the test stars with marked classification lines.")
+parser.add_argument('-o', '--output', default=None, help="Write the figures into this directory instead of showing them")
+parser.add_argument('--format', default='png', help="png, pdf, ... (with --output)")
+args = parser.parse_args()
 
 
-data_G = np.loadtxt(G_star)
-wavelength_G = data_G[:, 0]
-flux_G = data_G[:, 1]
+# Normalization settings chosen per star (the broad Balmer wings of the B star need a
+# different continuum than the G and F stars); the normalized spectra are reused from the result cache.
+# Three stars are tuned in this process: a worker pool would re-import this script under 'spawn'
+tuned = tune_files([G_star, F_star, B_star], workers=1).set_index('file')
+print(tuned.to_string())
+def normalized(star):
+    params = tuned.loc[os.path.basename(star)]
+    return cached_normalized(star, method=params['method'], window_length=int(params['window_length']),
+                             polyorder=int(params['polyorder']))
 
-data_B = np.loadtxt(B_star)
-wavelength_B = data_B[:, 0]
-flux_B = data_B[:, 1]
-
-data_F = np.loadtxt(F_star)
-wavelength_F = data_F[:, 0]
-flux_F = data_F[:, 1]
-
-def normalize_spectrum_smooth(wavelength, flux, window_length=101, polyorder=3):
-    smoothed_flux = savgol_filter(flux, window_length, polyorder)
-
-    norm_flux = flux / smoothed_flux
-
-    return norm_flux
-
-# Example: Normalizing the G_star spectrum with a smoothing method
-norm_flux_G_smooth = normalize_spectrum_smooth(wavelength_G, flux_G)
-norm_flux_F_smooth = normalize_spectrum_smooth(wavelength_F, flux_F)
-norm_flux_B_smooth = normalize_spectrum_smooth(wavelength_B, flux_B, polyorder=1)
+wavelength_G, flux_G, norm_flux_G_smooth = normalized(G_star)
+wavelength_F, flux_F, norm_flux_F_smooth = normalized(F_star)
+wavelength_B, flux_B, norm_flux_B_smooth = normalized(B_star)
 
 # Important absorption lines for classification
-absorption_lines = {
-    r'H_{\alpha}': 6563,
-    r'H_{\beta}': 4861,
-    r'H_{\gamma}': 4341,
-    r'H_{\delta}': 4102,
-    'He I 4471': 4471,
-    'He I 4026': 4026,
-    'Ca II K': 3933,
-    'Ca II H': 3968,
-    'Fe I 4383': 4383,
-    'Fe I 5270': 5270,
-    'Na I D1': 5890,
-    'Na I D2': 5896
-}
+absorption_lines = load_catalog().select(species=['H', 'He', 'Ca', 'Fe', 'Na'], include_tentative=False)
 # Group absorption lines by element for consistent coloring
 element_colors = {
     'H': 'r',
@@ -62,14 +46,25 @@ element_colors = {
     'Na': 'c'
 }
 
+if args.output:
+    # Headless: drawn on Agg canvases by render.py
+    for star, wavelength, flux, norm_flux, title in [
+            (G_star, wavelength_G, flux_G, norm_flux_G_smooth, 'HD109358 (G Star)'),
+            (F_star, wavelength_F, flux_F, norm_flux_F_smooth, 'HD194093 (F Star)'),
+            (B_star, wavelength_B, flux_B, norm_flux_B_smooth, 'HD120315 (B Star)')]:
+        output_path = os.path.join(args.output, f"{title.split()[0]}.{args.format}")
+        print("Wrote", render_spectrum(wavelength, flux, norm_flux, output_path,
+                                       f'{title} - Normalized and Unnormalized Spectrum', absorption_lines.as_pairs()))
+    print(default_cache().report())
+    sys.exit()
+
 # Plotting the normalized and unnormalized spectra for G star
 plt.figure()
 plt.plot(wavelength_G, flux_G, label='Unnormalized Flux', linestyle='-', alpha=0.5)
 plt.plot(wavelength_G, norm_flux_G_smooth, label='Normalized Flux', linestyle='-')
-for line_name, line_wavelength in absorption_lines.items():
-    element = line_name.split()[0] if ' ' in line_name else line_name.split('_')[0]
+for line_wavelength, element, line_label in zip(absorption_lines.center, absorption_lines.species, absorption_lines.label):
     color = element_colors.get(element, 'k')
-    plt.axvline(x=line_wavelength, color=color, linestyle=':', label=f'${line_name}$')
+    plt.axvline(x=line_wavelength, color=color, linestyle=':', label=f'{line_label} {line_wavelength:.0f}')
 plt.xlabel('Wavelength')
 plt.ylabel('Flux')
 plt.title('HD109358 (G Star) - Normalized and Unnormalized Spectrum')
@@ -80,10 +75,9 @@ plt.show()
 plt.figure()
 plt.plot(wavelength_F, flux_F, label='Unnormalized Flux', linestyle='-', alpha=0.5)
 plt.plot(wavelength_F, norm_flux_F_smooth, label='Normalized Flux', linestyle='-')
-for line_name, line_wavelength in absorption_lines.items():
-    element = line_name.split()[0] if ' ' in line_name else line_name.split('_')[0]
+for line_wavelength, element, line_label in zip(absorption_lines.center, absorption_lines.species, absorption_lines.label):
     color = element_colors.get(element, 'k')
-    plt.axvline(x=line_wavelength, color=color, linestyle=':', label=f'${line_name}$')
+    plt.axvline(x=line_wavelength, color=color, linestyle=':', label=f'{line_label} {line_wavelength:.0f}')
 plt.xlabel('Wavelength')
 plt.ylabel('Flux')
 plt.title('HD194093 (F Star) - Normalized and Unnormalized Spectrum')
@@ -94,12 +88,13 @@ plt.show()
 plt.figure()
 plt.plot(wavelength_B, flux_B, label='Unnormalized Flux', linestyle='-', alpha=0.5)
 plt.plot(wavelength_B, norm_flux_B_smooth, label='Normalized Flux', linestyle='-')
-for line_name, line_wavelength in absorption_lines.items():
-    element = line_name.split()[0] if ' ' in line_name else line_name.split('_')[0]
+for line_wavelength, element, line_label in zip(absorption_lines.center, absorption_lines.species, absorption_lines.label):
     color = element_colors.get(element, 'k')
-    plt.axvline(x=line_wavelength, color=color, linestyle=':', label=f'${line_name}$')
+    plt.axvline(x=line_wavelength, color=color, linestyle=':', label=f'{line_label} {line_wavelength:.0f}')
 plt.xlabel('Wavelength')
 plt.ylabel('Flux')
 plt.title('HD120315 (B Star) - Normalized and Unnormalized Spectrum')
 plt.legend()
 plt.show()
+
+print(default_cache().report())
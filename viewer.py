@@ -0,0 +1,224 @@
+import os, sys, argparse
+import numpy as np
+from matplotlib.collections import LineCollection
+from line_catalog import load_catalog
+
+### Interactive spectrum viewer ###
+# Every spectrum is turned into a min/max pyramid once: level L holds the minimum and
+# maximum of each block of 2**L pixels, each level built from the one below. On every
+# zoom, pan or resize the viewer picks, per spectrum, the coarsest level that still has
+# at least one block per screen pixel in the visible range, and hands matplotlib only
+# those points (about two per screen pixel, whatever the spectrum length). Catalog lines
+# are only drawn inside the visible range.
+
+class LODPyramid:
+    """
+    Min/max level-of-detail pyramid of one spectrum.
+
+    Parameters:
+    wavelength, flux: array-like
+        Spectrum (wavelength sorted).
+    min_bins: int
+        The pyramid stops at the first level with fewer blocks than this.
+    """
+
+    def __init__(self, wavelength, flux, min_bins=256):
+        self.wavelength = np.asarray(wavelength, dtype=np.float64)
+        self.flux = np.asarray(flux, dtype=np.float64)
+        # nan pixels never win a min/max comparison, so gaps stay gaps
+        low = np.where(np.isnan(self.flux), np.inf, self.flux)
+        high = np.where(np.isnan(self.flux), -np.inf, self.flux)
+
+        # Level 0 is the spectrum itself; (i_min, i_max) are pixel indices of each block's extremes
+        index = np.arange(self.flux.size)
+        self.levels = [(index, index)]
+        while self.levels[-1][0].size >= 2 * min_bins:
+            i_min, i_max = self.levels[-1]
+            n_pairs = i_min.size // 2
+            # An odd last block is merged into the pair before it
+            a_min, b_min = i_min[:2 * n_pairs:2], i_min[1:2 * n_pairs:2].copy()
+            a_max, b_max = i_max[:2 * n_pairs:2], i_max[1:2 * n_pairs:2].copy()
+            if i_min.size % 2:
+                b_min[-1] = np.where(low[i_min[-1]] < low[b_min[-1]], i_min[-1], b_min[-1])
+                b_max[-1] = np.where(high[i_max[-1]] > high[b_max[-1]], i_max[-1], b_max[-1])
+            self.levels.append((np.where(low[b_min] < low[a_min], b_min, a_min),
+                                np.where(high[b_max] > high[a_max], b_max, a_max)))
+
+    def view(self, wmin, wmax, n_pixels):
+        """
+        Points to draw for the wavelength range [wmin, wmax] on n_pixels screen pixels.
+
+        Returns:
+        x, y: ndarray
+            Full-resolution pixels if few enough, otherwise the in-order min/max points of
+            the blocks covering the range (plus one block on each side).
+        """
+        start = max(0, np.searchsorted(self.wavelength, wmin) - 1)
+        stop = min(self.flux.size, np.searchsorted(self.wavelength, wmax) + 1)
+        # Coarsest level with at least one block per screen pixel
+        level = int(np.clip(np.floor(np.log2(max(1, (stop - start) / max(1, n_pixels)))), 0, len(self.levels) - 1))
+        if level == 0:
+            return self.wavelength[start:stop], self.flux[start:stop]
+
+        i_min, i_max = self.levels[level]
+        first = max(0, (start >> level) - 1)
+        last = min(i_min.size, (stop >> level) + 2)
+        index = np.sort(np.column_stack([i_min[first:last], i_max[first:last]]), axis=1).ravel()
+        return self.wavelength[index], self.flux[index]
+
+class SpectrumViewer:
+    """
+    Overlay of spectra on a matplotlib Axes that redraws at the matching level of detail.
+
+    Parameters:
+    ax: matplotlib Axes
+    lines: LineCatalog or None
+        Lines to mark (default: non-tentative catalog lines).
+    flux_offset: float
+        Vertical offset between consecutive spectra.
+    """
+
+    def __init__(self, ax, lines=None, flux_offset=0.0):
+        self.ax = ax
+        self.lines = lines if lines is not None else load_catalog().select(include_tentative=False)
+        self.flux_offset = flux_offset
+        self.spectra = []  # (pyramid, offset, Line2D)
+        self._markers = LineCollection([], colors='k', linestyles='--', alpha=0.5, transform=ax.get_xaxis_transform())
+        ax.add_collection(self._markers)
+        # One label per catalog line, created once and only shown inside the visible range
+        self._labels = [ax.annotate(label, (center, 0.02), xycoords=ax.get_xaxis_transform(), xytext=(3, 0),
+                                    textcoords='offset points', color='k', fontsize=8, rotation=90,
+                                    verticalalignment='bottom', visible=False)
+                        for center, label in self.lines]
+        self._updating = False
+        ax.callbacks.connect('xlim_changed', self._on_xlim)
+        ax.figure.canvas.mpl_connect('resize_event', lambda event: self.update())
+
+    def add(self, wavelength, flux, label=None, **plot_kwargs):
+        """
+        Add a spectrum (its pyramid is built here, once).
+        """
+        pyramid = LODPyramid(wavelength, flux)
+        offset = len(self.spectra) * self.flux_offset
+        line, = self.ax.plot([], [], lw=0.8, label=label, **plot_kwargs)
+        self.spectra.append((pyramid, offset, line))
+        return line
+
+    def show_all(self):
+        """
+        Zoom out to the full wavelength and flux range of all spectra.
+        """
+        wmin = min(p.wavelength[0] for p, _, _ in self.spectra)
+        wmax = max(p.wavelength[-1] for p, _, _ in self.spectra)
+        ymin = min(np.nanmin(p.flux) + offset for p, offset, _ in self.spectra)
+        ymax = max(np.nanmax(p.flux) + offset for p, offset, _ in self.spectra)
+        margin = 0.05 * (ymax - ymin)
+        self.ax.set_ylim(ymin - margin, ymax + margin)
+        self.ax.set_xlim(wmin, wmax)  # triggers update()
+        self.ax.figure.canvas.draw_idle()
+
+    def _on_xlim(self, ax):
+        if not self._updating:
+            self.update()
+
+    def update(self):
+        """
+        Re-sample all spectra and line markers for the current x range.
+        """
+        self._updating = True
+        try:
+            wmin, wmax = sorted(self.ax.get_xlim())
+            n_pixels = max(1, int(self.ax.get_window_extent().width))
+            for pyramid, offset, line in self.spectra:
+                x, y = pyramid.view(wmin, wmax, n_pixels)
+                line.set_data(x, y + offset)
+
+            # Markers and labels only for the visible lines
+            lo, hi = self.lines.range_indices(wmin, wmax)
+            segments = np.zeros((hi - lo, 2, 2))
+            segments[:, :, 0] = self.lines.center[lo:hi, None]
+            segments[:, 0, 1], segments[:, 1, 1] = 0.05, 0.95
+            self._markers.set_segments(segments)
+            for i, text in enumerate(self._labels):
+                text.set_visible(lo <= i < hi)
+        finally:
+            self._updating = False
+        # No draw here: pan/zoom and resize are followed by a redraw of the canvas anyway
+
+def view_spectra(inputs, flux_offset=0.0, title=None):
+    """
+    Open an interactive window with the given spectra overlaid.
+
+    Parameters:
+    inputs: str or list of str
+        Directories, glob patterns or spectrum files in any format ingest.py reads.
+    """
+    import matplotlib.pyplot as plt
+    from ingest import ingest
+    collection = ingest(inputs)
+    for file_path, reason in collection.rejected:
+        print(f"Skipped {file_path}: {reason}", file=sys.stderr)
+    fig, ax = plt.subplots(figsize=(14, 8))
+    viewer = SpectrumViewer(ax, flux_offset=flux_offset)
+    for file_path, wavelength, flux in collection:
+        viewer.add(wavelength, flux, label=os.path.basename(file_path).split('_Melchiors')[0])
+    viewer.show_all()
+    ax.set_xlabel('Wavelength [A]')
+    ax.set_ylabel('Flux' + (' + Constant' if flux_offset else ''))
+    if title:
+        ax.set_title(title)
+    if len(collection) <= 12:
+        ax.legend(loc='upper right', fontsize=8)
+    fig.viewer = viewer  # keep the callbacks alive with the figure
+    return fig
+
+def _benchmark(inputs, n_frames=20):
+    # Time redraws of a zoom sequence, with the pyramid and with full-resolution lines
+    import time
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from ingest import ingest
+    collection = ingest(inputs)
+    spectra = list(zip(collection.wavelengths, collection.fluxes))
+    wmin, wmax = spectra[0][0][0], spectra[0][0][-1]
+    centers = np.linspace(wmin + 100, wmax - 100, n_frames)
+    widths = np.geomspace(wmax - wmin, 20, n_frames)
+
+    for mode in ('pyramid', 'full resolution'):
+        fig = Figure(figsize=(14, 8))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        if mode == 'pyramid':
+            viewer = SpectrumViewer(ax, flux_offset=1.0)
+            for w, f in spectra:
+                viewer.add(w, f)
+            viewer.show_all()
+        else:
+            # The same figure content drawn the plain way: all pixels and all line markers
+            from render import add_line_markers
+            for i, (w, f) in enumerate(spectra):
+                ax.plot(w, f + i, lw=0.8)
+            add_line_markers(ax, load_catalog().select(include_tentative=False).as_pairs())
+            ax.autoscale_view()
+        fig.canvas.draw()
+        start = time.perf_counter()
+        for center, width in zip(centers, widths):
+            ax.set_xlim(center - width / 2, center + width / 2)
+            fig.canvas.draw()
+        print(f"{mode:>16}: {(time.perf_counter() - start) / n_frames * 1e3:7.1f} ms per redraw "
+              f"({len(spectra)} spectra)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Interactive spectrum viewer with level-of-detail redraws.")
+    parser.add_argument('inputs', nargs='*', help="Directories, glob patterns or spectrum files (default: ExampleStars)")
+    parser.add_argument('--offset', type=float, default=1.0, help="Vertical offset between spectra")
+    parser.add_argument('--benchmark', action='store_true', help="Time zoom redraws without opening a window")
+    args = parser.parse_args()
+
+    inputs = args.inputs or [os.path.join(os.path.dirname(os.path.abspath(__file__)), "ExampleStars")]
+    if args.benchmark:
+        _benchmark(inputs)
+    else:
+        import matplotlib.pyplot as plt
+        view_spectra(inputs, args.offset)
+        plt.show()